@@ -0,0 +1,152 @@
+"""Tokenizer and recursive descent parser for the SIGNALS:: section of .accessory files.
+Each signal is a line of the form
+
+"SignalLabel":: Pos["TrackLabel" Start/End/Alt/Alternate/Altstart/Altend Left/Right] Red[Condition] Auto
+
+where the position words, Red[...] and Auto are optional and the condition is parsed into the Test, And and Or tree
+of Interlocking."""
+from collections import namedtuple
+
+from Interlocking import parse_condition, ConditionSyntaxError
+
+# A parsed signal. end is where on the track piece it stands, as the name of the piece's coordinate attribute
+# capitalised, side which side of the track it is drawn, and condition the tree of its red condition or None.
+SignalDefinition = namedtuple("SignalDefinition", ["label", "track_label", "end", "side", "condition", "automatic",
+                                                   "line", "line_number"])
+
+END_NAMES = {"Start": "Start", "End": "End", "Alt": "Alternate", "Alternate": "Alternate", "Altstart": "Altstart",
+             "Altend": "Altend"}
+SIDES = ("Left", "Right")
+
+
+class AccessorySyntaxError(Exception):
+    def __init__(self, line, string, line_number=None, column=None):
+        super().__init__(line, string, line_number, column)
+        self.line = line
+        self.line_number = line_number
+        self.column = column
+
+    def __str__(self):
+        where = "line {}".format(self.line_number) if self.line_number is not None else "signal"
+        if self.column is not None:
+            where += " column {}".format(self.column + 1)
+        return "{}: {}\n    {}{}".format(where, self.args[1], self.line,
+                                        "\n    " + " " * self.column + "^" if self.column is not None else "")
+
+
+def tokenize_signal(text, line_number=None):
+    """Yields (token, value, column) where token is one of "string", "name", "::", "[", "]" or "condition", the text
+    between the brackets after Red"""
+    i = 0
+    previous = None
+    while i < len(text):
+        char = text[i]
+        if char.isspace():
+            i += 1
+            continue
+        if char == '"':
+            end = text.find('"', i + 1)
+            if end == -1:
+                raise AccessorySyntaxError(text, "Unterminated label", line_number, i)
+            token = ("string", text[i + 1:end], i)
+            i = end + 1
+        elif text.startswith("::", i):
+            token = ("::", "::", i)
+            i += 2
+        elif char == "[" and previous == ("name", "Red"):
+            end = text.find("]", i + 1)
+            if end == -1:
+                raise AccessorySyntaxError(text, "Unterminated red condition", line_number, i)
+            yield "[", char, i
+            token = ("condition", text[i + 1:end], i + 1)
+            i = end
+        elif char in "[]":
+            token = (char, char, i)
+            i += 1
+        elif char.isalpha():
+            end = i + 1
+            while end < len(text) and text[end].isalnum():
+                end += 1
+            token = ("name", text[i:end], i)
+            i = end
+        else:
+            raise AccessorySyntaxError(text, "Unexpected character {}".format(char), line_number, i)
+        previous = token[:2]
+        yield token
+
+
+def parse_signal(text, line_number=None) -> SignalDefinition:
+    """Parses one signal definition"""
+    tokens = list(tokenize_signal(text, line_number))
+    position = 0
+
+    def error(string, column):
+        return AccessorySyntaxError(text, string, line_number, column)
+
+    def peek(token, values=None):
+        """Returns the value of the next token if it is token (and one of values), otherwise None"""
+        if position < len(tokens) and tokens[position][0] == token:
+            if values is None or tokens[position][1] in values:
+                return tokens[position][1]
+        return None
+
+    def take(token, describe=None):
+        nonlocal position
+        describe = describe or token
+        if position >= len(tokens):
+            raise error("Expected {} at end of line".format(describe), len(text))
+        kind, value, column = tokens[position]
+        if kind != token:
+            raise error("Expected {} not {}".format(describe, value), column)
+        position += 1
+        return value
+
+    def keyword(name):
+        column = tokens[position][2] if position < len(tokens) else len(text)
+        if take("name", name) != name:
+            raise error("Expected {} not {}".format(name, tokens[position - 1][1]), column)
+
+    label = take("string", "signal label")
+    take("::")
+    keyword("Pos")
+    take("[")
+    track_label = take("string", "track label")
+    end = "Start"
+    if peek("name", END_NAMES):
+        end = END_NAMES[take("name")]
+    side = "Left"
+    if peek("name", SIDES):
+        side = take("name")
+    take("]")
+    condition = None
+    if peek("name", ("Red",)):
+        keyword("Red")
+        take("[")
+        if peek("condition") is not None:
+            column = tokens[position][2]
+            try:
+                condition = parse_condition(take("condition"))
+            except ConditionSyntaxError as e:
+                raise error("Invalid red condition: {}".format(e.args[0]), column + e.column)
+        take("]")
+    automatic = peek("name", ("Auto",)) is not None
+    if automatic:
+        keyword("Auto")
+    if position < len(tokens):
+        raise error("Unexpected {}".format(tokens[position][1]), tokens[position][2])
+    return SignalDefinition(label, track_label, end, side, condition, automatic, text, line_number)
+
+
+def parse_accessory(lines):
+    """Yields a SignalDefinition for each signal in the SIGNALS:: sections of the lines of an .accessory file"""
+    signals_define = False
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        elif line.startswith("SIGNALS::"):
+            signals_define = True
+        elif line.startswith("::END"):
+            signals_define = False
+        elif signals_define:
+            yield parse_signal(line, line_number)
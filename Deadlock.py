@@ -0,0 +1,49 @@
+"""Finds trains that are waiting on each other, from the wait-for graph of the layout"""
+
+
+class DeadlockDetector:
+    """Keeps which train each blocked train is waiting for: the train on the piece it needs next, in its block ahead
+    or that it is braking for. A train waits for at most one other, so the wait-for graph is a set of chains, and a
+    deadlock is a chain that loops back on itself. It is checked for when a train starts waiting, by following the
+    chain from the train it waits for, so the cost is the length of that chain rather than the size of the layout.
+    Each deadlock is reported once, in deadlocks and to listeners called with the list of trains. With resolve=True
+    the last train to block reverses to break it."""
+
+    def __init__(self, track_manager, resolve=False):
+        self.track_manager = track_manager
+        track_manager.deadlock_detector = self
+        self.resolve = resolve
+        # Train: train it is waiting for
+        self.waits_for = {}
+        self.deadlocks = []
+        self.listeners = []
+
+    def waiting(self, train, other):
+        """Records that train is waiting for other, or has stopped waiting if other is None"""
+        if self.waits_for.get(train) is other:
+            return
+        if other is None:
+            del self.waits_for[train]
+            return
+        self.waits_for[train] = other
+        cycle = self.cycle(train)
+        if cycle is not None:
+            self.deadlock(cycle)
+
+    def cycle(self, train):
+        """Returns the trains in the loop of waits through train, or None"""
+        chain = [train]
+        other = self.waits_for.get(train)
+        while other is not None and other is not train and len(chain) <= len(self.waits_for):
+            chain.append(other)
+            other = self.waits_for.get(other)
+        return chain if other is train else None
+
+    def deadlock(self, cycle):
+        print("Deadlock:", ", ".join(str(train) for train in cycle))
+        self.deadlocks.append(cycle)
+        for listener in self.listeners:
+            listener(cycle)
+        if self.resolve:
+            self.waiting(cycle[0], None)
+            cycle[0].reverse()
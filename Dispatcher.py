@@ -0,0 +1,216 @@
+"""Runs trains to a timetable: sets their routes, clears their signals and releases them when they are due"""
+from collections import namedtuple
+import heapq
+import re
+
+from Managers import TrackGroup, lever_state
+
+# A timetabled movement of the train labelled train from the signal or track label origin to destination, due at
+# departure seconds. Higher priorities go first. A service with every set runs again every that many seconds after it
+# has departed.
+Service = namedtuple("Service", ["train", "origin", "destination", "departure", "priority", "every"],
+                     defaults=(0, None))
+
+
+class Dispatcher:
+    """Grants the services of a timetable in priority order once they are due and the train is waiting at the origin.
+    Due services are kept in a heap. A service gains aging priority for every second it waits, so lower priority
+    trains are not held forever behind busy higher priority ones. As every waiting service ages at the same rate
+    its place only depends on priority - aging * departure, and the heap never has to be reordered.
+    A service is granted when the route is clear of other trains and does not cross, or need a lever set
+    differently from, a route already granted, and the points set for it would not force the origin signal red. Only
+    then are the points switched with TrackGroup.switch, the origin signal cleared and the train started, so a service
+    that cannot be granted leaves the points and the train as they were. The signal goes back to red once the train
+    has left its piece, and the route is released when the train reaches the destination."""
+
+    def __init__(self, track_manager, route_manager, trains, services=(), aging=1 / 60):
+        self.track_manager = track_manager
+        self.route_manager = route_manager
+        self.trains = {train.label: train for train in trains}
+        self.aging = aging
+        self._count = 0
+        # (departure, order, service) not yet due
+        self.timetable = []
+        # (aging * departure - priority, departure, order, service) due
+        self.queue = []
+        # Train: (service, granted time, route, route mask)
+        self.running = {}
+        # Signal: train it was cleared for
+        self.cleared = {}
+        # (service, granted time, arrival time)
+        self.arrivals = []
+        self.now = 0
+        for service in services:
+            self.add(service)
+
+    def add(self, service):
+        heapq.heappush(self.timetable, (service.departure, self._count, service))
+        self._count += 1
+
+    def update(self, now):
+        """Called with the time in seconds. Returns the services granted."""
+        self.now = now
+        for signal, train in list(self.cleared.items()):
+            if train.track_segment is not signal.track_segment or not signal.set:
+                del self.cleared[signal]
+                if signal.set:
+                    signal.on_click(None)
+        for train, (service, granted, route, _) in list(self.running.items()):
+            if train.track_segment is route.pieces[-1]:
+                if service.destination not in self.signals:
+                    train.stop = True
+                del self.running[train]
+                self.arrivals.append((service, granted, now))
+        while self.timetable and self.timetable[0][0] <= now:
+            departure, order, service = heapq.heappop(self.timetable)
+            heapq.heappush(self.queue, (self.aging * departure - service.priority, departure, order, service))
+        granted, waiting = [], []
+        while self.queue:
+            entry = heapq.heappop(self.queue)
+            service = entry[3]
+            if self.grant(service):
+                granted.append(service)
+                if service.every:
+                    self.add(service._replace(departure=service.departure + service.every))
+            else:
+                waiting.append(entry)
+        for entry in waiting:
+            heapq.heappush(self.queue, entry)
+        return granted
+
+    @property
+    def signals(self):
+        signal_manager = self.track_manager.signal_manager
+        return signal_manager.all if signal_manager is not None else {}
+
+    def at_origin(self, train, service):
+        """Returns True if train is waiting to start service"""
+        if train in self.running:
+            return False
+        signal = self.signals.get(service.origin)
+        if signal is not None:
+            return train.held_by() is signal
+        return train.stop and train.track_segment is self.route_manager.destination(service.origin)
+
+    def grant(self, service) -> bool:
+        """Sets the route for service and lets the train go, if it can go now"""
+        train = self.trains.get(service.train)
+        if train is None or not self.at_origin(train, service):
+            return False
+        route_manager = self.route_manager
+        route = route_manager.route(service.origin, service.destination)
+        if route is None or not route_manager.route_clear(service.origin, service.destination, train):
+            return False
+        mask = self.track_manager.occupancy.mask(route.pieces)
+        for _, _, other, other_mask in self.running.values():
+            if mask & other_mask or any(other.settings.get(lever, state) != state
+                                        for lever, state in route.settings.items()):
+                return False
+        signal = self.signals.get(service.origin)
+        if signal is not None and self.forced_red(signal, route):
+            return False
+        previous = {lever: lever_state(lever) for lever in route.settings}
+        segment_end = train.segment_end
+        if not self.set_points(route, train):
+            return False
+        if tuple(train.pos) == train.segment_start:
+            # As Train.move does while held, so the train takes the points just set
+            train.segment_end = train.track_segment.next(train.segment_start)
+        if signal is not None:
+            if not signal.set:
+                signal.on_click(None)
+            if not signal.set:
+                # Held red by something other than the points, e.g. the block ahead of an automatic signal
+                self.switch(previous)
+                train.segment_end = segment_end
+                return False
+            self.cleared[signal] = train
+        self.running[train] = (service, self.now, route, mask)
+        if train.stop:
+            train.stop = False
+        return True
+
+    def set_points(self, route, train):
+        """Switches the levers of route that are set the other way. Returns False if a train other than train is on
+        one of them."""
+        occupancy = self.track_manager.occupancy
+        for lever, state in route.settings.items():
+            pieces = lever.all if isinstance(lever, TrackGroup) else (lever,)
+            if lever_state(lever) != state and not occupancy.is_clear(occupancy.mask(pieces), train):
+                return False
+        self.switch(route.settings)
+        return True
+
+    def switch(self, settings):
+        """Sets each lever in settings, {lever: state}, that is set the other way, writing its points to serial"""
+        for lever, state in settings.items():
+            if lever_state(lever) == state:
+                continue
+            if isinstance(lever, TrackGroup):
+                lever.switch(state)
+            else:
+                lever.set = state
+                lever.draw()
+                self.track_manager.points_changed(lever)
+
+    def forced_red(self, signal, route) -> bool:
+        """Returns True if the points, once set for route, would force signal red"""
+        if signal.red_conditions is None:
+            return False
+        interlocking = self.track_manager.signal_manager.interlocking
+        word = interlocking.state_word()
+        for lever, state in route.settings.items():
+            pieces = lever.all if isinstance(lever, TrackGroup) else (lever,)
+            for piece in pieces:
+                bit = interlocking.bits.get(piece, 0)
+                if state ^ (isinstance(lever, TrackGroup) and piece in lever.invert):
+                    word |= bit
+                else:
+                    word &= ~bit
+        return interlocking.forces_red(signal, word)
+
+    def throughput(self, now=None) -> float:
+        """Returns the services completed per hour so far"""
+        now = self.now if now is None else now
+        return len(self.arrivals) * 3600 / now if now else 0.0
+
+    def delays(self):
+        """Returns how many seconds each completed service waited after it was due"""
+        return [granted - service.departure for service, granted, _ in self.arrivals]
+
+
+def load_timetable(filename):
+    """Returns the Services in a .timetable file"""
+    timetable_define = False
+    # Line of the form "TrainLabel":: From["Label"] To["Label"] At[seconds] Priority[n] Every[seconds]
+    service_re = re.compile(r"\s*".join(
+        (r'"(?P<train>[^"]+)"::',
+         'From', r'\[', r'"(?P<origin>[^"]+)"', r'\]',
+         'To', r'\[', r'"(?P<destination>[^"]+)"', r'\]',
+         'At', r'\[', r'(?P<departure>\d+(\.\d*)?)', r'\]',
+         r'(Priority', r'\[', r'(?P<priority>-?\d+)', r'\])?',
+         r'(Every', r'\[', r'(?P<every>\d+(\.\d*)?)', r'\])?')))
+    services = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip("\n").strip()
+            if not line or line.startswith("#"):
+                continue
+            elif line.startswith("TIMETABLE::"):
+                timetable_define = True
+            elif line.startswith("::END"):
+                timetable_define = False
+            elif timetable_define:
+                m = service_re.fullmatch(line)
+                if m is None:
+                    raise TimetableSyntaxError(line, "Service definition not of correct form")
+                every = float(m["every"]) if m["every"] else None
+                if every == 0:
+                    raise TimetableSyntaxError(line, "Every must be more than 0")
+                services.append(Service(m["train"], m["origin"], m["destination"], float(m["departure"]),
+                                        int(m["priority"] or 0), every))
+    return services
+
+
+class TimetableSyntaxError(Exception):
+    pass
@@ -0,0 +1,195 @@
+"""Compiles the red conditions of signals so that interlocking checks do no parsing at run time.
+A condition is a sequence of "TrackLabel" 0/1 joined by & and |, with & binding tighter than | and optional
+parentheses to group statements."""
+from collections import namedtuple
+from functools import reduce
+
+from Models import Point
+
+# Condition tree
+Test = namedtuple("Test", ["label", "state"])
+And = namedtuple("And", ["terms"])
+Or = namedtuple("Or", ["terms"])
+
+
+class ConditionSyntaxError(Exception):
+    def __init__(self, text, string, column):
+        super().__init__(string, text, column)
+        self.column = column
+
+
+def tokenize_condition(text):
+    """Yields (token, value, column) where token is one of "label", "state", "&", "|", "(" or ")" """
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char.isspace():
+            i += 1
+        elif char == '"':
+            end = text.find('"', i + 1)
+            if end == -1:
+                raise ConditionSyntaxError(text, "Unterminated label", i)
+            yield "label", text[i + 1:end], i
+            i = end + 1
+        elif char in "01":
+            yield "state", int(char), i
+            i += 1
+        elif char in "&|()":
+            yield char, char, i
+            i += 1
+        else:
+            raise ConditionSyntaxError(text, "Unexpected character {}".format(char), i)
+
+
+def parse_condition(text):
+    """Parses a condition into a tree of Test, And and Or. Returns None for an empty condition."""
+    tokens = list(tokenize_condition(text))
+    if not tokens:
+        return None
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def take(expected):
+        nonlocal position
+        if position >= len(tokens):
+            raise ConditionSyntaxError(text, "Expected {} at end of condition".format(expected), len(text))
+        token, value, column = tokens[position]
+        if token != expected:
+            raise ConditionSyntaxError(text, "Expected {} not {}".format(expected, value), column)
+        position += 1
+        return value
+
+    def expression():
+        terms = [conjunction()]
+        while peek() == "|":
+            take("|")
+            terms.append(conjunction())
+        return terms[0] if len(terms) == 1 else Or(tuple(terms))
+
+    def conjunction():
+        terms = [atom()]
+        while peek() == "&":
+            take("&")
+            terms.append(atom())
+        return terms[0] if len(terms) == 1 else And(tuple(terms))
+
+    def atom():
+        if peek() == "(":
+            take("(")
+            node = expression()
+            take(")")
+            return node
+        return Test(take("label"), take("state"))
+
+    tree = expression()
+    if position != len(tokens):
+        raise ConditionSyntaxError(text, "Unexpected {}".format(tokens[position][1]), tokens[position][2])
+    return tree
+
+
+def condition_labels(node):
+    """Returns the set of track labels a condition depends on"""
+    if node is None:
+        return set()
+    if isinstance(node, Test):
+        return {node.label}
+    return set.union(*(condition_labels(term) for term in node.terms))
+
+
+def compile_condition(node, track_labels):
+    """Compiles a condition tree into a function of no arguments that is True when the condition holds.
+    Track pieces are looked up once here so evaluating does no parsing or label lookups."""
+    if isinstance(node, Test):
+        piece = track_labels[node.label]
+        state = node.state
+        return lambda: piece.set == state
+    terms = [compile_condition(term, track_labels) for term in node.terms]
+    if isinstance(node, And):
+        return reduce(lambda first, second: lambda: first() and second(), terms)
+    else:
+        return reduce(lambda first, second: lambda: first() or second(), terms)
+
+
+def evaluate_condition(node, states):
+    """Evaluates a condition tree for a dictionary of track label: state"""
+    if isinstance(node, Test):
+        return states[node.label] == node.state
+    elif isinstance(node, And):
+        return all(evaluate_condition(term, states) for term in node.terms)
+    else:
+        return any(evaluate_condition(term, states) for term in node.terms)
+
+
+class InterlockingTable:
+    """Gives every point an index in one integer state word, and precomputes for each signal the set of words (masked
+    to the points it depends on) that force it red. Checking a signal is then a table lookup, and all signals can be
+    checked against one state word in a single pass. A signal with no red condition is never forced red."""
+
+    def __init__(self, track_manager, signals):
+        self.points = [piece for piece in track_manager if isinstance(piece, Point)]
+        self.bits = {piece: 1 << i for i, piece in enumerate(self.points)}
+        self.signals = list(signals)
+        self.masks = []
+        self.red_words = []
+        self.signal_bits = {}
+        # Signal: its index in signals
+        self.index = {}
+        for i, signal in enumerate(self.signals):
+            self.index[signal] = i
+            labels = sorted(condition_labels(signal.condition))
+            bits = [self.bits[track_manager.track_labels[label]] for label in labels]
+            red_words = set()
+            for combination in range(2 ** len(labels) if signal.condition is not None else 0):
+                states = {label: (combination >> j) & 1 for j, label in enumerate(labels)}
+                if evaluate_condition(signal.condition, states):
+                    red_words.add(sum(bit for label, bit in zip(labels, bits) if states[label]))
+            self.signal_bits[signal] = tuple((track_manager.track_labels[label], bit)
+                                             for label, bit in zip(labels, bits))
+            self.masks.append(sum(bits))
+            self.red_words.append(frozenset(red_words))
+
+    def state_word(self):
+        """Returns the current state of all points as an integer, bit i being set if point i is set"""
+        word = 0
+        for piece, bit in self.bits.items():
+            if piece.set:
+                word |= bit
+        return word
+
+    def predicate(self, signal):
+        """Returns a function of no arguments that is True when the points force signal to be red"""
+        bits = self.signal_bits[signal]
+        red_words = self.red_words[self.index[signal]]
+
+        def red():
+            word = 0
+            for piece, bit in bits:
+                if piece.set:
+                    word |= bit
+            return word in red_words
+        return red
+
+    def forces_red(self, signal, word=None) -> bool:
+        """Returns True if the state word (default the current state) forces signal red"""
+        if word is None:
+            word = self.state_word()
+        i = self.index[signal]
+        return (word & self.masks[i]) in self.red_words[i]
+
+    def red_mask(self, word=None):
+        """Returns an integer with bit i set if signals[i] is forced red by the state word (default the current
+        state)"""
+        if word is None:
+            word = self.state_word()
+        out = 0
+        for i, (mask, red_words) in enumerate(zip(self.masks, self.red_words)):
+            if (word & mask) in red_words:
+                out |= 1 << i
+        return out
+
+    def red_signals(self, word=None):
+        """Returns the list of signals forced red by the state word (default the current state)"""
+        red_mask = self.red_mask(word)
+        return [signal for i, signal in enumerate(self.signals) if red_mask >> i & 1]
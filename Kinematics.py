@@ -0,0 +1,90 @@
+"""Moves all trains in one vectorised step"""
+import numpy
+
+
+class TrainKinematics:
+    """Keeps every train's position, heading, speed and distance along its path in arrays.
+    Each tick, trains that are running, well clear of both ends of their segment and not about to pass a vertex of
+    its path are advanced together with array arithmetic along the line they are on. The rest, which may be held at a
+    signal, rounding a curve, about to enter a new piece or in conflict, are returned for Train.move to deal with one
+    by one. Train.pos is a view of its row of position and Train.distance of its item of progress, so moving in either
+    place moves the train."""
+    # Trains within this distance (plus one tick at their speed) of the end of a segment are moved by Train.move, to
+    # cover the 20 pixel box Train.move checks for conflicts.
+    near_end = 30
+
+    def __init__(self):
+        self.trains = []
+        self.index = {}
+        self.position = numpy.zeros((0, 2))
+        self.heading = numpy.zeros((0, 2))
+        self.speed = numpy.zeros(0)
+        self.progress = numpy.zeros(0)
+        self.remaining = numpy.zeros(0)
+        self.to_vertex = numpy.zeros(0)
+        self.running = numpy.zeros(0, dtype=bool)
+
+    def add(self, train):
+        i = len(self.trains)
+        self.trains.append(train)
+        self.index[train] = i
+        self.position = numpy.vstack((self.position, numpy.array(train.pos, dtype=float)))
+        self.heading = numpy.vstack((self.heading, numpy.zeros(2)))
+        self.speed = numpy.append(self.speed, 0.0)
+        self.progress = numpy.append(self.progress, train.distance)
+        self.remaining = numpy.append(self.remaining, 0.0)
+        self.to_vertex = numpy.append(self.to_vertex, 0.0)
+        self.running = numpy.append(self.running, False)
+        # The arrays have been copied, so point every train at its new row
+        for j, other in enumerate(self.trains):
+            other.pos = self.position[j]
+            other._distance = self.progress[j:j + 1]
+        self.sync(train)
+
+    def remove(self, train):
+        keep = [j for j, other in enumerate(self.trains) if other is not train]
+        train.pos = list(self.position[self.index[train]])
+        train._distance = [float(self.progress[self.index[train]])]
+        self.trains = [self.trains[j] for j in keep]
+        self.index = {other: j for j, other in enumerate(self.trains)}
+        self.position = self.position[keep]
+        self.heading = self.heading[keep]
+        self.speed = self.speed[keep]
+        self.progress = self.progress[keep]
+        self.remaining = self.remaining[keep]
+        self.to_vertex = self.to_vertex[keep]
+        self.running = self.running[keep]
+        for j, other in enumerate(self.trains):
+            other.pos = self.position[j]
+            other._distance = self.progress[j:j + 1]
+
+    def sync(self, train):
+        """Updates the arrays from a train after it has changed segment, speed or stopped"""
+        i = self.index[train]
+        self.speed[i] = train.speed
+        self.running[i] = not train.stop
+        if train.segment_end is None:
+            self.heading[i] = 0
+            self.progress[i] = self.remaining[i] = self.to_vertex[i] = 0
+            return
+        path = train.path
+        vertex = path.index(train.distance)
+        line = numpy.subtract(path.points[vertex], path.points[vertex - 1])
+        length = path.lengths[vertex] - path.lengths[vertex - 1]
+        self.heading[i] = line / length if length else 0
+        self.progress[i] = train.distance
+        self.remaining[i] = path.length - train.distance
+        self.to_vertex[i] = path.lengths[vertex] - train.distance
+
+    def step(self):
+        """Advances the trains that are clear of the ends of their segments. Returns (moved, others): the indices of
+        the trains moved, and of the running trains left for Train.move."""
+        clear = self.running & (self.progress > 0) & (self.remaining > self.near_end + self.speed) & \
+            (self.to_vertex > self.speed)
+        moved = numpy.flatnonzero(clear)
+        others = numpy.flatnonzero(self.running & ~clear)
+        self.position[moved] += self.heading[moved] * self.speed[moved, None]
+        self.progress[moved] += self.speed[moved]
+        self.remaining[moved] -= self.speed[moved]
+        self.to_vertex[moved] -= self.speed[moved]
+        return moved, others
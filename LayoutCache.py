@@ -0,0 +1,57 @@
+"""Keeps the parsed form of a layout file next to it, so it is only parsed again when the file changes"""
+import hashlib
+import os
+import pickle
+
+
+class LayoutCache:
+    """The cache of a .track or .accessory file, kept in filename + ".cache" as a pickle of plain tuples, lists,
+    signal definitions and condition trees together with the SHA-256 of the source. Entries are only used while the
+    source and format version are unchanged. A cache that is missing, stale or unreadable is ignored, and one that
+    cannot be written is skipped, so the cache never stops a layout loading."""
+    # Increment when the form of any cached entry changes
+    version = 2
+
+    def __init__(self, filename, enabled=True):
+        self.filename = filename
+        self.path = filename + ".cache"
+        self.enabled = enabled
+        with open(filename, "rb") as f:
+            source = f.read()
+        self.text = source.decode()
+        self.digest = hashlib.sha256(source).hexdigest()
+        self.entries = self.read() if enabled else {}
+        self._dirty = False
+
+    def read(self) -> dict:
+        try:
+            with open(self.path, "rb") as f:
+                version, digest, entries = pickle.load(f)
+        except (OSError, EOFError, ValueError, TypeError, AttributeError, ImportError, pickle.UnpicklingError):
+            return {}
+        if version != self.version or digest != self.digest:
+            return {}
+        return entries
+
+    def lines(self):
+        return self.text.splitlines()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        self.entries[key] = value
+        self._dirty = True
+
+    def save(self):
+        """Writes the cache if anything was added to it"""
+        if not self.enabled or not self._dirty:
+            return
+        temporary = self.path + ".tmp"
+        try:
+            with open(temporary, "wb") as f:
+                pickle.dump((self.version, self.digest, self.entries), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.path)
+        except OSError:
+            return
+        self._dirty = False
@@ -0,0 +1,106 @@
+"""Writes synthetic .track layouts of any size, for measuring how fast layouts are parsed and built.
+A layout is rows of track 50 pixels apart, each a branch of 50 pixel pieces. Straights are broken up by pairs of
+curves, crossovers and points, and every other pair of rows is joined by a pair of points sharing their alternate
+coordinate, so auto grouping has work to do. A matching .accessory file puts a signal at each linked point. The same
+arguments always give the same files."""
+import argparse
+import time
+
+from TrackParser import TrackParser
+
+# Position of each kind of piece in a repeating cycle along a row
+CYCLE = 8
+LINK = 2
+CURVE = 5
+CROSSOVER = 0
+
+
+def row_lengths(pieces, columns):
+    rows = -(-pieces // columns)
+    return [min(columns, pieces - row * columns) for row in range(rows)]
+
+
+def piece_text(row, column, lengths):
+    """Returns the text of a piece, before its end coordinate"""
+    x, y = 50 * column, 50 * row + 50
+    if column % CYCLE == LINK and row % 2 == 0 and row + 1 < len(lengths) and column + 1 < lengths[row + 1]:
+        return 'Point[({}, {}), 0] "P{}_{}"'.format(x + 50, y + 25, row, column)
+    if (column - 1) % CYCLE == LINK and row % 2 == 1 and column < lengths[row - 1]:
+        return 'Point[({}, {}), 0] "P{}_{}"'.format(x, y - 25, row, column)
+    if column % CYCLE == CROSSOVER and column:
+        return 'Crossover[({}, {}), ({}, {})] "X{}_{}"'.format(x, y + 25, x + 50, y - 25, row, column)
+    if column % CYCLE in (CURVE, CURVE + 1):
+        return "Curve"
+    return "Straight" if column % 2 else "St"
+
+
+def end_coordinate(row, column):
+    y = 50 * row + 50
+    if column % CYCLE == CURVE:
+        y += 10
+    return "({}, {})".format(50 * column + 50, y)
+
+
+def generate_layout(pieces, columns=200, per_line=8):
+    """Yields the lines of a layout with about pieces pieces"""
+    lengths = row_lengths(pieces, columns)
+    yield "# Synthetic layout of {} pieces in {} rows".format(pieces, len(lengths))
+    for row, length in enumerate(lengths):
+        yield ""
+        yield "NEW::Row{}({})".format(row, "Clockwise" if row % 2 == 0 else "Anticlockwise")
+        line = ["(0, {})".format(50 * row + 50)]
+        for column in range(length):
+            line.append(piece_text(row, column, lengths))
+            line.append(end_coordinate(row, column))
+            if (column + 1) % per_line == 0 and column + 1 < length:
+                yield " ".join(line)
+                line = []
+        line.append("::END")
+        yield " ".join(line)
+
+
+def generate_accessory(pieces, columns=200):
+    """Yields the lines of an .accessory file for generate_layout, with a signal at each point that links two rows,
+    red if either point of the link is set"""
+    lengths = row_lengths(pieces, columns)
+    yield "SIGNALS::"
+    for row in range(0, len(lengths) - 1, 2):
+        for column in range(LINK, lengths[row], CYCLE):
+            if column + 1 < lengths[row + 1]:
+                yield '"S{0}_{1}":: Pos["P{0}_{1}"] Red["P{0}_{1}" 1 | "P{2}_{3}" 1]'.format(row, column, row + 1,
+                                                                                        column + 1)
+    yield "::END"
+
+
+def write_layout(filename, pieces, columns=200):
+    with open(filename, "w") as f:
+        for line in generate_layout(pieces, columns):
+            f.write(line + "\n")
+
+
+def write_accessory(filename, pieces, columns=200):
+    with open(filename, "w") as f:
+        for line in generate_accessory(pieces, columns):
+            f.write(line + "\n")
+
+
+def parse_throughput(filename):
+    """Returns the pieces per second TrackParser parses filename at, and the number of pieces"""
+    parser = TrackParser()
+    started = time.perf_counter()
+    count = sum(1 for _ in parser.parse_file(filename))
+    elapsed = time.perf_counter() - started
+    if parser.errors:
+        raise parser.errors[0]
+    return count / elapsed, count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pieces", type=int, help="Number of pieces, e.g. 1000 to 100000")
+    parser.add_argument("output", help=".track file to write")
+    parser.add_argument("--columns", type=int, default=200, help="Pieces in each row")
+    args = parser.parse_args()
+    write_layout(args.output, args.pieces, args.columns)
+    rate, count = parse_throughput(args.output)
+    print("{} pieces parsed at {:.0f} pieces per second".format(count, rate))
@@ -0,0 +1,151 @@
+"""An integer indexed graph of the layout, so following the track is index arithmetic on flat arrays"""
+from array import array
+from collections.abc import Mapping
+
+from Models import Point, Crossover
+
+# No node or no piece
+NONE = -1
+# How a piece connects its endpoints
+PLAIN, FACING, TRAILING, CROSSOVER = range(4)
+
+
+class LayoutGraph:
+    """Nodes are the coordinates where pieces join and edges are the track pieces, both numbered from 0.
+    ends holds four node ids per piece: start, end, then alternate (points) or altstart and altend (crossovers), NONE
+    where unused. adjacency holds the two piece ids at each node, NONE where unused."""
+
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+        self.piece_ids = {piece: piece_id for piece_id, piece in enumerate(self.pieces)}
+        self.coordinates = []
+        self.node_ids = {}
+        self.kinds = array("b")
+        self.ends = array("l")
+        self.adjacency = array("l")
+        for piece_id, piece in enumerate(self.pieces):
+            if isinstance(piece, Crossover):
+                self.kinds.append(CROSSOVER)
+            elif isinstance(piece, Point):
+                self.kinds.append(FACING if piece.facing else TRAILING)
+            else:
+                self.kinds.append(PLAIN)
+            coordinates = piece.coordinates
+            for slot in range(4):
+                if slot < len(coordinates):
+                    node = self.add_node(coordinates[slot])
+                    self.ends.append(node)
+                    if self.adjacency[2 * node] == NONE:
+                        self.adjacency[2 * node] = piece_id
+                    elif self.adjacency[2 * node + 1] == NONE:
+                        self.adjacency[2 * node + 1] = piece_id
+                    else:
+                        raise Exception("Three pieces assigned to coordinate {}".format(coordinates[slot]))
+                else:
+                    self.ends.append(NONE)
+
+    def add_node(self, coord) -> int:
+        coord = tuple(coord)
+        if coord not in self.node_ids:
+            self.node_ids[coord] = len(self.coordinates)
+            self.coordinates.append(coord)
+            self.adjacency.extend((NONE, NONE))
+        return self.node_ids[coord]
+
+    def node(self, coord) -> int:
+        """Returns the node id of a coordinate, or NONE"""
+        return self.node_ids.get(tuple(coord), NONE) if coord is not None else NONE
+
+    def other_piece(self, node, piece_id) -> int:
+        """Returns the id of the piece joining piece_id at node, or NONE"""
+        if node == NONE:
+            return NONE
+        first = self.adjacency[2 * node]
+        return self.adjacency[2 * node + 1] if first == piece_id else first
+
+    def exit(self, piece_id, node) -> int:
+        """Returns the node a piece is left by when entered at node, depending how points are set, or NONE.
+        The same as Track.next on node ids."""
+        i = 4 * piece_id
+        kind = self.kinds[piece_id]
+        if kind == PLAIN:
+            return self.ends[i] if node == self.ends[i + 1] else self.ends[i + 1]
+        state = self.pieces[piece_id].set
+        if kind == FACING:
+            if node == self.ends[i]:
+                return self.ends[i + 2] if state else self.ends[i + 1]
+            elif node == self.ends[i + 1]:
+                return NONE if state else self.ends[i]
+            else:
+                return self.ends[i] if state else NONE
+        elif kind == TRAILING:
+            if node == self.ends[i + 1]:
+                return self.ends[i + 2] if state else self.ends[i]
+            elif node == self.ends[i]:
+                return NONE if state else self.ends[i + 1]
+            else:
+                return self.ends[i + 1] if state else NONE
+        else:
+            if state:
+                if node == self.ends[i + 2]:
+                    return self.ends[i + 3]
+                elif node == self.ends[i + 3]:
+                    return self.ends[i + 2]
+            else:
+                if node == self.ends[i]:
+                    return self.ends[i + 1]
+                elif node == self.ends[i + 1]:
+                    return self.ends[i]
+            return NONE
+
+    def start_piece(self, node, direction) -> int:
+        """Returns the piece a train at node travelling in direction is on, or NONE"""
+        first, second = self.adjacency[2 * node], self.adjacency[2 * node + 1]
+        if second == NONE:
+            return first
+        elif first == NONE:
+            return second
+        first_direction = self.pieces[first].direction
+        if first_direction == self.pieces[second].direction:  # The common case
+            # Leaving by the start in the direction of the track, otherwise by the end
+            slot = 0 if direction == first_direction else 1
+            # TODO: Cope with alternates
+            return first if self.ends[4 * first + slot] == node else second
+        else:
+            # Assume we are going the right way on the track.
+            return first if first_direction == direction else second
+
+    def walk(self, piece_id, node):
+        """Yields the ids of pieces followed from piece_id entered at node, until the line ends or points are set
+        against. For a loop this never finishes."""
+        while piece_id != NONE:
+            yield piece_id
+            node = self.exit(piece_id, node)
+            piece_id = self.other_piece(node, piece_id)
+
+    def __len__(self):
+        return len(self.pieces)
+
+
+class CoordinateView(Mapping):
+    """Read only view of a LayoutGraph as {coordinate: [piece, piece]}, padded with None, for code that looks pieces
+    up by coordinate. Unknown coordinates give [None, None]."""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, coord):
+        node = self.graph.node(coord)
+        if node == NONE:
+            return [None, None]
+        return [self.graph.pieces[piece_id] if piece_id != NONE else None
+                for piece_id in self.graph.adjacency[2 * node:2 * node + 2]]
+
+    def __contains__(self, coord):
+        return self.graph.node(coord) != NONE
+
+    def __iter__(self):
+        return iter(self.graph.coordinates)
+
+    def __len__(self):
+        return len(self.graph.coordinates)
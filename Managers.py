@@ -1,216 +1,318 @@
 """Classes controlling groups of models"""
-import re
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from Models import Track, Straight, Curve, Point, Crossover, Signal
+from LayoutGraph import LayoutGraph, CoordinateView, NONE, PLAIN
+from Occupancy import OccupancyManager
+from LayoutCache import LayoutCache
+from TrackParser import TrackParser, TrackSyntaxError
+from Interlocking import compile_condition, condition_labels, InterlockingTable
+from AccessoryParser import parse_accessory, AccessorySyntaxError
 from typing import Dict
 
+# TrackSyntaxError and AccessorySyntaxError are re-exported for callers that import them from here, as the errors
+# raised by TrackManager and SignalManager
+__all__ = ["Traversal", "Block", "TrackManager", "PointManager", "TrackGroup", "lever_of", "lever_state", "set_lever",
+           "SignalManager", "parse_track", "TrackSyntaxError", "AccessorySyntaxError"]
+
+# A walk along the track: the pieces in order, the index the pieces loop back to (or None if the line ends) and the
+# (point, state) pairs it depends on.
+Traversal = namedtuple("Traversal", ["pieces", "loop", "points"])
+# The pieces from a signal up to the next signal, the end of the line or points set against, and the state of each
+# lever (a TrackGroup or an ungrouped point) the way depends on.
+Block = namedtuple("Block", ["pieces", "settings"])
 
-class TrackManager(object):
-    """A central class for the whole layout."""
 
-    def __init__(self, canvas, filename="", auto_group=True):
+class TrackManager(object):
+    """A central class for the whole layout.
+    canvas may be None to load the layout as a pure model, e.g. for tests and simulations. A canvas can be attached
+    later with attach. If cache is True the parsed layout and its groups are kept in a LayoutCache next to the file.
+    This is for the applications, as it writes next to the layout and loads the pickle it finds there."""
+    # Cached walks kept for each starting point, for different settings of the points passed
+    traversal_variants = 8
+
+    def __init__(self, canvas, filename="", auto_group=True, cache=False):
         # Create Track
-        self.canvas = canvas
+        self.canvas = None
         self.signal_manager = None
         self.track_labels = {}
-        self.track_branches = self.load_track(filename, auto_group)
+        # Canvas item id: piece or signal drawn with it
+        self.canvas_items = {}
+        # Incremented when pieces or groups change, for caches of things derived from the layout
+        self.layout_version = 0
+        self.route_manager = None
+        self.deadlock_detector = None
+        self._traversals = {}
+        self._traversal_version = 0
+        self._blocks = {}
+        self._blocks_version = 0
+        # Called with a TrackGroup whenever it is switched
+        self.point_listeners = []
+        layout_cache = LayoutCache(filename, cache)
+        self.track_branches = self.load_track(layout_cache, auto_group)
         self.track_pieces = [x for _, v in self.track_branches.items() for x in v]
-        self.coordinate_dict = defaultdict(self.nonenone)
-        for piece in self.track_pieces:
-            for coord in piece.coordinates:
-                if self.coordinate_dict[coord][0] is None:
-                    self.coordinate_dict[coord][0] = piece
-                elif self.coordinate_dict[coord][1] is None:
-                    self.coordinate_dict[coord][1] = piece
-                else:
-                    raise Exception("Three pieces assigned to coordinate {}".format(coord))
+        self.graph = LayoutGraph(self.track_pieces)
+        self.coordinate_dict = CoordinateView(self.graph)
+        self.occupancy = OccupancyManager(self.graph)
         self.groups = []
         if auto_group:
-            self.auto_point_group()
+            groups = layout_cache.get("groups")
+            if groups is None:
+                self.auto_point_group()
+                layout_cache.set("groups", [[piece.piece_id for piece in group.all] for group in self.groups])
+            else:
+                self.groups = [TrackGroup([self.graph.pieces[piece_id] for piece_id in group]) for group in groups]
             for piece in self.track_pieces:
                 if isinstance(piece, Point) and not piece.groups:
                     self.groups.append(TrackGroup((piece,)))
-
-    @staticmethod
-    def nonenone():
-        """For default coordinate dictionary"""
-        return [None, None]
-
-    def load_track(self, filename, auto_group) -> Dict[str, list]:
-        """Loads track from a text file. Returns a dictionary with keys being the name of track branches from the file
-        """
+        for group in self.groups:
+            group.track_manager = self
+        layout_cache.save()
+        if canvas is not None:
+            self.attach(canvas)
+
+    def attach(self, canvas):
+        """Draws the layout on a canvas and binds the groups and signals to it"""
+        self.canvas = canvas
+        for piece in self.track_pieces:
+            piece.attach(canvas)
+            self.index_items(piece)
+        for group in self.groups:
+            group.bind()
+        if self.signal_manager is not None:
+            self.signal_manager.attach(canvas)
+
+    def load_track(self, layout_cache, auto_group) -> Dict[str, list]:
+        """Loads track from a text file, or its cache if the file is unchanged. Returns a dictionary with keys being
+        the name of track branches from the file"""
+        branches = layout_cache.get("track")
+        if branches is None:
+            branches = parse_track(layout_cache.lines())
+            layout_cache.set("track", branches)
+        return self.build_track(branches, auto_group)
+
+    def build_track(self, branches, auto_group) -> Dict[str, list]:
+        """Makes the pieces of each branch from parse_track"""
         out = defaultdict(list)
-        track_name_re = re.compile(r"NEW::\s*([^(]*)\(")
-        # Splits at spaces outside of brackets, and also at outermost brackets
-        space_split_re = re.compile(r"[^:\s\[(\"]+|\"[^\"]+\"|\[[^\]]*]|\([^)]*\)|::.*")
-        comma_split_re = re.compile(r"\([^)]*\)|[^\s,[(\]]+")
-
-        def coord_handler(text):
-            """Checks and converts "(0, 1)" to (0, 1)"""
-            if not re.match(r"^\(\s*[\d]+\s*,\s*[\d]+\)", text):
-                return None, None
-            c1, c2 = (int(x) for x in text[1:-1].split(","))
-            return c1, c2
-
-        def argument_handler(text):
-            """Splits arguments by commas and converts to coords, integers or string as appropriate"""
-            text_split = comma_split_re.findall(text)
-            out = []
-            for text_part in text_split:
-                test = coord_handler(text_part)
-                if test[0] is None:
-                    try:
-                        test = int(text_part)
-                    except ValueError:
-                        test = text_part
-                out.append(test)
-            return out
-
-        def piece_handler(text):
-            """Converts string to a piece class"""
-            text = text.lower()
-            possible = {"straight": Straight, "st": Straight, "point": Point, "pt": Point, "curve": Curve, "cv": Curve,
-                        "crossover": Crossover, "xx": Crossover}
-            if text in possible:
-                return possible[text]
-            else:
-                return None
-
-        with open(filename) as f:
-            current_track = None
-            for line in f:
-                # Make empty line blank and tidy up
-                line = line.strip('\n').strip()
-                if not line or line.startswith('#'):
-                    # This is a blank line or comment
-                    continue
-                elif line.startswith("NEW::"):
-                    # A new track segment. Should not have coordinates or pieces on this line.
-                    if current_track is not None:
-                        raise TrackSyntaxError(line, "NEW:: defined without closure")
-                    else:
-                        current_track = track_name_re.findall(line)[0]
-                        direction_txt = re.findall(r"{}\s*\(([^(]*)\)".format(current_track), line)
-                        # if not direction_txt or direction_txt[0].lower() in ("none", "0"):
-                        #     direction = 0
-                        if direction_txt[0].lower() in ("clockwise", "1"):
-                            direction = 1
-                        elif direction_txt[0].lower() in ("anticlockwise", "-1"):
-                            direction = -1
-                        else:
-                            raise TrackSyntaxError(line, "Invalid direction: {}".format(direction_txt[0]))
-                        # Reset for new track
-                        last_coord = (None, None)
-                        piece = None
-                        label = ""
-                        arguments = []
-                        print(current_track, direction)
-                else:
-                    if current_track is None:
-                        raise TrackSyntaxError(line, "No track segment started")
-                    coord_and_pieces = space_split_re.findall(line)
-
-                    # If it is the start. For subsequent lines this is skipped
-                    if last_coord[0] is None:
-                        last_coord = coord_handler(coord_and_pieces[0])
-                        if last_coord[0] is None:
-                            raise TrackSyntaxError(line, "No starting coordinate given")
-                        coord_and_pieces = coord_and_pieces[1:]
-
-                    for text in coord_and_pieces:
-                        # Test if comment, then coord, argument, finally piece
-                        if text.startswith("#"):
-                            # Rest of the line is a comment
-                            break
-                        if text.startswith("("):
-                            next_coord = coord_handler(text)
-                            if next_coord[0] is None:
-                                raise TrackSyntaxError(line, "Invalid coordinate given", text)
-                            if piece is None:
-                                raise TrackSyntaxError(line, "No piece between coordinates", text)
-                            # All track pieces are start, end then optional further arguments
-                            # noinspection PyUnboundLocalVariable
-                            new_piece = piece(self.canvas, current_track, direction, last_coord,
-                                              next_coord, *arguments, label=label, click=not auto_group)
-                            out[current_track].append(new_piece)
-                            self.track_labels[label] = new_piece
-                            last_coord = next_coord
-                            piece = None
-                            label = ""
-                            arguments = []
-                        elif text.startswith("["):
-                            arguments = argument_handler(text)
-                        elif text == "::END":
-                            # End of the branch
-                            if piece is not None:
-                                raise TrackSyntaxError(line, "::END called before final coordinates", text)
-                            else:
-                                current_track = None
-                        elif text == "::CLOSE":
-                            # Close a track loop
-                            if piece is None:
-                                raise TrackSyntaxError(line, "::CLOSE called without piece", text)
-                            else:
-                                end_coord = out[current_track][0].start
-                                # noinspection PyUnboundLocalVariable
-                                out[current_track].append(piece(self.canvas, current_track, direction, last_coord,
-                                                                end_coord, *arguments, label=label,
-                                                                click=not auto_group))
-                                current_track = None
-                        elif text.startswith("\""):
-                            label = text.strip("\"")
-                            if label in self.track_labels:
-                                raise TrackSyntaxError(line, "Repeated Label", label)
-                        else:
-                            piece = piece_handler(text)
+        kinds = {kind.__name__: kind for kind in (Straight, Curve, Point, Crossover)}
+        for name, direction, pieces in branches:
+            for kind, start, end, arguments, label in pieces:
+                piece = kinds[kind](None, name, direction, start, end, *arguments, label=label, click=not auto_group)
+                out[name].append(piece)
+                self.track_labels[label] = piece
         return out
 
     def auto_point_group(self):
-        """Groups points and crossovers that join at at least 1 alt coordinate."""
+        """Groups points and crossovers that join at at least 1 alt coordinate. Pieces are joined in a disjoint set
+        forest (union by size with path halving), so groups that meet are merged however the ladders and crossovers
+        are laid out, and each TrackGroup is made once at the end with its pieces in the order they were found."""
+        parent = {}
+        size = {}
+
+        def find(piece):
+            while parent[piece] is not piece:
+                parent[piece] = parent[parent[piece]]
+                piece = parent[piece]
+            return piece
+
         for coord, pieces in self.coordinate_dict.items():
             if ((isinstance(pieces[0], Point) or isinstance(pieces[0], Crossover)) and
                     (isinstance(pieces[1], Point) or isinstance(pieces[1], Crossover)) and not
                     (coord in (pieces[0].start, pieces[0].end) and coord in (pieces[1].start, pieces[1].end))):
-                if pieces[0].groups and pieces[1].groups:
-                    # TODO: join groups together for more complex layout options.
-                    print(pieces, coord)
-                    raise Exception("Autogrouping error: both already in groups")
-                elif pieces[0].groups:
-                    pieces[0].groups[0].append(pieces[1])
-                elif pieces[1].groups:
-                    pieces[1].groups[0].append(pieces[0])
-                else:
-                    self.groups.append(TrackGroup(pieces))
-                    # print(self.point_groups)
+                for piece in pieces[:2]:
+                    if piece not in parent:
+                        parent[piece] = piece
+                        size[piece] = 1
+                first, second = find(pieces[0]), find(pieces[1])
+                if first is second:
+                    continue
+                if size[first] < size[second]:
+                    first, second = second, first
+                parent[second] = first
+                size[first] += size[second]
+        members = defaultdict(list)
+        for piece in parent:
+            members[find(piece)].append(piece)
+        for pieces in members.values():
+            self.groups.append(TrackGroup(pieces))
+
+    def points_changed(self, group):
+        for listener in self.point_listeners:
+            listener(group)
+
+    def layout_changed(self):
+        """Call after changing pieces or groups so that cached routes are recalculated"""
+        self.layout_version += 1
+
+    def index_items(self, item):
+        """Adds the canvas items of a piece or signal to the index used by the *_by_id lookups"""
+        image_ids = (item.image_id,) if isinstance(item, Signal) else item.image_ids
+        for image_id in image_ids:
+            if image_id is not None:
+                self.canvas_items[image_id] = item
+
+    def closest_piece(self, pos) -> Track:
+        """Returns the piece with a straight line between two of its coordinates closest to pos, for placing things
+        without a canvas"""
+        def distance(start, end):
+            dx, dy = end[0] - start[0], end[1] - start[1]
+            length = dx ** 2 + dy ** 2
+            t = 0 if not length else max(0, min(1, ((pos[0] - start[0]) * dx + (pos[1] - start[1]) * dy) / length))
+            return (pos[0] - start[0] - t * dx) ** 2 + (pos[1] - start[1] - t * dy) ** 2
+
+        return min(self.track_pieces, key=lambda piece: min(distance(piece.start, coord)
+                                                            for coord in piece.coordinates[1:]))
+
+    def item_by_id(self, image_id):
+        """Returns the piece or signal drawn with a canvas item, or None"""
+        return self.canvas_items.get(image_id)
 
     def piece_by_id(self, image_id) -> Track:
-        return next(x for x in self.track_pieces if image_id in x.image_ids)
+        item = self.canvas_items.get(image_id)
+        if not isinstance(item, Track):
+            raise KeyError(image_id)
+        return item
+
+    def group_by_id(self, image_id):
+        """Returns the group of the piece drawn with a canvas item, or None if there is no such piece or it is not
+        grouped"""
+        piece = self.canvas_items.get(image_id)
+        if not isinstance(piece, Track):
+            return None
+        return piece.groups[0] if piece.groups else None
+
+    def signal_by_id(self, image_id) -> Signal:
+        item = self.canvas_items.get(image_id)
+        if not isinstance(item, Signal):
+            raise KeyError(image_id)
+        return item
 
     def iter_from(self, coord, direction) -> Track:
         """Follows the track from a starting coordinate in a given direction"""
-        segment_end = tuple(coord)
-        if segment_end not in self.coordinate_dict:
+        node = self.graph.node(tuple(coord))
+        if node == NONE:
             raise KeyError(coord)
-        else:
-            piece_list = self.coordinate_dict[segment_end]
-            if None in piece_list:
-                track_segment = next((x for x in piece_list if x is not None))
-            else:
-                if piece_list[0].direction == piece_list[1].direction:  # The common case
-                    if direction == piece_list[0].direction:
-                        track_segment = next((x for x in piece_list if x.start == segment_end))
-                    else:
-                        # TODO: Cope with alternates
-                        track_segment = next((x for x in piece_list if x.end == segment_end))
+        yield from self.traverse(self.graph.start_piece(node, direction), node)
+
+    def start_piece(self, coord, direction) -> Track:
+        """Returns the piece a train at coord travelling in direction is on"""
+        node = self.graph.node(tuple(coord))
+        if node == NONE:
+            raise KeyError(coord)
+        return self.graph.pieces[self.graph.start_piece(node, direction)]
+
+    def walk(self, track_segment, entry) -> Track:
+        """Follows the track from a piece entered at the entry coordinate, until the line ends or points are set
+        against. For a loop this never finishes."""
+        yield from self.traverse(self.graph.piece_ids[track_segment], self.graph.node(tuple(entry)))
+
+    def traverse(self, piece_id, node) -> Track:
+        """Yields the pieces of a cached Traversal, going round the loop forever if there is one"""
+        traversal = self.traversal(piece_id, node)
+        yield from traversal.pieces
+        if traversal.loop is not None:
+            loop = traversal.pieces[traversal.loop:]
+            while True:
+                yield from loop
+
+    def traversal(self, piece_id, node):
+        """Returns the Traversal from piece_id entered at node. Walks are cached by where they start and the state of
+        the points they pass through, and are reused until one of those points is switched."""
+        if self._traversal_version != self.layout_version:
+            self._traversals.clear()
+            self._traversal_version = self.layout_version
+        variants = self._traversals.setdefault((piece_id, node), [])
+        for traversal in variants:
+            if all(point.set == state for point, state in traversal.points):
+                return traversal
+        traversal = self.walk_graph(piece_id, node)
+        variants.insert(0, traversal)
+        del variants[self.traversal_variants:]
+        return traversal
+
+    def walk_graph(self, piece_id, node):
+        """Walks the graph from piece_id entered at node until the line ends or the walk repeats itself"""
+        pieces = []
+        points = []
+        seen = {}
+        graph = self.graph
+        while piece_id != NONE and (piece_id, node) not in seen:
+            seen[(piece_id, node)] = len(pieces)
+            piece = graph.pieces[piece_id]
+            pieces.append(piece)
+            if graph.kinds[piece_id] != PLAIN:
+                points.append((piece, piece.set))
+            node = graph.exit(piece_id, node)
+            piece_id = graph.other_piece(node, piece_id)
+        loop = seen[(piece_id, node)] if piece_id != NONE else None
+        return Traversal(tuple(pieces), loop, tuple(points))
+
+    def signal_blocks(self, signal):
+        """Returns a Block for every way from signal to the next signal, branching at each point on both settings.
+        For a signal at the start of a piece the block includes that piece, for one at the end it starts after it.
+        Worked out once for each signal, until the layout changes."""
+        if self._blocks_version != self.layout_version:
+            self._blocks.clear()
+            self._blocks_version = self.layout_version
+        if not self._blocks:
+            self._blocks[None] = self.signal_holds()
+        if signal not in self._blocks:
+            self._blocks[signal] = self.trace_blocks(signal, *self._blocks[None])
+        return self._blocks[signal]
+
+    def signal_holds(self):
+        """Returns where trains are held by signals, as two dictionaries of {(piece, entry coordinate): signal}: on
+        entering the piece, and on reaching the end of the piece"""
+        before, after = {}, {}
+        if self.signal_manager is not None:
+            for signal in self.signal_manager.all.values():
+                piece = signal.track_segment
+                if signal.track_relative_position == "end":
+                    after[(piece, piece.start)] = signal
                 else:
-                    raise NotImplementedError
-        while track_segment is not None:
-            yield track_segment
-            segment_end = track_segment.next(segment_end)
-            if segment_end is not None:
-                track_segment = next((x for x in self.coordinate_dict[segment_end] if x is not track_segment))
-            else:
-                track_segment = None
+                    before[(piece, getattr(piece, signal.track_relative_position))] = signal
+        return before, after
+
+    def trace_blocks(self, signal, holds_before, holds_after):
+        """Depth first search from a signal, restoring the points afterwards"""
+        start = signal.track_segment
+        skip_first = signal.track_relative_position == "end"
+        entry = start.start if skip_first else getattr(start, signal.track_relative_position)
+        out = []
+        points = [piece for piece in self.track_pieces if isinstance(piece, Point)]
+        saved = [piece.set for piece in points]
+        try:
+            stack = [(start, entry, (), {}, True)]
+            while stack:
+                piece, entry, pieces, settings, first = stack.pop()
+                branched = False
+                while piece is not None and piece not in pieces:
+                    if not first and (piece, entry) in holds_before:
+                        break
+                    if isinstance(piece, Point):
+                        lever = lever_of(piece)
+                        if lever not in settings:
+                            for state in (1, 0):
+                                stack.append((piece, entry, pieces, {**settings, lever: state}, first))
+                            branched = True
+                            break
+                        set_lever(lever, settings[lever])
+                    if not (first and skip_first):
+                        pieces += (piece,)
+                    if not first and (piece, entry) in holds_after:
+                        break
+                    exit_coord = piece.next(entry)
+                    piece, entry, first = self.other_piece(exit_coord, piece), exit_coord, False
+                if not branched:
+                    out.append(Block(pieces, settings))
+        finally:
+            for piece, state in zip(points, saved):
+                piece.set = state
+        return out
+
+    def other_piece(self, coord, piece):
+        """Returns the piece that joins piece at coord, or None if nothing does"""
+        piece_id = self.graph.other_piece(self.graph.node(coord), self.graph.piece_ids[piece])
+        return self.graph.pieces[piece_id] if piece_id != NONE else None
 
     def __iter__(self) -> Track:
         for piece in self.track_pieces:
@@ -235,23 +337,47 @@ class TrackGroup:
         self.invert = set()
         self.signal_manager = None
         self.serial_manager = None
+        self.track_manager = None
+        # Occupancy mask of the pieces, worked out when first needed
+        self._mask = None
         for item in self.all:
             item.groups.append(self)
-            self.canvases.add(item.canvas)
             self.labels.append(item.label)
             if item.set:
                 self.invert.add(item)
-            for image_id in item.image_ids:
-                self.image_ids.append(image_id)
-                item.canvas.itemconfig(image_id, tag=str(self))
-                item.canvas.tag_bind(image_id, "<Button-1>", self.on_click)
-                item.canvas.tag_bind(image_id, "<Enter>", self.hover, "+")
-                item.canvas.tag_bind(image_id, "<Leave>", self.hover, "+")
+            self.bind_piece(item)
+
+    def occupied(self) -> bool:
+        """Returns True if a train is on any piece in the group"""
+        if self.track_manager is None:
+            return any(x.train_in for x in self.all)
+        if self._mask is None:
+            self._mask = self.track_manager.occupancy.mask(self.all)
+        return not self.track_manager.occupancy.is_clear(self._mask)
+
+    def bind(self):
+        """Binds canvas events for all pieces, for when the pieces are drawn after the group is made"""
+        for item in self.all:
+            self.bind_piece(item)
+
+    def bind_piece(self, item):
+        """Binds canvas events of a piece to the group. Does nothing for a piece that is not drawn."""
+        if item.canvas is None:
+            return
+        self.canvases.add(item.canvas)  # Adding to set if not in it
+        for image_id in item.image_ids:
+            if image_id in self.image_ids:
+                continue
+            self.image_ids.append(image_id)
+            item.canvas.itemconfig(image_id, tag=str(self))
+            item.canvas.tag_bind(image_id, "<Button-1>", self.on_click)
+            item.canvas.tag_bind(image_id, "<Enter>", self.hover, "+")
+            item.canvas.tag_bind(image_id, "<Leave>", self.hover, "+")
 
     def on_click(self, event=None):
         """Calls all pieces on_click method, forces signals to check if they should be red and outputs serial"""
         # Don't change if train in section
-        if any((x.train_in for x in self.all)):
+        if self.occupied():
             print("Train in section")
         else:
             for item in self.all:
@@ -263,18 +389,32 @@ class TrackGroup:
             if self.serial_manager is not None:
                 for item in self.points:
                     self.serial_manager.write_point(item)
+            if self.track_manager is not None:
+                self.track_manager.points_changed(self)
 
-    def set(self, state):
+    def set(self, state, check_signals=True):
+        """Sets all pieces to state (inverted for pieces initially set). If check_signals is False the caller is
+        responsible for checking the interlocking, e.g. with SignalManager.interlock_all after many changes."""
         for item in self.all:
             if item in self.invert:
                 item.set = not state
             else:
                 item.set = state
             item.draw()
-        if self.signal_manager is not None:
+        if check_signals and self.signal_manager is not None:
             for label in self.labels:
                 for signal in self.signal_manager.track_label_interlock[label]:
                     signal.interlock_red()
+        if self.track_manager is not None:
+            self.track_manager.points_changed(self)
+
+    def switch(self, state, check_signals=True):
+        """Sets all pieces to state as set does, then writes the points to serial as on_click does. For points moved
+        by the program, e.g. when setting a route, where set is for following the hardware."""
+        self.set(state, check_signals)
+        if self.serial_manager is not None:
+            for item in self.points:
+                self.serial_manager.write_point(item)
 
     def hover(self, event):
         for item in self.all:
@@ -283,6 +423,7 @@ class TrackGroup:
     def append(self, other):
         """Add a new track piece to the group"""
         self.all.append(other)
+        self._mask = None
         if isinstance(other, Point):
             self.points.append(other)
         elif isinstance(other, Crossover):
@@ -290,13 +431,10 @@ class TrackGroup:
         else:
             self.other.append(other)
         other.groups.append(self)
-        self.canvases.add(other.canvas)  # Adding to set if not in it
-        for image_id in other.image_ids:
-            self.image_ids.append(image_id)
-            other.canvas.itemconfig(image_id, tag=str(self))
-            other.canvas.tag_bind(image_id, "<Button-1>", self.on_click)
-            other.canvas.tag_bind(image_id, "<Enter>", self.hover, "+")
-            other.canvas.tag_bind(image_id, "<Leave>", self.hover, "+")
+        self.bind_piece(other)
+        if self.track_manager is not None:
+            self.track_manager.index_items(other)
+            self.track_manager.layout_changed()
 
     def __iter__(self):
         for piece in self.all:
@@ -306,85 +444,173 @@ class TrackGroup:
         return "TrackGroup({})".format(self.all)
 
 
+def lever_of(piece):
+    """Returns what switches a point: its group, or the point itself if it is not grouped"""
+    return piece.groups[0] if piece.groups else piece
+
+
+def lever_state(lever):
+    """Returns the state a lever is set to, as passed to TrackGroup.set"""
+    if isinstance(lever, TrackGroup):
+        piece = lever.all[0]
+        return int(bool(piece.set) != (piece in lever.invert))
+    return int(bool(lever.set))
+
+
+def set_lever(lever, state):
+    """Sets the pieces switched by a lever like TrackGroup.set, without drawing or checking signals"""
+    if isinstance(lever, TrackGroup):
+        for item in lever.all:
+            item.set = (not state) if item in lever.invert else state
+    else:
+        lever.set = state
+
+
 class SignalManager:
-    def __init__(self, track_manager, canvas, filename):
+    def __init__(self, track_manager, canvas, filename, cache=False):
         self.track_manager = track_manager
         track_manager.signal_manager = self
         for group in track_manager.groups:
             group.signal_manager = self
-        self.canvas = canvas
+        self.canvas = None
         self.all = {}
         self.track_label_interlock = defaultdict(list)
-        self.load(filename)
+        self.load(filename, cache)
         print(self.track_label_interlock)
-
-    def load(self, filename):
-        signals_define = False
-        # Line of the form "SignalLabel":: Pos["Label" Start/End/Alternate/tart/end Left/Right] Red["Label" 0/1 &/|]
-        signal_definition_re = re.compile(r"\s*".join(
-            (r'"(?P<signal_label>[^"]+)"::', 'Pos', r'\[', r'"(?P<pos_label>[^"]+)"',
-             r'(?P<start>(Start)|(End)|(Alt((ernate)|(start)|(end))?))?', r'(?P<position>(Left)|(Right))?', r'\]',
-             r'(Red', r'\[', r'(?P<red_condition>(\(*\s*"[^"]+"\s+[0-1]\s*\)*\s*(&|\|)?\s*)*)',
-             r'\])?')))
-        label_re = re.compile(r'"[^"]*"')
-        with open(filename) as f:
-            for line in f:
-                line = line.strip("\n").strip()
-                if not line or line.startswith("#"):
-                    continue
-                elif line.startswith("SIGNALS::"):
-                    signals_define = True
-                elif line.startswith("::END"):
-                    signals_define = False
-                elif signals_define:
-                    m = signal_definition_re.fullmatch(line)
-                    if m is None:
-                        raise AccessorySyntaxError(line, "Signal definition not of correct form")
-                    groupdict = m.groupdict()
-                    if groupdict["position"] is None:
-                        groupdict["position"] = "Left"
-                    if groupdict["start"] is None:
-                        groupdict["start"] = "Start"
-                    elif groupdict["start"] == "Alt":
-                        groupdict["start"] = "Alternate"
-                    track_segment = self.track_manager.track_labels[groupdict["pos_label"]]
-                    track_pos = getattr(track_segment, groupdict["start"].lower())
-                    if groupdict["start"] == "Start":
-                        track_dir = (track_segment.end[0] - track_pos[0], track_segment.end[1] - track_pos[1])
-                    elif groupdict["start"] == "Alternate" and isinstance(track_segment, Point) \
-                            and not track_segment.facing:
-                        track_dir = (track_pos[0] - track_segment.end[0], track_pos[1] - track_segment.end[1])
-                    else:
-                        track_dir = (track_pos[0] - track_segment.start[0], track_pos[1] - track_segment.start[1])
-                    # Normalise vector
-                    track_dir_size = (track_dir[0] ** 2 + track_dir[1] ** 2) ** 0.5
-                    track_dir = (track_dir[0] / track_dir_size, track_dir[1] / track_dir_size)
-                    if groupdict["position"] == "Right":
-                        # Get normal vector by (x,y) => (-y, x)
-                        light_pos = (track_pos[0] - 10 * track_dir[1], track_pos[1] + 10 * track_dir[0])
-                    else:
-                        light_pos = (track_pos[0] + 10 * track_dir[1], track_pos[1] - 10 * track_dir[0])
-                    red_condition = groupdict["red_condition"]
-                    red_condition = red_condition.replace("&", "and").replace("|", "or")
-                    for label in set(label_re.findall(red_condition)):
-                        red_condition = red_condition.replace(label,
-                                                              "self.track_manager.track_labels[{}]".format(label))
-                    red_condition = re.sub(r'("[^"]*"\])\s*([0-1])', r'\1.set == \2', red_condition)
-                    if red_condition:
-                        # Check it is valid statement
-                        eval(red_condition)
-                    direction = track_segment.direction
-                    signal = Signal(self.canvas, direction, light_pos, groupdict["start"].lower(),
-                                    self.track_manager, red_condition, groupdict["signal_label"])
-                    self.all[groupdict["signal_label"]] = signal
-                    for label in set(label_re.findall(red_condition)):
-                        self.track_label_interlock[label.strip("\"")].append(signal)
-
-
-class TrackSyntaxError(Exception):
-    def __init__(self, line, string, text=""):
-        super().__init__(string, line, text)
-
-
-class AccessorySyntaxError(Exception):
-    pass
+        # Replace compiled conditions with lookups into precomputed truth tables
+        self.interlocking = InterlockingTable(track_manager, self.all.values())
+        for signal in self.all.values():
+            if signal.condition is not None:
+                signal.red_conditions = self.interlocking.predicate(signal)
+        # Automatic signal: [(block name, settings)] for each way ahead of it
+        self.automatic_blocks = {}
+        # Lever: automatic signals whose block depends on it
+        self.lever_signals = defaultdict(list)
+        self.setup_automatic()
+        if canvas is not None:
+            self.attach(canvas)
+
+    def attach(self, canvas):
+        """Draws all signals on a canvas"""
+        self.canvas = canvas
+        for signal in self.all.values():
+            if signal.canvas is not canvas:
+                signal.attach(canvas)
+            self.track_manager.index_items(signal)
+
+    def setup_automatic(self):
+        """Registers the blocks ahead of automatic signals with the OccupancyManager. A signal is only updated when one
+        of its blocks becomes occupied or clear, or the points its blocks or red condition depend on are switched."""
+        occupancy = self.track_manager.occupancy
+        for signal in self.all.values():
+            if not signal.automatic:
+                continue
+            self.automatic_blocks[signal] = []
+            for i, block in enumerate(self.track_manager.signal_blocks(signal)):
+                # A train held at a start signal is on the signal's piece, so the block is the pieces beyond it
+                pieces = [piece for piece in block.pieces if piece is not signal.track_segment]
+                name = (signal.label, i)
+                occupancy.add_block(name, pieces)
+                occupancy.block_listeners[name].append(lambda name, occupied, signal=signal: self.update_automatic(
+                    signal))
+                self.automatic_blocks[signal].append((name, block.settings))
+                for lever in block.settings:
+                    if signal not in self.lever_signals[lever]:
+                        self.lever_signals[lever].append(signal)
+            for label in sorted(condition_labels(signal.condition)):
+                if label in self.track_manager.track_labels:
+                    lever = lever_of(self.track_manager.track_labels[label])
+                    if signal not in self.lever_signals[lever]:
+                        self.lever_signals[lever].append(signal)
+            self.update_automatic(signal)
+        if self.lever_signals:
+            self.track_manager.point_listeners.append(self.points_changed)
+
+    def points_changed(self, lever):
+        for signal in self.lever_signals.get(lever, ()):
+            self.update_automatic(signal)
+
+    def current_block(self, signal):
+        """Returns the name of the block ahead of an automatic signal for the way the points are set, or None"""
+        for name, settings in self.automatic_blocks.get(signal, ()):
+            if all(lever_state(lever) == state for lever, state in settings.items()):
+                return name
+        return None
+
+    def block_occupant(self, signal):
+        """Returns a train in the block ahead of an automatic signal, or None"""
+        name = self.current_block(signal)
+        return self.track_manager.occupancy.block_occupant(name) if name is not None else None
+
+    def update_automatic(self, signal):
+        """Sets an automatic signal green if the block ahead for the way the points are set is clear and it is not
+        interlocked, otherwise red"""
+        name = self.current_block(signal)
+        clear = name is not None and not self.track_manager.occupancy.block_occupied(name)
+        if clear:
+            clear = signal.red_conditions is None or not signal.red_conditions()
+        if bool(signal.set) != clear:
+            signal.set = clear
+            signal.changed()
+
+    def interlock_all(self, word=None):
+        """Forces every green signal that the points (or state word) interlock to red, in one pass"""
+        for signal in self.interlocking.red_signals(word):
+            if signal.set:
+                signal.interlock_red()
+
+    def load(self, filename, cache=False):
+        """Loads signals from an .accessory file, or its cache if the file is unchanged"""
+        layout_cache = LayoutCache(filename, cache)
+        definitions = layout_cache.get("signals")
+        if definitions is None:
+            definitions = list(parse_accessory(layout_cache.lines()))
+            layout_cache.set("signals", definitions)
+            layout_cache.save()
+        for definition in definitions:
+            start = definition.end
+            track_segment = self.track_manager.track_labels[definition.track_label]
+            track_pos = getattr(track_segment, start.lower())
+            if start == "Start":
+                track_dir = (track_segment.end[0] - track_pos[0], track_segment.end[1] - track_pos[1])
+            elif start == "Alternate" and isinstance(track_segment, Point) and not track_segment.facing:
+                track_dir = (track_pos[0] - track_segment.end[0], track_pos[1] - track_segment.end[1])
+            else:
+                track_dir = (track_pos[0] - track_segment.start[0], track_pos[1] - track_segment.start[1])
+            # Normalise vector
+            track_dir_size = (track_dir[0] ** 2 + track_dir[1] ** 2) ** 0.5
+            track_dir = (track_dir[0] / track_dir_size, track_dir[1] / track_dir_size)
+            if definition.side == "Right":
+                # Get normal vector by (x,y) => (-y, x)
+                light_pos = (track_pos[0] - 10 * track_dir[1], track_pos[1] + 10 * track_dir[0])
+            else:
+                light_pos = (track_pos[0] + 10 * track_dir[1], track_pos[1] - 10 * track_dir[0])
+            condition = definition.condition
+            try:
+                red_condition = compile_condition(condition, self.track_manager.track_labels) \
+                    if condition is not None else None
+            except KeyError as e:
+                raise AccessorySyntaxError(definition.line, "Unknown track label {} in red condition".format(*e.args),
+                                           definition.line_number)
+            direction = track_segment.direction
+            signal = Signal(None, direction, light_pos, start.lower(), self.track_manager, red_condition,
+                            definition.label, condition, track_segment, definition.automatic)
+            self.all[definition.label] = signal
+            for label in condition_labels(condition):
+                self.track_label_interlock[label].append(signal)
+
+
+def parse_track(lines):
+    """Parses the lines of a .track file. Returns a list of (branch name, direction, pieces) where each piece is
+    (class name, start, end, arguments, label), plain values that can be cached. Raises the first TrackSyntaxError,
+    with all of them in its errors attribute."""
+    parser = TrackParser()
+    out = []
+    for record in parser.parse(lines):
+        if not out or out[-1][0] != record.branch or out[-1][1] != record.direction:
+            out.append((record.branch, record.direction, []))
+        out[-1][2].append((record.kind, record.start, record.end, record.arguments, record.label))
+    if parser.errors:
+        parser.errors[0].errors = parser.errors
+        raise parser.errors[0]
+    return out
@@ -1,7 +1,49 @@
 """Contains model classes"""
+from bisect import bisect_right
 from collections import namedtuple
-
-from CreateToolTip import create_tool_tip
+from itertools import accumulate
+
+
+class Path:
+    """A polyline from one end of a track piece to the other, with the cumulative length at each vertex, so the
+    position a distance along it is found by a binary search rather than by stepping along it."""
+
+    def __init__(self, points):
+        self.points = [tuple(point) for point in points]
+        self.lengths = [0.0] + list(accumulate(((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5
+                                               for (x0, y0), (x1, y1) in zip(self.points, self.points[1:])))
+        self.length = self.lengths[-1]
+
+    def index(self, distance) -> int:
+        """Returns the index of the vertex ending the line that distance is along, from 1 to len(points) - 1"""
+        return min(max(bisect_right(self.lengths, distance), 1), len(self.points) - 1)
+
+    def at(self, distance):
+        """Returns the (x, y) coordinates distance along the path, clamped to its ends"""
+        if distance <= 0:
+            return self.points[0]
+        if distance >= self.length:
+            return self.points[-1]
+        i = self.index(distance)
+        (x0, y0), (x1, y1) = self.points[i - 1], self.points[i]
+        fraction = (distance - self.lengths[i - 1]) / (self.lengths[i] - self.lengths[i - 1])
+        return x0 + (x1 - x0) * fraction, y0 + (y1 - y0) * fraction
+
+    def locate(self, pos) -> float:
+        """Returns the distance along the path of the closest point on it to pos"""
+        best = None
+        for i in range(1, len(self.points)):
+            (x0, y0), (x1, y1) = self.points[i - 1], self.points[i]
+            dx, dy = x1 - x0, y1 - y0
+            span = dx ** 2 + dy ** 2
+            fraction = min(max(((pos[0] - x0) * dx + (pos[1] - y0) * dy) / span, 0), 1) if span else 0
+            gap = (x0 + dx * fraction - pos[0]) ** 2 + (y0 + dy * fraction - pos[1]) ** 2
+            if best is None or gap < best[0]:
+                best = (gap, self.lengths[i - 1] + (self.lengths[i] - self.lengths[i - 1]) * fraction)
+        return best[1]
+
+    def __len__(self):
+        return len(self.points)
 
 
 class Track(object):
@@ -16,16 +58,46 @@ class Track(object):
         self.branch = branch
         self.start = start
         self.end = end
-        self.canvas = canvas
         self.direction = direction
         self.groups = groups if groups is not None else []
         self.label = label
-        self.train_in = False
+        self.click = click
+        # Set when the piece is added to a layout's OccupancyManager
+        self.occupancy = None
+        self.piece_id = None
+        self._train_in = False
+        self.canvas = None
+        self.image_ids = ()
+        self._paths = {}
+        if canvas is not None:
+            self.attach(canvas)
+
+    def attach(self, canvas):
+        """Draws the piece on a canvas. Without a canvas the piece is a pure model and can be used headless."""
+        # Imported here so the model can be used where tkinter is not available
+        from CreateToolTip import create_tool_tip
+        self.canvas = canvas
         self.image_ids = self.create()
         for image_id in self.image_ids:
             create_tool_tip(self.canvas, image_id, str(self))
             self.canvas.itemconfig(image_id, tag="Track")
 
+    @property
+    def train_in(self):
+        """The train on the piece, or False. Kept by the OccupancyManager when there is one."""
+        if self.occupancy is None:
+            return self._train_in
+        return self.occupancy.occupant(self) or False
+
+    @train_in.setter
+    def train_in(self, train):
+        if self.occupancy is None:
+            self._train_in = train
+        elif train:
+            self.occupancy.occupy(self, train)
+        else:
+            self.occupancy.release(self)
+
     @property
     def coordinates(self):
         """Returns all the coordinates of endpoints"""
@@ -35,6 +107,17 @@ class Track(object):
         """Called when TrackManager iterates through by from entry coordinates"""
         return self.start if tuple(entry) == self.end else self.end
 
+    def path(self, entry, exit_coord) -> Path:
+        """Returns the Path from entry to exit_coord, worked out once for each pair"""
+        key = (tuple(entry), tuple(exit_coord))
+        if key not in self._paths:
+            self._paths[key] = Path(self.polyline(*key))
+        return self._paths[key]
+
+    def polyline(self, entry, exit_coord):
+        """Returns the points the piece is drawn through from entry to exit_coord"""
+        return [entry, exit_coord]
+
     def create(self):
         """Create and Return an iterable of ids of line segments that make up the image on the canvas"""
         raise NotImplementedError
@@ -82,15 +165,33 @@ class Curve(Track):
             raise Exception("Curve not defined as L or R")
         super().__init__(canvas, branch, direction, start, end, label=label, click=click)
 
-    def create(self):
+    # Lines tkinter draws a smoothed curve with (its default splinesteps)
+    spline_steps = 12
+
+    @property
+    def curvepoint(self):
+        """The control point of the curve, off the midpoint of the chord"""
         tangent = (self.start[1] - self.end[1], self.end[0] - self.start[0])
         midpoint = ((self.start[0] + self.end[0])/2, (self.start[1] + self.end[1])/2)
         if self.left_right == "R":
-            curvepoint = (midpoint[0] - self.factor * tangent[0], midpoint[1] - self.factor * tangent[1])
+            return midpoint[0] - self.factor * tangent[0], midpoint[1] - self.factor * tangent[1]
         else:
-            curvepoint = (midpoint[0] + self.factor * tangent[0], midpoint[1] + self.factor * tangent[1])
+            return midpoint[0] + self.factor * tangent[0], midpoint[1] + self.factor * tangent[1]
+
+    def create(self):
         ids = namedtuple("image_ids", ["main"])
-        return ids(self.canvas.create_line(self.start, curvepoint, self.end, smooth=True))
+        return ids(self.canvas.create_line(self.start, self.curvepoint, self.end, smooth=True))
+
+    def polyline(self, entry, exit_coord):
+        """Samples the quadratic Bezier curve tkinter draws for three points with smooth=True"""
+        (x0, y0), (x1, y1), (x2, y2) = entry, self.curvepoint, exit_coord
+        points = [entry]
+        for step in range(1, self.spline_steps):
+            t = step / self.spline_steps
+            a, b, c = (1 - t) ** 2, 2 * t * (1 - t), t ** 2
+            points.append((a * x0 + b * x1 + c * x2, a * y0 + b * y1 + c * y2))
+        points.append(exit_coord)
+        return points
 
 
 class Point(Track):
@@ -99,9 +200,12 @@ class Point(Track):
         self.facing = facing
         self.set = set
         super().__init__(canvas, branch, direction, start, end, label=label, click=click)
+
+    def attach(self, canvas):
+        super().attach(canvas)
         # For if initially set
         self.draw()
-        if click:
+        if self.click:
             for imageID in self.image_ids:
                 self.canvas.tag_bind(imageID, '<Button-1>', self.on_click)
                 self.canvas.tag_bind(imageID, "<Enter>", self.hover, "+")
@@ -139,6 +243,8 @@ class Point(Track):
         return ids(main_id, alt_id)
 
     def draw(self):
+        if self.canvas is None:
+            return
         if self.set:
             self.canvas.itemconfig(self.image_ids[0], dash=[1], fill="Red")
             self.canvas.itemconfig(self.image_ids[1], dash=[], fill="Black")
@@ -212,17 +318,37 @@ class Crossover(Point):
 
 
 class Signal:
-    def __init__(self, canvas, direction, position, track_relative_pos, track_manager, red_conditions, label):
-        self.canvas = canvas
+    """A signal at the track_relative_pos ("start", "end" or "alternate") of a track piece.
+    red_conditions is a compiled function returning True when the track forces the signal to be red, or None. condition
+    is the tree it was compiled from and track_segment the piece the signal is positioned on. An automatic signal is
+    set by the SignalManager from the occupancy of the block ahead of it."""
+
+    def __init__(self, canvas, direction, position, track_relative_pos, track_manager, red_conditions, label,
+                 condition=None, track_segment=None, automatic=False):
         self.direction = direction
         self.position = position
         self.track_relative_position = track_relative_pos
         self.track_manager = track_manager
-        self.image_id = self.create()
         self.set = False
         self.red_conditions = red_conditions
+        self.condition = condition
+        self.track_segment = track_segment
         self.label = label
+        self.automatic = automatic
         self.interlock_print_flag = True
+        # Called with the signal whenever it changes
+        self.listeners = []
+        self.canvas = None
+        self.image_id = None
+        if canvas is not None:
+            self.attach(canvas)
+
+    def attach(self, canvas):
+        """Draws the signal on a canvas. Without a canvas the signal is a pure model and can be used headless."""
+        from CreateToolTip import create_tool_tip
+        self.canvas = canvas
+        self.image_id = self.create()
+        self.draw()
         self.canvas.tag_bind(self.image_id, "<Button-1>", self.on_click)
         create_tool_tip(self.canvas, self.image_id, str(self))
 
@@ -233,15 +359,16 @@ class Signal:
 
     def interlock_red(self):
         """Checks if track forces the signal to be red"""
-        if self.red_conditions and eval(self.red_conditions):
+        if self.red_conditions is not None and self.red_conditions():
             if self.interlock_print_flag:
                 print("Interlocked:", self)
                 self.interlock_print_flag = False
             self.set = 0
-            self.draw()
-            # Flash
-            self.canvas.itemconfig(self.image_id, width=4)
-            self.canvas.after(100, lambda: self.canvas.itemconfig(self.image_id, width=0))
+            self.changed()
+            if self.canvas is not None:
+                # Flash
+                self.canvas.itemconfig(self.image_id, width=4)
+                self.canvas.after(100, lambda: self.canvas.itemconfig(self.image_id, width=0))
             return False
         self.interlock_print_flag = True
         return True
@@ -253,9 +380,17 @@ class Signal:
             self.set = 0
         else:
             self.set = self.interlock_red()
+        self.changed()
+
+    def changed(self):
+        """Redraws and tells listeners the signal may have changed"""
         self.draw()
+        for listener in self.listeners:
+            listener(self)
 
     def draw(self):
+        if self.canvas is None:
+            return
         if self.set:
             self.canvas.itemconfig(self.image_id, fill="Green", outline="Green")
         else:
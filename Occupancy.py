@@ -0,0 +1,119 @@
+"""Track circuits: which train is on each piece of track, kept as a bitmap over the pieces of a LayoutGraph"""
+from collections import defaultdict
+
+
+class OccupancyManager:
+    """Holds the occupancy of every piece as one int, bit n set when piece n of the graph is occupied, with the
+    occupying train of each piece in a list. A set of pieces is clear if its mask ANDed with the bitmap is 0, so
+    checking a route or a group of points is one operation however long it is.
+    Blocks are named sets of pieces with a count of how many are occupied, kept up to date as pieces change.
+    Listeners are only called when occupancy actually changes: with (piece, train) for a piece that has become
+    occupied by train or (piece, None) for one that has been released, and with (name, occupied) for a block."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.bits = 0
+        self.occupants = [None] * len(graph)
+        for piece_id, piece in enumerate(graph.pieces):
+            piece.occupancy = self
+            piece.piece_id = piece_id
+        self.blocks = {}
+        self.block_counts = {}
+        self._piece_blocks = defaultdict(list)
+        # Called for every change
+        self.listeners = []
+        # piece id: listeners for that piece
+        self.piece_listeners = defaultdict(list)
+        # block name: listeners for that block
+        self.block_listeners = defaultdict(list)
+
+    def mask(self, pieces) -> int:
+        """Returns the bit mask of pieces"""
+        out = 0
+        for piece in pieces:
+            out |= 1 << piece.piece_id
+        return out
+
+    def occupant(self, piece):
+        """Returns the train on piece, or None"""
+        return self.occupants[piece.piece_id]
+
+    def is_clear(self, mask, train=None) -> bool:
+        """Returns True if no train, other than train if given, is on the pieces in mask"""
+        occupied = self.bits & mask
+        if train is not None and occupied:
+            occupied &= ~self.mask_of(train)
+        return not occupied
+
+    def mask_of(self, train) -> int:
+        """Returns the mask of the pieces train is on"""
+        return self.mask(piece for piece in self.pieces_in(self.bits) if self.occupant(piece) is train)
+
+    def pieces_in(self, mask):
+        """Yields the pieces with a bit set in mask"""
+        while mask:
+            low = mask & -mask
+            yield self.graph.pieces[low.bit_length() - 1]
+            mask ^= low
+
+    def occupy(self, piece, train):
+        """Marks piece as occupied by train"""
+        piece_id = piece.piece_id
+        if self.occupants[piece_id] is train:
+            return
+        was_occupied = self.occupants[piece_id] is not None
+        self.occupants[piece_id] = train
+        self.bits |= 1 << piece_id
+        if not was_occupied:
+            self._count(piece_id, 1)
+        self._notify(piece, train)
+
+    def release(self, piece, train=None):
+        """Marks piece as clear, if it is occupied by train when train is given"""
+        piece_id = piece.piece_id
+        occupant = self.occupants[piece_id]
+        if occupant is None or (train is not None and occupant is not train):
+            return
+        self.occupants[piece_id] = None
+        self.bits &= ~(1 << piece_id)
+        self._count(piece_id, -1)
+        self._notify(piece, None)
+
+    def add_block(self, name, pieces):
+        """Adds or replaces a named block of pieces"""
+        if name in self.blocks:
+            for piece in self.pieces_in(self.blocks[name]):
+                self._piece_blocks[piece.piece_id].remove(name)
+        mask = self.mask(pieces)
+        self.blocks[name] = mask
+        self.block_counts[name] = bin(self.bits & mask).count("1")
+        for piece in self.pieces_in(mask):
+            self._piece_blocks[piece.piece_id].append(name)
+
+    def block_occupied(self, name) -> bool:
+        return self.block_counts[name] > 0
+
+    def block_occupant(self, name):
+        """Returns a train in the block, or None"""
+        occupied = self.bits & self.blocks[name]
+        if not occupied:
+            return None
+        return self.occupants[(occupied & -occupied).bit_length() - 1]
+
+    def subscribe(self, pieces, listener):
+        """Calls listener(piece, train) whenever the occupancy of one of pieces changes"""
+        for piece in pieces:
+            self.piece_listeners[piece.piece_id].append(listener)
+
+    def _count(self, piece_id, change):
+        for name in self._piece_blocks.get(piece_id, ()):
+            self.block_counts[name] += change
+            if self.block_counts[name] == (1 if change > 0 else 0):
+                for listener in self.block_listeners.get(name, ()):
+                    listener(name, change > 0)
+
+    def _notify(self, piece, train):
+        for listener in self.piece_listeners.get(piece.piece_id, ()):
+            listener(piece, train)
+        for listener in self.listeners:
+            listener(piece, train)
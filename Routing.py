@@ -0,0 +1,138 @@
+"""Finds and sets routes between labelled track pieces or signals"""
+from collections import namedtuple, deque
+
+from Managers import TrackGroup, lever_of
+from Models import Point
+
+# pieces from origin to destination inclusive, entered at the entry coordinate of the first piece, and settings the
+# state of each lever (a TrackGroup or an ungrouped point) needed to take the route.
+Route = namedtuple("Route", ["pieces", "entry", "settings"])
+
+
+class RouteManager:
+    """Finds routes by a breadth first search of the layout, trying both settings at each point. Routes are cached
+    until the layout changes (TrackManager.layout_version), not when points move, as a route is the same whatever the
+    points are currently set to."""
+
+    def __init__(self, track_manager):
+        self.track_manager = track_manager
+        track_manager.route_manager = self
+        self._cache = {}
+        # Occupancy masks of the cached routes
+        self._masks = {}
+        self._version = track_manager.layout_version
+
+    def starts(self, label):
+        """Returns the (piece, entry coordinate) pairs a route from label can begin with. A signal's route starts where
+        it holds trains, a track piece's from either end."""
+        signal_manager = self.track_manager.signal_manager
+        if signal_manager is not None and label in signal_manager.all:
+            signal = signal_manager.all[label]
+            piece = signal.track_segment
+            if signal.track_relative_position == "end":
+                return [(piece, piece.start)]
+            return [(piece, getattr(piece, signal.track_relative_position))]
+        piece = self.track_manager.track_labels[label]
+        return [(piece, piece.start), (piece, piece.end)]
+
+    def destination(self, label):
+        signal_manager = self.track_manager.signal_manager
+        if signal_manager is not None and label in signal_manager.all:
+            return signal_manager.all[label].track_segment
+        return self.track_manager.track_labels[label]
+
+    def route(self, origin, destination):
+        """Returns the shortest Route from the label origin to the label destination, or None if there is none"""
+        if self._version != self.track_manager.layout_version:
+            self._cache.clear()
+            self._masks.clear()
+            self._version = self.track_manager.layout_version
+        key = (origin, destination)
+        if key not in self._cache:
+            self._cache[key] = self.search(self.starts(origin), self.destination(destination))
+        return self._cache[key]
+
+    def search(self, starts, target):
+        """Breadth first search from (piece, entry) pairs to the target piece. Each state carries the lever settings
+        of the path to it, and a point is only passed with a setting that agrees with them. A piece reached again from
+        the same entry is only skipped if the settings are the same too, as a longer way to it may leave free a lever
+        the shorter way fixed against the rest of the route."""
+        queue = deque()
+        parents = {}
+        for piece, entry in starts:
+            state = (piece, entry, frozenset())
+            queue.append((state, {}))
+            parents[state] = None
+        while queue:
+            state, settings = queue.popleft()
+            piece, entry, _ = state
+            if piece is target:
+                pieces = [piece]
+                while parents[state] is not None:
+                    state = parents[state]
+                    pieces.append(state[0])
+                return Route(pieces[::-1], state[1], settings)
+            for exit_coord, next_settings in self.exits(piece, entry, settings):
+                next_piece = self.track_manager.other_piece(exit_coord, piece)
+                if next_piece is None:
+                    continue
+                next_state = (next_piece, exit_coord, frozenset(next_settings.items()))
+                if next_state in parents:
+                    continue
+                parents[next_state] = state
+                queue.append((next_state, next_settings))
+        return None
+
+    @staticmethod
+    def exits(piece, entry, settings):
+        """Returns a list of (exit coordinate, settings) for each way through piece from entry"""
+        if not isinstance(piece, Point):
+            return [(piece.next(entry), settings)]
+        out = []
+        lever = lever_of(piece)
+        inverted = isinstance(lever, TrackGroup) and piece in lever.invert
+        saved = piece.set
+        for piece_state in (0, 1):
+            lever_state = piece_state ^ inverted
+            if settings.get(lever, lever_state) != lever_state:
+                # The path here needs the lever set the other way
+                continue
+            piece.set = piece_state
+            exit_coord = piece.next(entry)
+            if exit_coord is not None:
+                out.append((exit_coord, settings if lever in settings else {**settings, lever: lever_state}))
+        piece.set = saved
+        return out
+
+    def route_clear(self, origin, destination, train=None) -> bool:
+        """Returns True if there is a route from origin to destination with no train on it, other than train"""
+        route = self.route(origin, destination)
+        if route is None:
+            return False
+        key = (origin, destination)
+        if key not in self._masks:
+            self._masks[key] = self.track_manager.occupancy.mask(route.pieces)
+        return self.track_manager.occupancy.is_clear(self._masks[key], train)
+
+    def set_route(self, origin, destination):
+        """Sets all the points for the route from origin to destination at once. Returns the Route, or None if there is
+        no route or a train is on any of the points to change."""
+        route = self.route(origin, destination)
+        if route is None:
+            return None
+        occupancy = self.track_manager.occupancy
+        for lever in route.settings:
+            pieces = lever.all if isinstance(lever, TrackGroup) else (lever,)
+            if not occupancy.is_clear(occupancy.mask(pieces)):
+                print("Train in section", lever)
+                return None
+        for lever, state in route.settings.items():
+            if isinstance(lever, TrackGroup):
+                lever.switch(state, check_signals=False)
+            else:
+                lever.set = state
+                lever.draw()
+                self.track_manager.points_changed(lever)
+        if self.track_manager.signal_manager is not None:
+            self.track_manager.signal_manager.interlock_all()
+        return route
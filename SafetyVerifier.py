@@ -0,0 +1,196 @@
+"""Verifies that the Red[...] conditions of signals stop conflicting routes, for every combination of point settings.
+Run with a .track and .accessory file to print any conflicts found."""
+from collections import namedtuple
+from itertools import combinations
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+
+from Managers import TrackManager, SignalManager, TrackGroup, lever_of, set_lever
+from Models import Point
+from Interlocking import condition_labels
+
+# pieces is the sequence of track pieces from the signal up to the next signal, settings the state of each lever
+# (a TrackGroup or an ungrouped point) that the route depends on.
+Route = namedtuple("Route", ["signal", "pieces", "settings"])
+# Two signals that can both be green with routes sharing track. pieces is every piece the routes can share while both
+# are green, and settings an example of point settings for which they are.
+Conflict = namedtuple("Conflict", ["signals", "pieces", "settings"])
+# Increment when the form of the cached results changes
+CACHE_VERSION = 2
+
+
+class SafetyVerifier:
+    """Traces the routes from every signal, branching at each point on both settings, and checks every pair of
+    signals for settings where both could be green while their routes share track.
+    Only the points a route passes through or a red condition depends on are enumerated, so the work grows with the
+    number of routes rather than with 2 ** (number of points)."""
+
+    def __init__(self, track_manager, signal_manager):
+        self.track_manager = track_manager
+        self.signal_manager = signal_manager
+        self.points = [piece for piece in track_manager if isinstance(piece, Point)]
+        self._routes = {}
+
+    def routes(self, signal):
+        """Returns every Route from signal to the next signal, the end of the line or points set against"""
+        if signal not in self._routes:
+            self._routes[signal] = [Route(signal, block.pieces, block.settings)
+                                    for block in self.track_manager.signal_blocks(signal)]
+        return self._routes[signal]
+
+    def condition_levers(self, signal):
+        """Returns the levers a signal's red condition depends on"""
+        return [lever_of(self.track_manager.track_labels[label])
+                for label in sorted(condition_labels(signal.condition))]
+
+    @staticmethod
+    def red(signal):
+        return signal.red_conditions is not None and bool(signal.red_conditions())
+
+    def check_pair(self, first, second):
+        """Returns the Conflict between the routes of two signals, with the pieces of every pair of routes that can
+        conflict merged, or None if there is none"""
+        pieces = set()
+        example = None
+        saved = [piece.set for piece in self.points]
+        try:
+            for first_route in self.routes(first):
+                for second_route in self.routes(second):
+                    if any(second_route.settings.get(lever, state) != state
+                           for lever, state in first_route.settings.items()):
+                        # Needs the same points set both ways
+                        continue
+                    shared = frozenset(first_route.pieces).intersection(second_route.pieces)
+                    if not shared or shared <= pieces:
+                        # Nothing more to report
+                        continue
+                    settings = dict(first_route.settings)
+                    settings.update(second_route.settings)
+                    free = []
+                    for lever in self.condition_levers(first) + self.condition_levers(second):
+                        if lever not in settings and lever not in free:
+                            free.append(lever)
+                    for combination in range(2 ** len(free)):
+                        for j, lever in enumerate(free):
+                            settings[lever] = (combination >> j) & 1
+                        for lever, state in settings.items():
+                            set_lever(lever, state)
+                        if not self.red(first) and not self.red(second):
+                            pieces |= shared
+                            if example is None:
+                                example = self.describe(settings)
+                            break
+        finally:
+            for piece, state in zip(self.points, saved):
+                piece.set = state
+        if not pieces:
+            return None
+        return Conflict((first.label, second.label), sorted(str(piece) for piece in pieces), example)
+
+    @staticmethod
+    def describe(settings):
+        """Returns {piece: 0/1} for the points switched by the levers in settings, as they are currently set"""
+        out = {}
+        for lever in settings:
+            for piece in (lever.all if isinstance(lever, TrackGroup) else (lever,)):
+                out[str(piece)] = int(bool(piece.set))
+        return out
+
+    def pair_key(self, first, second):
+        """A hash of everything check_pair depends on, so unchanged pairs can be reused when the layout is edited"""
+        def describe_lever(lever):
+            return repr(lever), sorted(repr(piece) for piece in getattr(lever, "invert", ()))
+
+        parts = []
+        for signal in (first, second):
+            routes = [([repr(piece) for piece in route.pieces],
+                       sorted((describe_lever(lever), state) for lever, state in route.settings.items()))
+                      for route in self.routes(signal)]
+            parts.append((signal.label, repr(signal.condition),
+                          sorted(map(describe_lever, self.condition_levers(signal))), routes))
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def verify(self, pairs=None):
+        """Returns the Conflicts between all pairs of signals, one for each pair that conflicts"""
+        if pairs is None:
+            pairs = combinations(self.signal_manager.all.values(), 2)
+        conflicts = (self.check_pair(first, second) for first, second in pairs)
+        return [conflict for conflict in conflicts if conflict is not None]
+
+
+_worker_verifier = None
+
+
+def _init_worker(track_file, accessory_file):
+    global _worker_verifier
+    track_manager = TrackManager(None, track_file)
+    _worker_verifier = SafetyVerifier(track_manager, SignalManager(track_manager, None, accessory_file))
+
+
+def _check_pair(labels):
+    signals = _worker_verifier.signal_manager.all
+    return _worker_verifier.check_pair(signals[labels[0]], signals[labels[1]])
+
+
+def layout_hash(*filenames):
+    digest = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def verify(track_file, accessory_file, processes=1, use_cache=True):
+    """Returns the Conflicts for a layout, checking pairs of signals on a pool of processes if processes > 1.
+    Results are cached next to the track file: by the hash of the layout files, and by pair of signals so that after
+    an edit only pairs whose routes or conditions changed are checked again."""
+    cache_file = track_file + ".verify.json"
+    cache = {"version": CACHE_VERSION, "layout": None, "conflicts": [], "pairs": {}}
+    if use_cache and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached.get("version") == CACHE_VERSION:
+            cache = cached
+    layout = layout_hash(track_file, accessory_file)
+    if cache["layout"] == layout:
+        return [Conflict(**conflict) for conflict in cache["conflicts"]]
+
+    _init_worker(track_file, accessory_file)
+    verifier = _worker_verifier
+    pairs = list(combinations(sorted(verifier.signal_manager.all), 2))
+    keys = [verifier.pair_key(*(verifier.signal_manager.all[label] for label in pair)) for pair in pairs]
+    # Indices of the pairs to check
+    todo = [i for i, key in enumerate(keys) if key not in cache["pairs"]]
+    if processes > 1 and len(todo) > 1:
+        with multiprocessing.Pool(processes, _init_worker, (track_file, accessory_file)) as pool:
+            results = pool.map(_check_pair, [pairs[i] for i in todo])
+    else:
+        results = [_check_pair(pairs[i]) for i in todo]
+    # Key: the Conflict as a dict, or None if the pair does not conflict
+    pair_results = {key: cache["pairs"][key] for key in keys if key in cache["pairs"]}
+    for i, conflict in zip(todo, results):
+        pair_results[keys[i]] = conflict._asdict() if conflict is not None else None
+    conflicts = [pair_results[key] for key in keys if pair_results[key] is not None]
+    if use_cache:
+        with open(cache_file, "w") as f:
+            json.dump({"version": CACHE_VERSION, "layout": layout, "conflicts": conflicts, "pairs": pair_results}, f)
+    return [Conflict(**conflict) for conflict in conflicts]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("track", help=".track layout file")
+    parser.add_argument("accessory", help=".accessory file with the signals")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(), help="Processes to check pairs on")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and do not write cached results")
+    args = parser.parse_args()
+
+    found = verify(args.track, args.accessory, args.processes, not args.no_cache)
+    for conflict in found:
+        print("Conflict between", " and ".join(conflict.signals), "on", ", ".join(conflict.pieces))
+        print("    with", ", ".join("{} {}".format(piece, state) for piece, state in sorted(conflict.settings.items())))
+    print(len(found), "conflicts found")
+    exit(1 if found else 0)
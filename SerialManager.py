@@ -1,19 +1,193 @@
 """Controls serial input/output and can run a simulation via virtually linked com ports"""
+from collections import deque
 import serial
+import queue
 import random
+import threading
 import time
 
 
+class SerialWriter:
+    """Writes messages to com from a background thread, in the order they are put, so a write never blocks the Tk
+    main loop. A message put with a spacing holds the next write back by that many seconds, as the point motors need
+    time between commands.
+    A message put with a key, such as the header of a signal frame that is sent again every few ms, replaces the
+    message for that key still waiting to be written rather than queueing behind it, so only the latest is written
+    and at most one message per key is queued however long the port stalls. Replaced messages are counted as dropped.
+    Keeps the queue depth and the latency of each message from being put to being written. A message that fails to
+    write is printed and counted, not retried."""
+
+    def __init__(self, com):
+        self.com = com
+        # (key or None, message or None if it is in pending, spacing, time put)
+        self.queue = queue.Queue()
+        # Key: latest message for it waiting to be written
+        self.pending = {}
+        self._lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="SerialWriter", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """Messages waiting to be written"""
+        return self.queue.qsize()
+
+    @property
+    def mean_latency(self):
+        count = self.written + self.failed
+        return self.total_latency / count if count else 0.0
+
+    def metrics(self):
+        return {"depth": self.depth, "written": self.written, "failed": self.failed, "dropped": self.dropped,
+                "latency": self.latency, "mean_latency": self.mean_latency, "max_latency": self.max_latency}
+
+    def put(self, message, spacing=0.0, key=None):
+        if key is None:
+            self.queue.put((None, message, spacing, time.perf_counter()))
+            return
+        with self._lock:
+            if key in self.pending:
+                self.dropped += 1
+            else:
+                self.queue.put((key, None, spacing, time.perf_counter()))
+            self.pending[key] = message
+
+    def run(self):
+        ready = 0.0
+        while True:
+            item = self.queue.get()
+            if item is None or self._stop.is_set():
+                return
+            key, message, spacing, put = item
+            wait = ready - time.perf_counter()
+            if wait > 0 and self._stop.wait(wait):
+                return
+            if key is not None:
+                with self._lock:
+                    message = self.pending.pop(key)
+            try:
+                ok = self.com.write(message)
+            except serial.SerialException:
+                ok = False
+            now = time.perf_counter()
+            if ok:
+                self.written += 1
+            else:
+                self.failed += 1
+                print("Writing {} failed".format(message.decode().strip()))
+            self.latency = now - put
+            self.total_latency += self.latency
+            self.max_latency = max(self.max_latency, self.latency)
+            ready = now + spacing
+
+    def close(self, timeout=1.0):
+        """Writes what is queued, for up to timeout seconds, then stops the thread"""
+        self.queue.put(None)
+        self._thread.join(timeout)
+        self._stop.set()
+        self._thread.join()
+
+
+class SerialReader:
+    """Reads com from a background thread and splits what arrives into lines, without their newline, for the Tk main
+    loop to take with get. A line gives the whole state of the groups of its header (its first header_len bytes), so
+    only the latest line for each header is kept: a line replaces one for the same header not yet taken, in its place
+    in the queue. However fast input arrives on one header the main loop is at most one line per header behind, and no
+    other header's update is lost. Replaced lines, and lines for a new header while maxsize headers are waiting, are
+    dropped and counted."""
+
+    def __init__(self, com, maxsize=1024, header_len=3):
+        self.com = com
+        self.maxsize = maxsize
+        self.header_len = header_len
+        # Headers in the order their lines arrived, and the latest line for each
+        self.order = deque()
+        self.pending = {}
+        self._lock = threading.Lock()
+        self.received = 0
+        self.dropped = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="SerialReader", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """Lines waiting to be taken"""
+        return len(self.order)
+
+    def metrics(self):
+        return {"depth": self.depth, "received": self.received, "dropped": self.dropped}
+
+    def put(self, line):
+        header = line[:self.header_len]
+        with self._lock:
+            self.received += 1
+            if header in self.pending:
+                self.dropped += 1
+            elif len(self.order) >= self.maxsize:
+                self.dropped += 1
+                return
+            else:
+                self.order.append(header)
+            self.pending[header] = line
+
+    def get(self):
+        """Returns the line that has waited longest, or None if there are none"""
+        with self._lock:
+            if not self.order:
+                return None
+            return self.pending.pop(self.order.popleft())
+
+    def run(self):
+        buffer = b""
+        while not self._stop.is_set():
+            try:
+                # Waits up to the port's timeout for the first byte, then takes whatever else has arrived
+                data = self.com.read(self.com.in_waiting or 1)
+            except serial.SerialException:
+                if not self._stop.is_set():
+                    print("Reading from serial failed")
+                return
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                if line:
+                    self.put(line)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
 class SerialManager:
     """Controls the serial input and output.
     Consist of two dictionaries, a tkinter widget or root to call the read function.
     write_mapping for output is Dict[Track Dict] where the inner dict has the header associated with the piece, and
     the bit associated with setting and resetting the track.
     read_mapping for input is a Dict[str TrackGroup]
-    delay is between calls of read() in ms"""
+    delay is between calls of write_signals() in ms
+    read_delay is between calls of read() in ms, each of which processes at most read_budget lines
+    point_spacing is the time in ms the hardware needs after each point command before the next command
+    port is a port name or a pyserial URL, e.g. "loop://" to loop writes back to read() without hardware
+    Writes are queued and made by a SerialWriter, whose metrics() gives the queue depth and write latency.
+    Input is read by a SerialReader, which keeps the latest line for each of up to read_queue_size headers."""
     def __init__(self, port, write_point_mapping, write_signal_mapping, read_mapping, tk_caller, track_manager,
-                 header_len=3, delay=100):
-        self.com = serial.Serial(port, timeout=0, write_timeout=0)
+                 header_len=3, delay=100, point_spacing=100, read_delay=10, read_budget=100, read_queue_size=1024):
+        # Reads and writes are made from the reader and writer threads, so can wait on the port. The read timeout
+        # is how long closing waits for the reader.
+        self.com = serial.serial_for_url(port, timeout=0.05, write_timeout=1)
+        self.writer = SerialWriter(self.com)
+        self.reader = SerialReader(self.com, read_queue_size, header_len)
+        self.point_spacing = point_spacing
+        self.read_delay = read_delay
+        self.read_budget = read_budget
         self.write_point_mapping = write_point_mapping
         self.write_signal_mapping = write_signal_mapping
         self.read_mapping = read_mapping
@@ -27,44 +201,52 @@ class SerialManager:
         self.write_signals()
 
     def write_point(self, changed_object):
-        """Takes a track piece and writes the change correct bit to com."""
+        """Takes a track piece and queues the change correct bit to be written to com, spaced from the next
+        command by point_spacing."""
         if changed_object not in self.write_point_mapping:
             return
         header = self.write_point_mapping[changed_object]["HEADER"]
         bit = self.write_point_mapping[changed_object][changed_object.set]
         byte = "".join(("0" if i != bit else "1" for i in range(8)))
-        if not self.com.write("{header}{byte}\n".format(header=header, byte=byte).encode()):
-            # Writes or prints error message
-            print("Writing {header}{byte} failed".format(header=header, byte=byte))
-        else:
-            self.tk_caller.after(100)
+        self.writer.put("{header}{byte}\n".format(header=header, byte=byte).encode(), self.point_spacing / 1000)
 
     def write_signals(self):
         for header, signals in self.write_signal_mapping.items():
             byte = "".join("1" if signal.set else "0" for signal in signals)
             for i in range(8 - len(byte)):
                 byte += "0"
-            if not self.com.write("{header}{byte}\n".format(header=header, byte=byte).encode()):
-                # Writes or prints error message
-                print("Writing {header}{byte} failed".format(header=header, byte=byte))
-
+            self.writer.put("{header}{byte}\n".format(header=header, byte=byte).encode(), key=header)
         self.tk_caller.after(self.delay, self.write_signals)
 
     def read(self):
         """Called by tkinter, and sets itself to be called again.
-        Reads and processes all messages in the pipeline. It sends them to a TrackGroups set method to change track
-        pieces.
-        To invert a track piece have it set initially in the layout definition."""
-        while self.com.in_waiting:
-            data = self.com.readline().strip(b"\n").decode()
+        Processes up to read_budget lines from the reader, leaving the rest for the next call so a flood of input
+        cannot hold up the GUI. It sends them to a TrackGroups set method to change track pieces.
+        To invert a track piece have it set initially in the layout definition.
+        Signals are checked against the interlocking once, after all messages are processed.
+        Returns the number of lines processed."""
+        changed = False
+        processed = 0
+        while processed < self.read_budget:
+            data = self.reader.get()
+            if data is None:
+                break
+            data = data.decode()
+            processed += 1
             header = data[:self.header_len]
             byte = data[self.header_len:]
             if header in self.read_mapping:
                 for i, group in enumerate(self.read_mapping[header]):
-                    group.set(int(byte[i]))
-        self.tk_caller.after(self.delay, self.read)
+                    group.set(int(byte[i]), check_signals=False)
+                changed = True
+        if changed and self.track_manager.signal_manager is not None:
+            self.track_manager.signal_manager.interlock_all()
+        self.tk_caller.after(self.read_delay, self.read)
+        return processed
 
     def close(self):
+        self.writer.close()
+        self.reader.close()
         self.com.close()
 
 
@@ -0,0 +1,212 @@
+"""Discrete event simulation of trains, an alternative to stepping every train every tick with TrainScheduler"""
+from collections import defaultdict
+from itertools import count
+import heapq
+import time
+
+# Kinds of event
+SEGMENT_END = "segment end"
+NEAR_END = "near end"
+SIGNAL = "signal"
+POINT_CHANGE = "point change"
+
+
+class EventSimulation:
+    """Moves trains from event to event rather than tick by tick. Time is measured in ticks, so Train.speed (pixels
+    per tick) means the same as with TrainScheduler.
+    The arrival of a train at the end of its segment is worked out from the length of the segment's path and its speed.
+    A train that cannot move is woken only by something that could let it move: a signal it is held at changing,
+    points being switched, or the piece it is waiting for being released. Positions between events are interpolated
+    when asked for, so a soak test does no work between events.
+    Head-on conflicts are checked once, when a train comes within 20 pixels of the end of its segment."""
+    # Distance from the end of a segment at which to check for conflicts, as Train.move does
+    near_end = 20
+
+    def __init__(self, track_manager):
+        self.track_manager = track_manager
+        self.time = 0.0
+        self.trains = []
+        self.queue = []
+        self.events = 0
+        self._sequence = count()
+        # Events for a train are ignored if its version has changed since they were scheduled
+        self._versions = defaultdict(int)
+        # Train: (time, distance along its path) when it set off along its segment
+        self.moving = {}
+        self.waiting_on_piece = defaultdict(list)
+        self.waiting_on_signal = defaultdict(list)
+        self.waiting_on_points = []
+        track_manager.point_listeners.append(self.on_points_changed)
+        track_manager.occupancy.listeners.append(self.on_occupancy_changed)
+        if track_manager.signal_manager is not None:
+            for signal in track_manager.signal_manager.all.values():
+                signal.listeners.append(self.on_signal_changed)
+        self._canvas = None
+        self._last = None
+        self._frame = 20
+
+    def add(self, train):
+        self.trains.append(train)
+        train.scheduler = self
+        self.plan(train)
+
+    def changed(self, train):
+        """Called by a train that has been stopped, started, reversed or changed speed"""
+        self.update_position(train)
+        self.plan(train)
+
+    def schedule(self, event_time, kind, train):
+        heapq.heappush(self.queue, (event_time, next(self._sequence), kind, train, self._versions[train]))
+
+    def plan(self, train):
+        """Works out what a train does next from where it is now, and schedules the event it is waiting for"""
+        self._versions[train] += 1
+        self.moving.pop(train, None)
+        if train.stop:
+            return
+        if self.held(train):
+            return
+        if train.segment_end is None:
+            train.segment_end = train.track_segment.next(train.pos)
+            train.segment_start = tuple(train.pos)
+            train.distance = 0.0
+            if train.segment_end is None:
+                # Points set against
+                self.waiting_on_points.append(train)
+                return
+        # Setting off along the segment
+        occupancy = self.track_manager.occupancy
+        occupancy.occupy(train.track_segment, train)
+        if train.previous_segment is not None:
+            occupancy.release(train.previous_segment, train)
+        self.moving[train] = (self.time, train.distance, train.speed)
+        if not train.speed:
+            # Standing still like a held train, until a change of speed calls changed
+            return
+        arrival = self.time + (train.path.length - train.distance) / train.speed
+        near = arrival - self.near_end / train.speed
+        if near > self.time:
+            self.schedule(near, NEAR_END, train)
+        self.schedule(arrival, SEGMENT_END, train)
+
+    def held(self, train) -> bool:
+        """Returns True, and waits for the signal to clear, if the train is held by a red signal"""
+        signal = train.held_by()
+        if signal is None:
+            return False
+        # Check if points have changed when the signal clears
+        train.segment_end = train.track_segment.next(train.segment_start)
+        self.waiting_on_signal[signal].append(train)
+        if signal.automatic:
+            train.wait_for(self.track_manager.signal_manager.block_occupant(signal))
+        return True
+
+    def segment_end(self, train):
+        """The train has reached the end of its segment: go on to the next one if it is free"""
+        self.moving.pop(train, None)
+        train.distance = train.path.length
+        train.pos[:] = train.segment_end
+        next_section = train.next_section
+        if self.held(train):
+            return
+        if next_section is None:
+            print("End of line for", train)
+            train.stop = True
+            train.draw()
+        elif self.track_manager.occupancy.occupant(next_section) not in (None, train):
+            if not train.next_section_occupied_flag:
+                print("Next section occupied for", train)
+                train.next_section_occupied_flag = True
+            self.waiting_on_piece[next_section].append((train, self._versions[train]))
+            train.wait_for(self.track_manager.occupancy.occupant(next_section))
+        else:
+            train.next_section_occupied_flag = False
+            train.wait_for(None)
+            train.previous_segment = train.track_segment
+            train.track_segment = next_section
+            train.segment_start = train.segment_end
+            train.segment_end = train.track_segment.next(train.segment_end)
+            train.distance = 0.0
+            self.plan(train)
+
+    def near_segment_end(self, train):
+        next_section = train.next_section
+        other = train.oncoming(next_section) if next_section is not None else None
+        if other is not None:
+            self.update_position(other)
+            train.conflict(other)
+            other.conflict(train)
+
+    def on_occupancy_changed(self, piece, train):
+        if train is not None:
+            return
+        for train, version in self.waiting_on_piece.pop(piece, ()):
+            # Unless the train has been replanned since, e.g. reversed
+            if version == self._versions[train]:
+                self._versions[train] += 1
+                self.schedule(self.time, SEGMENT_END, train)
+
+    def on_signal_changed(self, signal):
+        if signal.set:
+            for train in self.waiting_on_signal.pop(signal, ()):
+                self._versions[train] += 1
+                self.schedule(self.time, SIGNAL, train)
+
+    def on_points_changed(self, group):
+        waiting = self.waiting_on_points + [train for trains in self.waiting_on_signal.values() for train in trains]
+        self.waiting_on_points = []
+        self.waiting_on_signal.clear()
+        for train in waiting:
+            self._versions[train] += 1
+            self.schedule(self.time, POINT_CHANGE, train)
+
+    def step(self):
+        """Processes the next event. Returns False if there are none."""
+        while self.queue:
+            event_time, _, kind, train, version = heapq.heappop(self.queue)
+            if version != self._versions[train]:
+                continue
+            self.time = max(self.time, event_time)
+            self.events += 1
+            if kind == SEGMENT_END:
+                self.segment_end(train)
+            elif kind == NEAR_END:
+                self.near_segment_end(train)
+            else:
+                self.plan(train)
+            return True
+        return False
+
+    def run(self, until):
+        """Processes all events up to the time until, then moves the trains to where they are at that time"""
+        while self.queue and self.queue[0][0] <= until:
+            self.step()
+        self.time = max(self.time, until)
+        for train in list(self.moving):
+            self.update_position(train)
+
+    def update_position(self, train):
+        """Sets train.pos to where a moving train is at the current time"""
+        if train not in self.moving:
+            return
+        # At the speed it set off at, as a change of speed calls changed after it is made
+        start_time, start, speed = self.moving[train]
+        path = train.path
+        train.distance = min(start + (self.time - start_time) * speed, path.length)
+        train.pos[:] = path.at(train.distance)
+
+    def start(self, canvas, tick=10, frame=20):
+        """Runs in real time on a canvas, where a tick lasts tick ms, redrawing the moving trains every frame ms"""
+        self._canvas = canvas
+        self._tick = tick
+        self._frame = frame
+        self._last = time.perf_counter()
+        canvas.after(frame, self.on_timer)
+
+    def on_timer(self):
+        now = time.perf_counter()
+        self.run(self.time + (now - self._last) * 1000 / self._tick)
+        self._last = now
+        for train in self.moving:
+            self._canvas.coords(train.image_id, *train.coords())
+        self._canvas.after(self._frame, self.on_timer)
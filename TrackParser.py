@@ -0,0 +1,177 @@
+"""Streaming tokenizer and parser for the .track format, independent of Tk and the piece classes.
+A .track file is a sequence of branches, each
+
+NEW::Name(Clockwise/Anticlockwise)
+(x, y) Piece[Arguments] "Label" (x, y) Piece ... ::END or ::CLOSE
+
+over as many lines as wanted, with # starting a comment. See Loft.track for the full description."""
+from collections import namedtuple
+import re
+
+# kind is one of "new", "coord", "arguments", "label", "keyword", "piece" or "invalid". value is the converted value:
+# (branch name, direction text) or None if malformed for "new", (x, y) or None if malformed for "coord", a tuple of
+# coordinates, integers and strings for "arguments", the label without quotes for "label" and the text otherwise.
+# line is the whole line the token is in.
+Token = namedtuple("Token", ["kind", "value", "text", "line", "line_number"])
+# A piece of track as plain values. kind is the name of the piece class.
+PieceRecord = namedtuple("PieceRecord", ["branch", "direction", "kind", "start", "end", "arguments", "label",
+                                         "line_number"])
+
+PIECE_NAMES = {"straight": "Straight", "st": "Straight", "point": "Point", "pt": "Point", "curve": "Curve",
+               "cv": "Curve", "crossover": "Crossover", "xx": "Crossover"}
+
+_new_re = re.compile(r"NEW::\s*([^(]*)\(([^(]*)\)")
+# One token: a coordinate, arguments, a label, a keyword, a comment to the end of the line or a piece name
+_token_re = re.compile(r"(?P<coord>\([^)]*\))|(?P<arguments>\[[^\]]*])|(?P<label>\"[^\"]+\")|(?P<keyword>::\S*)|"
+                       r"(?P<comment>#.*)|(?P<piece>[^:\s\[(\"#]+)|(?P<invalid>\S)")
+_coord_re = re.compile(r"\(\s*(\d+)\s*,\s*(\d+)\)")
+_argument_re = re.compile(r"\([^)]*\)|[^\s,[(\]]+")
+
+
+class TrackSyntaxError(Exception):
+    def __init__(self, line, string, text=""):
+        super().__init__(string, line, text)
+
+
+def coordinate(text):
+    """Converts "(0, 1)" to (0, 1), or returns None"""
+    m = _coord_re.fullmatch(text)
+    return (int(m[1]), int(m[2])) if m else None
+
+
+def arguments(text):
+    """Splits "[...]" by commas and converts to coords, integers or strings as appropriate"""
+    out = []
+    for part in _argument_re.findall(text[1:-1]):
+        value = coordinate(part)
+        if value is None:
+            try:
+                value = int(part)
+            except ValueError:
+                value = part
+        out.append(value)
+    return tuple(out)
+
+
+def tokenize(lines):
+    """Yields the Tokens of lines, one line at a time"""
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("NEW::"):
+            m = _new_re.match(line)
+            yield Token("new", m.groups() if m else None, line, line, line_number)
+            continue
+        for m in _token_re.finditer(line):
+            kind = m.lastgroup
+            text = m[kind]
+            if kind == "comment":
+                break
+            if kind == "coord":
+                value = coordinate(text)
+            elif kind == "arguments":
+                value = arguments(text)
+            elif kind == "label":
+                value = text[1:-1]
+            else:
+                value = text
+            yield Token(kind, value, text, line, line_number)
+
+
+class TrackParser:
+    """Parses tokens into PieceRecords as it goes, so a file is never held in memory. Rather than stop at the first
+    error each is added to errors as a TrackSyntaxError and parsing carries on from the next coordinate, so one pass
+    finds every error in a file."""
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, token, string, text=""):
+        error = TrackSyntaxError(token.line, string, text)
+        error.line_number = token.line_number
+        self.errors.append(error)
+
+    def parse(self, lines):
+        """Yields a PieceRecord for each piece in lines"""
+        labels = set()
+        branch = direction = None
+        start = first = piece = None
+        label = ""
+        piece_arguments = ()
+        # Set after an unknown piece name, which is reported instead of the coordinate after it
+        unknown = False
+        # Set once a missing start coordinate has been reported for the branch
+        missing_start = False
+        for token in tokenize(lines):
+            kind, value = token.kind, token.value
+            if kind == "new":
+                if branch is not None:
+                    self.error(token, "NEW:: defined without closure")
+                start = first = piece = None
+                label = ""
+                piece_arguments = ()
+                missing_start = False
+                # Carry on with a branch that has errors, to find any more in it
+                branch, direction = value if value is not None else ("", None)
+                if value is None:
+                    self.error(token, "Invalid branch definition")
+                elif direction.lower() in ("clockwise", "1"):
+                    direction = 1
+                elif direction.lower() in ("anticlockwise", "-1"):
+                    direction = -1
+                else:
+                    self.error(token, "Invalid direction: {}".format(direction))
+                continue
+            if branch is None:
+                if not self.errors or self.errors[-1].args[1] != token.line:
+                    self.error(token, "No track segment started")
+                continue
+            if kind == "coord":
+                if value is None:
+                    self.error(token, "Invalid coordinate given", token.text)
+                elif start is None:
+                    start = first = value
+                elif piece is None:
+                    if not unknown:
+                        self.error(token, "No piece between coordinates", token.text)
+                    start = value
+                else:
+                    yield PieceRecord(branch, direction, piece, start, value, piece_arguments, label,
+                                      token.line_number)
+                    start = value
+                piece, label, piece_arguments, unknown = None, "", (), False
+            elif start is None and kind != "keyword":
+                # The branch carries on from the next coordinate
+                if not missing_start:
+                    self.error(token, "No starting coordinate given")
+                    missing_start = True
+            elif kind == "arguments":
+                piece_arguments = value
+            elif kind == "label":
+                if value in labels:
+                    self.error(token, "Repeated Label", value)
+                labels.add(value)
+                label = value
+            elif kind == "piece":
+                piece = PIECE_NAMES.get(value.lower())
+                unknown = piece is None
+                if unknown:
+                    self.error(token, "Unknown piece", value)
+            elif value == "::END":
+                if piece is not None:
+                    self.error(token, "::END called before final coordinates", value)
+                branch = None
+            elif value == "::CLOSE":
+                if piece is None:
+                    self.error(token, "::CLOSE called without piece", value)
+                elif first is not None:
+                    yield PieceRecord(branch, direction, piece, start, first, piece_arguments, label,
+                                      token.line_number)
+                branch = None
+            else:
+                self.error(token, "Unexpected", value)
+
+    def parse_file(self, filename):
+        with open(filename) as f:
+            yield from self.parse(f)
@@ -0,0 +1,217 @@
+"""Times the layout code that runs at start up and every tick, on Loft.track and on generated layouts of growing size.
+Results are saved as JSON and compared with a stored baseline, flagging anything that has got slower.
+
+    python benchmark.py --output results.json --baseline baseline.json
+    python benchmark.py --save-baseline baseline.json
+
+Each benchmark is run repeat times and the fastest taken, as timeit does, in seconds per operation."""
+from itertools import islice
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from Managers import TrackManager, SignalManager
+from LayoutGenerator import write_layout, write_accessory
+import train
+
+try:
+    from SerialManager import SerialManager
+except ImportError:
+    # pyserial is only needed for the serial benchmark
+    SerialManager = None
+
+
+class Idle:
+    """Stands in for the Tk widget SerialManager schedules itself with, so read() is only run when called"""
+
+    def after(self, delay, func=None):
+        pass
+
+
+def best(func, repeat):
+    """Returns the fastest time of repeat calls of func"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def load(track_file, accessory_file, auto_group=True):
+    with contextlib.redirect_stdout(io.StringIO()):
+        track_manager = TrackManager(None, track_file, auto_group, cache=False)
+        signal_manager = SignalManager(track_manager, None, accessory_file, cache=False) \
+            if accessory_file is not None else None
+    return track_manager, signal_manager
+
+
+def bench_layout(name, track_file, accessory_file, repeat=5, frames=1000):
+    """Returns {benchmark: {"seconds": seconds per operation, "operations": operations timed}} for one layout"""
+    results = {}
+
+    def record(benchmark, seconds, operations=1):
+        results["{}/{}".format(name, benchmark)] = {"seconds": seconds / operations, "operations": operations}
+
+    track_manager, signal_manager = load(track_file, accessory_file)
+    pieces = len(track_manager.track_pieces)
+    record("track_manager", best(lambda: load(track_file, None), repeat))
+
+    def group():
+        # Only the grouping is timed, not loading the layout it groups
+        ungrouped, _ = load(track_file, None, auto_group=False)
+        started = time.perf_counter()
+        ungrouped.auto_point_group()
+        return time.perf_counter() - started
+
+    record("auto_point_group", min(group() for _ in range(repeat)))
+
+    starts = [(branch[0].start, branch[0].direction) for branch in track_manager.track_branches.values()]
+
+    def traverse():
+        for coord, direction in starts:
+            for _ in islice(track_manager.iter_from(coord, direction), pieces):
+                pass
+
+    # The first walk fills the traversal cache, which is what runs on every tick after
+    traverse()
+    record("iter_from", best(traverse, repeat), len(starts))
+
+    if signal_manager is not None and signal_manager.all:
+        signals = list(signal_manager.all.values())
+
+        def interlock():
+            for signal in signals:
+                signal.interlock_red()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            record("interlock_red", best(interlock, repeat), len(signals))
+
+    if SerialManager is not None and track_manager.groups:
+        # 8 groups per 3 letter header, as the Loft boards are wired
+        headers = ["B{:02}".format(i) for i in range(-(-len(track_manager.groups) // 8))][:100]
+        read_mapping = {header: track_manager.groups[8 * i:8 * i + 8] for i, header in enumerate(headers)}
+        with contextlib.redirect_stdout(io.StringIO()):
+            serial_manager = SerialManager("loop://", {}, {}, read_mapping, Idle(), track_manager)
+        # The loop port times a write at its baud rate, so a batch of frames is longer than the write timeout
+        serial_manager.com.write_timeout = None
+        messages = ["{}{:08b}\n".format(headers[i % len(headers)], i % 256).encode() for i in range(frames)]
+        # The loop port blocks writes beyond its 4 kB buffer, so frames arrive in batches as they would between reads
+        batches = [b"".join(messages[i:i + 256]) for i in range(0, frames, 256)]
+
+        reader = serial_manager.reader
+
+        def read():
+            # Times each frame from being written to the port to being processed by read(), or replaced by a later
+            # frame for its header
+            received = reader.received
+            for i, batch in enumerate(batches):
+                serial_manager.com.write(batch)
+                while reader.received < received + min(frames, 256 * (i + 1)) or reader.depth:
+                    serial_manager.read()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            record("serial_read", best(read, repeat), frames)
+        serial_manager.close()
+    return results, pieces
+
+
+def bench_movement(repeat=5, ticks=1000):
+    """Times Train.move and TrainScheduler.step for the Loft trains, with the signals in front of them cleared"""
+    results = {}
+    for benchmark in ("train_move", "scheduler_step"):
+        times = []
+        for _ in range(repeat):
+            track_manager, signal_manager = load("Loft.track", "Loft.accessory")
+            scheduler = train.TrainScheduler()
+            trains = train.loft_trains(None, track_manager, scheduler if benchmark == "scheduler_step" else None)
+            for label in ("L1a", "R1b"):
+                signal_manager.all[label].on_click(None)
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                if benchmark == "train_move":
+                    for _ in range(ticks):
+                        for moving in trains:
+                            moving.move()
+                else:
+                    scheduler.run(ticks)
+            times.append(time.perf_counter() - started)
+        results["Loft/" + benchmark] = {"seconds": min(times) / ticks, "operations": ticks}
+    return results
+
+
+def run(sizes=(1000, 10000), repeat=5, ticks=1000, frames=1000):
+    """Runs every benchmark and returns the results as a dict that can be saved as JSON"""
+    results, _ = bench_layout("Loft", "Loft.track", "Loft.accessory", repeat, frames)
+    results.update(bench_movement(repeat, ticks))
+    layouts = {"Loft": len(load("Loft.track", None)[0].track_pieces)}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            track_file = os.path.join(directory, "generated{}.track".format(size))
+            accessory_file = os.path.join(directory, "generated{}.accessory".format(size))
+            write_layout(track_file, size)
+            write_accessory(accessory_file, size)
+            layout_results, pieces = bench_layout("generated{}".format(size), track_file, accessory_file, repeat,
+                                                  frames)
+            results.update(layout_results)
+            layouts["generated{}".format(size)] = pieces
+    return {"python": platform.python_version(), "machine": platform.machine(), "layouts": layouts,
+            "results": results}
+
+
+def regressions(results, baseline, tolerance=0.25):
+    """Returns (benchmark, seconds, baseline seconds) for each benchmark more than tolerance slower than baseline"""
+    out = []
+    for benchmark, result in sorted(results["results"].items()):
+        previous = baseline["results"].get(benchmark)
+        if previous is not None and result["seconds"] > previous["seconds"] * (1 + tolerance):
+            out.append((benchmark, result["seconds"], previous["seconds"]))
+    return out
+
+
+def print_results(results, baseline=None):
+    for benchmark, result in sorted(results["results"].items()):
+        line = "    {:<36} {:12.3f} us".format(benchmark, result["seconds"] * 1e6)
+        if baseline is not None and benchmark in baseline["results"]:
+            line += " {:+7.1%}".format(result["seconds"] / baseline["results"][benchmark]["seconds"] - 1)
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1000, 10000],
+                        help="Pieces in each generated layout, e.g. 1000 10000 100000")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Times to run each benchmark, taking the fastest")
+    parser.add_argument("--ticks", type=int, default=1000, help="Ticks of train movement to time")
+    parser.add_argument("--frames", type=int, default=1000, help="Serial frames to time")
+    parser.add_argument("-o", "--output", help="Save the results as JSON")
+    parser.add_argument("--baseline",
+                        help="JSON results to compare with, which must exist. Exits with 1 if anything is slower.")
+    parser.add_argument("--save-baseline", help="Save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Fraction slower that counts as a regression")
+    args = parser.parse_args()
+    if args.baseline and not os.path.exists(args.baseline):
+        parser.error("baseline {} not found, make it with --save-baseline".format(args.baseline))
+
+    results = run(args.sizes, args.repeat, args.ticks, args.frames)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+    if baseline is not None:
+        slower = regressions(results, baseline, args.tolerance)
+        for benchmark, seconds, previous in slower:
+            print("Regression: {} {:.3f} us, was {:.3f} us".format(benchmark, seconds * 1e6, previous * 1e6))
+        if slower:
+            sys.exit(1)
@@ -18,8 +18,8 @@ if __name__ == "__main__":
     frame.pack(fill="both", expand="yes")
     root.wm_title("Railway Manager")
     canvas = ResizingCanvas(frame, bg="cyan", height=600, width=1000)
-    track_manager = TrackManager(canvas, "Loft.track")
-    signal_manager = SignalManager(track_manager, canvas, "Loft.accessory")
+    track_manager = TrackManager(canvas, "Loft.track", cache=True)
+    signal_manager = SignalManager(track_manager, canvas, "Loft.accessory", cache=True)
     canvas.pack(fill="both", expand="yes")
 
     # Setup serial
@@ -43,4 +43,6 @@ if __name__ == "__main__":
 
     # Run
     root.mainloop()
+    # Writes any point commands still queued
+    serial_manager.close()
     print("Done")
@@ -0,0 +1,225 @@
+"""Runs the trains on a layout without Tk, as fast as possible, and reports how the layout was used.
+A seeded signalman clears signals for waiting trains and switches points set against them, so the same seed and
+layout always give the same run. Given a timetable, a Dispatcher runs the trains to it instead, and the throughput
+of the timetable is reported."""
+from collections import Counter
+import argparse
+import contextlib
+import io
+import json
+import random
+import time
+
+from Managers import TrackManager, SignalManager, TrackGroup, lever_of
+from Models import Point
+from Interlocking import condition_labels
+from Simulation import EventSimulation
+from Conflicts import ConflictPredictor
+from Deadlock import DeadlockDetector
+from Dispatcher import Dispatcher, load_timetable
+from Routing import RouteManager
+from train import TrainScheduler, loft_trains
+
+
+class Signalman:
+    """Clears a red signal a random time after a train is first held at it, and returns it to red once the train has
+    left the signal's track piece. If the signal is interlocked red one of the points in its red condition is switched,
+    as are points set against a stopped train, unless another train is on them. All the randomness comes from one
+    seeded random.Random."""
+
+    def __init__(self, track_manager, seed, min_wait=5.0, max_wait=60.0):
+        self.track_manager = track_manager
+        self.random = random.Random(seed)
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        # Train: time it may be let go
+        self.due = {}
+        # Signal: train it was cleared for
+        self.cleared = {}
+
+    def wait(self, now):
+        return now + self.random.uniform(self.min_wait, self.max_wait)
+
+    def update(self, now, trains):
+        """Called each sample with the time in seconds"""
+        for signal, train in list(self.cleared.items()):
+            if train.track_segment is not signal.track_segment or not signal.set:
+                del self.cleared[signal]
+                if signal.set:
+                    signal.on_click(None)
+        for train in trains:
+            if train.stop:
+                continue
+            signal = train.held_by()
+            if signal is None and train.segment_end is not None:
+                self.due.pop(train, None)
+                continue
+            if train not in self.due:
+                self.due[train] = self.wait(now)
+            elif now >= self.due[train]:
+                if signal is not None:
+                    signal.on_click(None)
+                    if signal.set:
+                        self.cleared[signal] = train
+                        del self.due[train]
+                    else:
+                        # Interlocked, so switch one of the points the signal depends on and try again later
+                        labels = sorted(condition_labels(signal.condition)) if signal.condition else []
+                        if labels:
+                            self.switch(self.track_manager.track_labels[self.random.choice(labels)], train)
+                        self.due[train] = self.wait(now)
+                else:
+                    self.switch(train.track_segment, train)
+                    self.due[train] = self.wait(now)
+
+    def switch(self, piece, train):
+        """Switches a point, unless a train other than train is on it or its group"""
+        occupancy = self.track_manager.occupancy
+        if not isinstance(piece, Point) or not occupancy.is_clear(occupancy.mask((piece,)), train):
+            return
+        lever = lever_of(piece)
+        if isinstance(lever, TrackGroup):
+            if not occupancy.is_clear(occupancy.mask(lever.all), train):
+                return
+            inverted = piece in lever.invert
+            lever.set(not (piece.set ^ inverted))
+        else:
+            piece.set = not piece.set
+            piece.draw()
+            self.track_manager.points_changed(piece)
+
+
+class Report:
+    """Samples the layout once per simulated second: which labelled pieces are occupied, which trains are held at
+    signals and how far each train has gone. Conflicts are taken from Train.conflicts at the end."""
+
+    def __init__(self, track_manager, trains):
+        self.track_manager = track_manager
+        self.trains = trains
+        self.samples = 0
+        self.occupied = Counter()
+        self.signal_stops = Counter()
+        self.signal_wait = Counter()
+        self.distance = Counter()
+        self._held = {}
+        self._last = {train: tuple(train.pos) for train in trains}
+
+    def sample(self):
+        self.samples += 1
+        occupancy = self.track_manager.occupancy
+        for label in {piece.label for piece in occupancy.pieces_in(occupancy.bits)}:
+            if label:
+                self.occupied[label] += 1
+        for train in self.trains:
+            signal = train.held_by()
+            if signal is not None:
+                if self._held.get(train) is not signal:
+                    self.signal_stops[signal.label] += 1
+                self.signal_wait[signal.label] += 1
+            self._held[train] = signal
+            last = self._last[train]
+            self.distance[train.label] += ((train.pos[0] - last[0]) ** 2 + (train.pos[1] - last[1]) ** 2) ** 0.5
+            self._last[train] = tuple(train.pos)
+
+    def results(self):
+        return {
+            "seconds": self.samples,
+            "occupancy": {label: count / self.samples for label, count in sorted(self.occupied.items())},
+            "signal_stops": {label: {"stops": self.signal_stops[label], "seconds": self.signal_wait[label]}
+                             for label in sorted(self.signal_wait)},
+            "trains": {train.label: {"distance": round(self.distance[train.label], 1), "stopped": bool(train.stop),
+                                     "conflicts": [other.label for other in train.conflicts]}
+                       for train in self.trains},
+        }
+
+
+def simulate(track_file, accessory_file, seconds=3600, seed=0, mode="event", tick=10, verbose=False, predict=False,
+             resolve=False, timetable_file=None, cache=False):
+    """Runs the Loft trains for a number of simulated seconds. mode is "event" for the EventSimulation or "tick" for
+    the TrainScheduler, where a tick is tick ms. predict brakes trains for conflicts ahead with a ConflictPredictor,
+    in tick mode. Deadlocks are reported, and broken by reversing a train if resolve is True. With a timetable_file
+    the trains are dispatched to it rather than let go by the Signalman. cache keeps the parsed layout in a LayoutCache
+    next to its files. Returns a dict of results."""
+    with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+        track_manager = TrackManager(None, track_file, cache=cache)
+        SignalManager(track_manager, None, accessory_file, cache=cache)
+        detector = DeadlockDetector(track_manager, resolve)
+        ticks_per_second = 1000 // tick
+        if mode == "event":
+            scheduler = EventSimulation(track_manager)
+        else:
+            scheduler = TrainScheduler(tick=tick, predictor=ConflictPredictor(track_manager) if predict else None)
+        trains = loft_trains(None, track_manager, scheduler)
+        if timetable_file is None:
+            signalman = Signalman(track_manager, seed)
+        else:
+            dispatcher = Dispatcher(track_manager, RouteManager(track_manager), trains, load_timetable(timetable_file))
+        report = Report(track_manager, trains)
+        started = time.perf_counter()
+        for second in range(seconds):
+            if mode == "event":
+                scheduler.run((second + 1) * ticks_per_second)
+            else:
+                scheduler.run(ticks_per_second)
+            report.sample()
+            if timetable_file is None:
+                signalman.update(second + 1, trains)
+            else:
+                dispatcher.update(second + 1)
+        elapsed = time.perf_counter() - started
+    results = report.results()
+    results["conflicts"] = sum(len(result["conflicts"]) for result in results["trains"].values())
+    results["deadlocks"] = [[train.label for train in cycle] for cycle in detector.deadlocks]
+    if timetable_file is not None:
+        delays = dispatcher.delays()
+        results["services"] = len(delays)
+        results["throughput"] = dispatcher.throughput()
+        results["mean_delay"] = sum(delays) / len(delays) if delays else 0.0
+    results["wall_seconds"] = elapsed
+    return results
+
+
+def print_results(results, top=10):
+    print("Simulated {seconds} s in {wall_seconds:.2f} s".format(**results))
+    print("\nTrains:")
+    for label, result in results["trains"].items():
+        print("    {:<10} {:>10.0f} px{}{}".format(label, result["distance"], "  stopped" if result["stopped"] else "",
+                                                  "".join("  conflict with " + other for other in result["conflicts"])))
+    print("\nBusiest track pieces:")
+    busiest = sorted(results["occupancy"].items(), key=lambda item: (-item[1], item[0]))
+    for label, fraction in busiest[:top]:
+        print("    {:<12} {:6.1%}".format(label, fraction))
+    print("\nStops at signals:")
+    for label, stops in sorted(results["signal_stops"].items(), key=lambda item: (-item[1]["seconds"], item[0])):
+        print("    {:<12} {:4} stops {:6} s waiting".format(label, stops["stops"], stops["seconds"]))
+    print("\n{} conflicts".format(results["conflicts"]))
+    for cycle in results["deadlocks"]:
+        print("Deadlock between", ", ".join(cycle))
+    if "throughput" in results:
+        print("{services} services, {throughput:.1f} trains per hour, {mean_delay:.1f} s mean delay".format(**results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("track", help=".track layout file")
+    parser.add_argument("accessory", help=".accessory file with the signals")
+    parser.add_argument("-t", "--seconds", type=int, default=3600, help="Simulated seconds to run for")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Seed for the signalman")
+    parser.add_argument("--mode", choices=("event", "tick"), default="event",
+                        help="Move trains from event to event, or every tick as train.py does")
+    parser.add_argument("--tick", type=int, default=10, help="ms per tick, as for TrainScheduler")
+    parser.add_argument("--predict", action="store_true", help="Brake trains for conflicts ahead (tick mode only)")
+    parser.add_argument("--resolve", action="store_true", help="Reverse a train to break each deadlock")
+    parser.add_argument("--timetable", help=".timetable file to dispatch the trains to, instead of the signalman")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show output from loading and running")
+    args = parser.parse_args()
+    if args.predict and args.mode != "tick":
+        parser.error("--predict needs --mode tick")
+
+    results = simulate(args.track, args.accessory, args.seconds, args.seed, args.mode, args.tick, args.verbose,
+                       args.predict, args.resolve, args.timetable, cache=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
@@ -0,0 +1,40 @@
+import re
+import unittest
+import Interlocking
+import AccessoryParser
+
+
+class TestAccessoryParser(unittest.TestCase):
+    def test_signal(self):
+        definition = AccessoryParser.parse_signal('"P2":: Pos["Platform 2" End Right] Red["St3" 0 | "St2" 1] Auto', 7)
+        self.assertEqual(definition[:4], ("P2", "Platform 2", "End", "Right"))
+        self.assertEqual(definition.condition, Interlocking.Or((Interlocking.Test("St3", 0),
+                                                                Interlocking.Test("St2", 1))))
+        self.assertTrue(definition.automatic)
+        self.assertEqual(definition.line_number, 7)
+        definition = AccessoryParser.parse_signal('"A"::Pos["L1a"Alt]')
+        self.assertEqual(definition[:6], ("A", "L1a", "Alternate", "Left", None, False))
+
+    def test_error_location(self):
+        for text, column in (('"A":: Pos["L1a" Middle]', 16),
+                             ('"A":: Pos["L1a"] Red["L1a" 1 & "L2a" 2]', 37),
+                             ('"A":: Pos["L1a"] Red["L1a" 1 &]', 30),
+                             ('"A":: Pos["L1a"] Auto Red["L1a" 1]', 22),
+                             ('"A":: Pos["L1a"', 15)):
+            with self.assertRaises(AccessoryParser.AccessorySyntaxError) as context:
+                AccessoryParser.parse_signal(text, 3)
+            self.assertEqual((context.exception.line_number, context.exception.column), (3, column), text)
+
+    def test_loft(self):
+        """The Loft signals are parsed to the same trees as their conditions on their own"""
+        with open("Loft.accessory") as f:
+            lines = f.read().splitlines()
+        definitions = list(AccessoryParser.parse_accessory(lines))
+        self.assertEqual(len(definitions), 10)
+        for definition in definitions:
+            condition = re.search(r"Red\[(.*)\]", lines[definition.line_number - 1])[1]
+            self.assertEqual(definition.condition, Interlocking.parse_condition(condition))
+
+
+if __name__ == "__main__":
+    unittest.main()
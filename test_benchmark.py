@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        results = benchmark.run(sizes=(400,), repeat=1, ticks=10, frames=10)
+        self.assertEqual(results["layouts"]["generated400"], 400)
+        for name in ("track_manager", "auto_point_group", "iter_from", "interlock_red"):
+            self.assertIn("generated400/" + name, results["results"])
+        self.assertIn("Loft/train_move", results["results"])
+        self.assertEqual(benchmark.regressions(results, results), [])
+        slower = {"results": {name: {"seconds": result["seconds"] * 2}
+                              for name, result in results["results"].items()}}
+        self.assertEqual(len(benchmark.regressions(slower, results)), len(results["results"]))
+
+    def test_missing_baseline(self):
+        """A baseline that does not exist is an error, not a run with nothing to compare"""
+        with tempfile.TemporaryDirectory() as directory:
+            missing = os.path.join(directory, "baseline.json")
+            result = subprocess.run([sys.executable, "benchmark.py", "--baseline", missing], capture_output=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn(b"--save-baseline", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+import Managers
+
+
+class TestLayoutCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.track = os.path.join(self.directory.name, "Loft.track")
+        self.accessory = os.path.join(self.directory.name, "Loft.accessory")
+        for source, copy in (("Loft.track", self.track), ("Loft.accessory", self.accessory)):
+            with open(source) as f, open(copy, "w") as out:
+                out.write(f.read())
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def load(self):
+        track_manager = Managers.TrackManager(None, self.track, cache=True)
+        signal_manager = Managers.SignalManager(track_manager, None, self.accessory, cache=True)
+        return track_manager, signal_manager
+
+    def summary(self, track_manager, signal_manager):
+        return ([(type(piece), piece.coordinates, piece.label) for piece in track_manager.track_pieces],
+                [group.labels for group in track_manager.groups],
+                {label: (signal.track_segment.label, signal.condition) for label, signal in signal_manager.all.items()})
+
+    def test_same_as_parsed(self):
+        parsed = self.summary(*self.load())
+        self.assertTrue(os.path.exists(self.track + ".cache"))
+        self.assertTrue(os.path.exists(self.accessory + ".cache"))
+        self.assertEqual(self.summary(*self.load()), parsed)
+
+    def test_stale(self):
+        """Editing the source makes the cache stale"""
+        self.load()
+        with open(self.accessory) as f:
+            text = f.read()
+        with open(self.accessory, "w") as f:
+            f.write(text.replace('"L3b":: Pos["L3b"]', '"L3b":: Pos["L3b" End]'))
+        track_manager, signal_manager = self.load()
+        self.assertEqual(signal_manager.all["L3b"].track_relative_position, "end")
+
+    def test_unreadable(self):
+        with open(self.track + ".cache", "wb") as f:
+            f.write(b"not a cache")
+        track_manager, _ = self.load()
+        self.assertIn("L1a", track_manager.track_labels)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import threading
+import time
+import unittest
+import Managers
+import SerialManager
+import benchmark
+
+
+class StalledPort:
+    """A port whose writes wait until released"""
+
+    def __init__(self):
+        self.writing = threading.Event()
+        self.released = threading.Event()
+        self.messages = []
+
+    def write(self, message):
+        self.writing.set()
+        self.released.wait()
+        self.messages.append(message)
+        return len(message)
+
+
+class TestSerialWriter(unittest.TestCase):
+    def test_stalled_port(self):
+        """Signal frames for a header replace the one waiting while the port is stalled, and do not hold up points"""
+        port = StalledPort()
+        writer = SerialManager.SerialWriter(port)
+        writer.put(b"SRA00000000\n", key="SRA")
+        self.assertTrue(port.writing.wait(5))
+        for i in range(100):
+            writer.put("SRA{:08b}\n".format(i).encode(), key="SRA")
+        writer.put(b"PRA10000000\n", 0.1)
+        self.assertEqual(writer.depth, 2)
+        self.assertEqual(writer.metrics()["dropped"], 99)
+        port.released.set()
+        writer.close()
+        self.assertEqual(port.messages, [b"SRA00000000\n", b"SRA01100011\n", b"PRA10000000\n"])
+
+
+class TestSerialManager(unittest.TestCase):
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.points = [self.track_manager.track_labels[label] for label in ("R1a", "R2a", "R3a")]
+        write_point_mapping = {piece: {"HEADER": "PRA", 0: 2 * i, 1: 2 * i + 1} for i, piece in enumerate(self.points)}
+        self.serial_manager = SerialManager.SerialManager("loop://", write_point_mapping, {}, {}, benchmark.Idle(),
+                                                          self.track_manager, point_spacing=50)
+
+    def tearDown(self):
+        self.serial_manager.close()
+
+    def test_write_queue(self):
+        """Point commands are queued without blocking and written in order, spaced by point_spacing"""
+        started = time.perf_counter()
+        for piece in self.points:
+            self.serial_manager.write_point(piece)
+        self.assertLess(time.perf_counter() - started, 0.05)
+        writer = self.serial_manager.writer
+        while writer.written < len(self.points) and time.perf_counter() - started < 5:
+            time.sleep(0.01)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.1)
+        self.assertEqual(writer.depth, 0)
+        self.assertEqual(writer.failed, 0)
+        self.assertGreaterEqual(writer.max_latency, 0.1)
+        expected = ["PRA{}".format("".join("1" if j == 2 * i + piece.set else "0" for j in range(8)))
+                    for i, piece in enumerate(self.points)]
+        # The port loops back, so the commands are read back in by the reader, each replacing the one before
+        reader = self.serial_manager.reader
+        while reader.received < len(self.points) and time.perf_counter() - started < 5:
+            time.sleep(0.01)
+        self.assertEqual((reader.received, reader.dropped), (3, 2))
+        self.assertEqual(reader.get(), expected[-1].encode())
+
+    def wait_for(self, frames):
+        reader = self.serial_manager.reader
+        started = time.perf_counter()
+        while reader.received < frames and time.perf_counter() - started < 5:
+            time.sleep(0.01)
+        self.assertEqual(reader.received, frames)
+
+    def test_flood(self):
+        """A flood on one header does not lose the one update for another, and leaves the last line of the flood"""
+        groups = [piece.groups[0] for piece in self.points]
+        self.serial_manager.read_mapping = {"PRA": groups[:2], "PRB": groups[2:]}
+        frames = 2000
+        for i in range(frames):
+            self.serial_manager.com.write("PRA{:08b}\n".format(i % 256).encode())
+            if i == 10:
+                self.serial_manager.com.write(b"PRB10000000\n")
+        self.wait_for(frames + 1)
+        self.assertEqual(self.serial_manager.reader.depth, 2)
+        self.assertEqual(self.serial_manager.read(), 2)
+        # The last PRA line, "PRA11001111", and the PRB line, inverted for pieces initially set
+        self.assertEqual([bool(piece.set) != (piece in piece.groups[0].invert) for piece in self.points],
+                         [True, True, True])
+
+    def test_read_budget(self):
+        """Lines for many headers are processed read_budget lines per call"""
+        self.serial_manager.read_budget = 10
+        for i in range(25):
+            self.serial_manager.com.write("H{:02}00000000\n".format(i).encode())
+        self.wait_for(25)
+        self.assertEqual([self.serial_manager.read() for _ in range(4)], [10, 10, 5, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+import os
+import random
+import re
+import tempfile
+import unittest
+import Managers
+import Interlocking
+import SafetyVerifier
+
+
+class TestRedConditions(unittest.TestCase):
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, "Loft.accessory", cache=False)
+
+    def test_parse(self):
+        tree = Interlocking.parse_condition('"A" 1 | "B" 0 & ("C" 1 | "D" 1)')
+        self.assertEqual(tree, Interlocking.Or((Interlocking.Test("A", 1),
+                                                Interlocking.And((Interlocking.Test("B", 0),
+                                                                  Interlocking.Or((Interlocking.Test("C", 1),
+                                                                                   Interlocking.Test("D", 1))))))))
+        self.assertIsNone(Interlocking.parse_condition(""))
+        with self.assertRaises(Interlocking.ConditionSyntaxError):
+            Interlocking.parse_condition('"A" 1 & ("B" 0')
+
+    def test_compiled_matches_eval(self):
+        """Compiled conditions agree with evaluating the condition text as python"""
+        with open("Loft.accessory") as f:
+            texts = dict(re.findall(r'^"([^"]+)".*Red\[(.*)\]$', f.read(), re.MULTILINE))
+        labels = self.track_manager.track_labels
+        points = [piece for piece in self.track_manager if hasattr(piece, "set")]
+        rng = random.Random(0)
+        for _ in range(200):
+            for piece in points:
+                piece.set = rng.choice((0, 1))
+            for label, signal in self.signal_manager.all.items():
+                python = re.sub(r'"([^"]+)"\s*([01])', r'(labels["\1"].set == \2)', texts[label])
+                python = python.replace("&", " and ").replace("|", " or ")
+                self.assertEqual(bool(signal.red_conditions()), bool(eval(python)), label)
+
+    def test_red_signals(self):
+        """The bulk check over a state word agrees with checking each signal"""
+        table = self.signal_manager.interlocking
+        rng = random.Random(1)
+        for _ in range(200):
+            for piece in table.points:
+                piece.set = rng.choice((0, 1))
+            word = table.state_word()
+            expected = [signal for signal in table.signals if signal.red_conditions()]
+            self.assertEqual(table.red_signals(word), expected)
+
+    def test_no_red_condition(self):
+        """A signal without Red[...] loads and is never forced red"""
+        with open("Loft.accessory") as f:
+            text = re.sub(r'^"R2a"::.*$', '"R2a":: Pos["R2a"]', f.read(), flags=re.MULTILINE)
+        with tempfile.NamedTemporaryFile("w", suffix=".accessory", delete=False) as f:
+            f.write(text)
+        self.addCleanup(os.remove, f.name)
+        signal_manager = Managers.SignalManager(self.track_manager, None, f.name, cache=False)
+        signal = signal_manager.all["R2a"]
+        self.assertIsNone(signal.condition)
+        table = signal_manager.interlocking
+        for word in (0, table.state_word(), (1 << len(table.points)) - 1):
+            self.assertFalse(table.forces_red(signal, word))
+            self.assertNotIn(signal, table.red_signals(word))
+        self.assertTrue(signal.interlock_red())
+
+
+class TestSafetyVerifier(unittest.TestCase):
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, "Loft.accessory", cache=False)
+        self.verifier = SafetyVerifier.SafetyVerifier(self.track_manager, self.signal_manager)
+
+    def test_routes_stop_at_next_signal(self):
+        """From R2a on the up fast line the straight route ends before signal L1a"""
+        signal = self.signal_manager.all["R2a"]
+        straight_on = [route for route in self.verifier.routes(signal) if not any(route.settings.values())]
+        self.assertEqual(len(straight_on), 1)
+        self.assertIs(straight_on[0].pieces[0], self.track_manager.track_labels["R2a"])
+        self.assertIs(self.track_manager.other_piece(straight_on[0].pieces[-1].end, straight_on[0].pieces[-1]),
+                      self.track_manager.track_labels["L1a"])
+
+    def test_conflicts_are_green(self):
+        """Both signals of a reported conflict can be green with the reported settings"""
+        points = {str(piece): piece for piece in self.verifier.points}
+        conflicts = self.verifier.verify()
+        self.assertTrue(conflicts)
+        # One for each pair of signals
+        self.assertEqual(len({conflict.signals for conflict in conflicts}), len(conflicts))
+        for conflict in conflicts:
+            for label, state in conflict.settings.items():
+                points[label].set = state
+            for label in conflict.signals:
+                self.assertFalse(self.verifier.red(self.signal_manager.all[label]), conflict)
+
+
+class TestAutomaticSignals(unittest.TestCase):
+    def setUp(self):
+        with open("Loft.accessory") as f:
+            text = re.sub(r'^("L1a"::.*)$', r"\1 Auto", f.read(), flags=re.MULTILINE)
+        self.file = tempfile.NamedTemporaryFile("w", suffix=".accessory", delete=False)
+        self.file.write(text)
+        self.file.close()
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, self.file.name, cache=False)
+        self.signal = self.signal_manager.all["L1a"]
+        self.occupancy = self.track_manager.occupancy
+
+    def tearDown(self):
+        os.remove(self.file.name)
+
+    def current_block(self):
+        for block in self.track_manager.signal_blocks(self.signal):
+            if all(Managers.lever_state(lever) == state for lever, state in block.settings.items()):
+                return block
+
+    def test_loaded(self):
+        self.assertTrue(self.signal.automatic)
+        self.assertFalse(self.signal_manager.all["R1b"].automatic)
+        self.assertTrue(self.signal.set)
+
+    def test_occupancy(self):
+        piece = self.current_block().pieces[-1]
+        self.occupancy.occupy(piece, "train")
+        self.assertFalse(self.signal.set)
+        self.occupancy.release(piece)
+        self.assertTrue(self.signal.set)
+        # The signal's own piece is where a train waits for it
+        self.occupancy.occupy(self.signal.track_segment, "train")
+        self.assertTrue(self.signal.set)
+
+    def test_points(self):
+        """Occupancy on another way ahead only turns the signal red once the points are set for it"""
+        current = self.current_block()
+        for block in self.track_manager.signal_blocks(self.signal):
+            others = [piece for piece in block.pieces if piece not in current.pieces]
+            if others:
+                self.occupancy.occupy(others[-1], "train")
+                break
+        self.assertTrue(self.signal.set)
+        for lever, state in block.settings.items():
+            lever.set(state)
+        self.assertFalse(self.signal.set)
+        self.occupancy.release(others[-1])
+        self.assertEqual(self.signal.set, not self.signal.red_conditions())
+
+
+class TestAutomaticConditionLevers(unittest.TestCase):
+    # The point P is nowhere ahead of the signal, only in its red condition
+    track = """
+NEW::Line(Clockwise)
+(0, 0) St "S1" (100, 0) St "S2" (200, 0) ::END
+
+NEW::Siding(Clockwise)
+(0, 100) Point[(50, 150), 1] "P" (100, 100) St (200, 100) ::END
+"""
+    accessory = """
+SIGNALS::
+"A":: Pos["S1"] Red["P" 1] Auto
+::END
+"""
+
+    def setUp(self):
+        self.files = []
+        for text, suffix in ((self.track, ".track"), (self.accessory, ".accessory")):
+            with tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False) as f:
+                f.write(text)
+            self.files.append(f.name)
+        self.track_manager = Managers.TrackManager(None, self.files[0], cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, self.files[1], cache=False)
+
+    def tearDown(self):
+        for filename in self.files:
+            os.remove(filename)
+
+    def switch(self, state):
+        point = self.track_manager.track_labels["P"]
+        point.set = state
+        self.track_manager.points_changed(Managers.lever_of(point))
+
+    def test_condition_lever(self):
+        signal = self.signal_manager.all["A"]
+        self.assertTrue(signal.set)
+        self.switch(1)
+        self.signal_manager.interlock_all()
+        self.assertFalse(signal.set)
+        self.switch(0)
+        self.assertTrue(signal.set)
+
+
+if __name__ == "__main__":
+    unittest.main()
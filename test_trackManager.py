@@ -1,12 +1,15 @@
+import os
+import tempfile
 import unittest
 import Models
 import Managers
+import Routing
 import tkinter
 
 
 class TestTrackManager(unittest.TestCase):
     def setUp(self):
-        self.track_manager = Managers.TrackManager(tkinter.Canvas(), "UnitTest.track")
+        self.track_manager = Managers.TrackManager(tkinter.Canvas(), "UnitTest.track", cache=False)
 
     # def test_iter_from(self):
     #     # Reversing a reverse transversal is the same
@@ -35,5 +38,316 @@ class TestTrackManager(unittest.TestCase):
                 self.assertIn(piece.alternate, self.track_manager.coordinate_dict)
 
 
+class RecordingCanvas:
+    """Stands in for a tkinter canvas, numbering items and recording bindings"""
+    def __init__(self):
+        self.items = 0
+        self.bindings = []
+
+    def create_line(self, *args, **kwargs):
+        self.items += 1
+        return self.items
+
+    create_oval = create_line
+
+    def itemconfig(self, *args, **kwargs):
+        pass
+
+    def tag_bind(self, image_id, sequence, func, add=None):
+        self.bindings.append((image_id, sequence, func))
+
+
+class RecordingSerial(list):
+    """Stands in for the SerialManager of every group, keeping the points written"""
+
+    def __init__(self, track_manager):
+        super().__init__()
+        for group in track_manager.groups:
+            group.serial_manager = self
+
+    def write_point(self, piece):
+        self.append(piece)
+
+
+class TestCanvasIndex(unittest.TestCase):
+    def setUp(self):
+        self.canvas = RecordingCanvas()
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, "Loft.accessory", cache=False)
+        self.track_manager.attach(self.canvas)
+
+    def test_lookups(self):
+        for piece in self.track_manager:
+            for image_id in piece.image_ids:
+                self.assertIs(self.track_manager.piece_by_id(image_id), piece)
+        for signal in self.signal_manager.all.values():
+            self.assertIs(self.track_manager.signal_by_id(signal.image_id), signal)
+        point = self.track_manager.track_labels["R1a"]
+        self.assertIs(self.track_manager.group_by_id(point.image_ids[0]), point.groups[0])
+        self.assertIsNone(self.track_manager.group_by_id(-1))
+        signal = next(iter(self.signal_manager.all.values()))
+        self.assertIsNone(self.track_manager.group_by_id(signal.image_id))
+
+    def test_group_append(self):
+        piece = Models.Straight(self.canvas, "Test", 1, (0, 0), (10, 0))
+        self.track_manager.groups[0].append(piece)
+        self.assertIs(self.track_manager.piece_by_id(piece.image_ids[0]), piece)
+        self.assertIn((piece.image_ids[0], "<Button-1>", self.track_manager.groups[0].on_click),
+                      self.canvas.bindings)
+
+
+class TestHeadlessTrackManager(unittest.TestCase):
+    """The layout model can be loaded and driven without a canvas"""
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, "Loft.accessory", cache=False)
+
+    def test_no_images(self):
+        for piece in self.track_manager:
+            self.assertIsNone(piece.canvas)
+            self.assertFalse(piece.image_ids)
+        for signal in self.signal_manager.all.values():
+            self.assertIsNone(signal.image_id)
+
+    def test_interlock(self):
+        """Setting the group of R1a forces signal R2a to red"""
+        signal = self.signal_manager.all["R2a"]
+        group = self.track_manager.track_labels["R1a"].groups[0]
+        group.set(0)
+        signal.on_click(None)
+        self.assertTrue(signal.set)
+        group.on_click()
+        self.assertFalse(signal.set)
+
+    def test_graph_exit(self):
+        """Following the graph gives the same result as Track.next for every piece, endpoint and setting"""
+        graph = self.track_manager.graph
+        for piece in self.track_manager:
+            piece_id = graph.piece_ids[piece]
+            for state in (0, 1):
+                if isinstance(piece, Models.Point):
+                    piece.set = state
+                for coord in piece.coordinates:
+                    self.assertEqual(graph.exit(piece_id, graph.node(coord)), graph.node(piece.next(coord)))
+
+
+class TestTraversalCache(unittest.TestCase):
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+
+    def uncached(self, coord, direction, count):
+        """Follows the track with Track.next as iter_from did before walks were cached"""
+        piece = self.track_manager.start_piece(coord, direction)
+        entry = coord
+        out = []
+        while piece is not None and len(out) < count:
+            out.append(piece)
+            entry = piece.next(entry)
+            piece = self.track_manager.other_piece(entry, piece)
+        return out
+
+    def test_matches_uncached(self):
+        groups = self.track_manager.groups
+        for i in range(2 ** 6):
+            for j, group in enumerate(groups[:6]):
+                group.set((i >> j) & 1)
+            for coord, direction in (((325, 575), 1), ((700, 525), -1), ((660, 380), -1)):
+                cached = self.track_manager.iter_from(coord, direction)
+                expected = self.uncached(coord, direction, 120)
+                self.assertEqual([next(cached) for _ in expected], expected)
+
+    def test_invalidated_by_switching(self):
+        traversal = self.track_manager.traversal(0, self.track_manager.graph.ends[0])
+        self.assertIs(self.track_manager.traversal(0, self.track_manager.graph.ends[0]), traversal)
+        point, state = traversal.points[0]
+        point.groups[0].on_click()
+        self.assertIsNot(self.track_manager.traversal(0, self.track_manager.graph.ends[0]), traversal)
+        point.groups[0].on_click()
+        self.assertIs(self.track_manager.traversal(0, self.track_manager.graph.ends[0]), traversal)
+
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, "Loft.accessory", cache=False)
+        self.route_manager = Routing.RouteManager(self.track_manager)
+
+    def test_set_route(self):
+        """After setting a route, following the track from its start passes through its pieces"""
+        for origin, destination in (("Platform 1", "R5a"), ("R2a", "Platform 2"), ("L1a", "U1")):
+            route = self.route_manager.set_route(origin, destination)
+            self.assertIsNotNone(route, (origin, destination))
+            walk = self.track_manager.walk(route.pieces[0], route.entry)
+            self.assertEqual([next(walk) for _ in route.pieces], route.pieces)
+
+    def test_serial(self):
+        """The points a route switches are written to serial"""
+        written = RecordingSerial(self.track_manager)
+        route = self.route_manager.set_route("L1a", "St1a")
+        changed = [piece for lever in route.settings for piece in lever.points]
+        self.assertTrue(written)
+        self.assertEqual(set(written), set(changed))
+
+    def test_cache(self):
+        route = self.route_manager.route("R2a", "Platform 2")
+        self.assertIs(self.route_manager.route("R2a", "Platform 2"), route)
+        self.track_manager.groups[0].on_click()
+        self.assertIs(self.route_manager.route("R2a", "Platform 2"), route)
+        self.track_manager.layout_changed()
+        self.assertIsNot(self.route_manager.route("R2a", "Platform 2"), route)
+
+
+class TestRoutingSettings(unittest.TestCase):
+    # From O the shorter way to X is through A set to its alternate coordinate, but A is grouped with B, which must be
+    # straight for T, so the route has to take the longer way round to X
+    layout = """
+NEW::Main(Clockwise)
+(0, 0) St "O" (50, 0) Point[(100, 50), 1] "A" (100, 0) St (150, 0) St (200, 0) St (250, 0) Point[(200, 50), 0] "M"
+(300, 0) St "X" (350, 0) Point[(400, 50), 1] "B" (400, 0) St "T" (450, 0) ::END
+
+NEW::Short(Clockwise)
+(100, 50) St (150, 50) St (200, 50) ::END
+"""
+
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile("w", suffix=".track", delete=False)
+        self.file.write(self.layout)
+        self.file.close()
+        self.track_manager = Managers.TrackManager(None, self.file.name, auto_group=False, cache=False)
+        labels = self.track_manager.track_labels
+        self.group = Managers.TrackGroup([labels["A"], labels["B"]])
+        self.track_manager.groups.append(self.group)
+        self.track_manager.layout_changed()
+        self.route_manager = Routing.RouteManager(self.track_manager)
+
+    def tearDown(self):
+        os.remove(self.file.name)
+
+    def test_longer_way_round(self):
+        route = self.route_manager.route("O", "T")
+        self.assertIsNotNone(route)
+        self.assertEqual(route.settings, {self.group: 0, self.track_manager.track_labels["M"]: 0})
+        self.assertEqual(len(route.pieces), 9)
+
+
+class TestPath(unittest.TestCase):
+    def setUp(self):
+        self.curve = Models.Curve(None, "", 1, (0, 0), (100, 0), "R")
+
+    def test_ends(self):
+        path = self.curve.path(self.curve.start, self.curve.end)
+        self.assertEqual(path.at(0), (0, 0))
+        self.assertEqual(path.at(path.length), (100, 0))
+        self.assertEqual(path.at(path.length + 10), (100, 0))
+        self.assertGreater(path.length, 100)
+        self.assertIs(path, self.curve.path((0, 0), (100, 0)))
+
+    def test_follows_curve(self):
+        """Halfway along, the path is at the middle of the Bezier curve, not on the chord"""
+        path = self.curve.path(self.curve.start, self.curve.end)
+        x, y = path.at(path.length / 2)
+        control = self.curve.curvepoint
+        self.assertAlmostEqual(x, 50)
+        self.assertAlmostEqual(y, control[1] / 2)
+        self.assertAlmostEqual(path.locate((x, y)), path.length / 2)
+
+    def test_reversed(self):
+        forward = self.curve.path(self.curve.start, self.curve.end)
+        backward = self.curve.path(self.curve.end, self.curve.start)
+        self.assertAlmostEqual(forward.length, backward.length)
+        for distance in (0, 10, 33.3, forward.length):
+            for a, b in zip(forward.at(distance), backward.at(forward.length - distance)):
+                self.assertAlmostEqual(a, b)
+
+
+class TestOccupancy(unittest.TestCase):
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.occupancy = self.track_manager.occupancy
+        self.changes = []
+        self.occupancy.listeners.append(lambda piece, train: self.changes.append((piece, train)))
+
+    def test_notify_on_change(self):
+        piece = self.track_manager.track_labels["Platform 2"]
+        self.occupancy.occupy(piece, "train")
+        self.occupancy.occupy(piece, "train")
+        self.assertEqual(self.changes, [(piece, "train")])
+        self.assertEqual(piece.train_in, "train")
+        self.occupancy.release(piece, "other")
+        self.assertEqual(piece.train_in, "train")
+        self.occupancy.release(piece, "train")
+        self.assertEqual(self.changes, [(piece, "train"), (piece, None)])
+        self.assertFalse(piece.train_in)
+        self.assertEqual(self.occupancy.bits, 0)
+
+    def test_blocks(self):
+        pieces = [self.track_manager.track_labels[label] for label in ("St1a", "St1b", "St2")]
+        self.occupancy.add_block("Station", pieces)
+        events = []
+        self.occupancy.block_listeners["Station"].append(lambda name, occupied: events.append(occupied))
+        self.occupancy.occupy(pieces[0], "train")
+        self.occupancy.occupy(pieces[1], "train")
+        self.assertTrue(self.occupancy.block_occupied("Station"))
+        self.assertEqual(self.occupancy.block_occupant("Station"), "train")
+        self.occupancy.release(pieces[0])
+        self.occupancy.release(pieces[1])
+        self.assertFalse(self.occupancy.block_occupied("Station"))
+        self.assertEqual(events, [True, False])
+
+    def test_group_occupied(self):
+        group = self.track_manager.track_labels["St3"].groups[0]
+        self.assertFalse(group.occupied())
+        self.track_manager.track_labels["St3"].train_in = "train"
+        self.assertTrue(group.occupied())
+
+    def test_route_clear(self):
+        Managers.SignalManager(self.track_manager, None, "Loft.accessory", cache=False)
+        route_manager = Routing.RouteManager(self.track_manager)
+        route = route_manager.route("L1a", "R2a")
+        self.assertTrue(route_manager.route_clear("L1a", "R2a"))
+        self.occupancy.occupy(route.pieces[2], "train")
+        self.assertFalse(route_manager.route_clear("L1a", "R2a"))
+        self.assertTrue(route_manager.route_clear("L1a", "R2a", "train"))
+
+
+class TestAutoGroup(unittest.TestCase):
+    # Two crossovers in a ladder between two points, with the two pairs found before the crossovers' shared coordinate
+    ladder = """
+NEW::Bottom(Clockwise)
+(0, 150) Point[(50, 125), 0] "P1" (50, 150) Straight (200, 150) ::END
+
+NEW::Top(Clockwise)
+(0, 0) Straight (100, 0) Point[(150, 25), 0] "P2" (150, 0) Straight (200, 0) ::END
+
+NEW::Middle(Clockwise)
+(0, 100) Straight (50, 100) Crossover[(50, 125), (100, 75)] "X1" (100, 100) Straight (200, 100) ::END
+
+NEW::Upper(Clockwise)
+(0, 50) Straight (100, 50) Crossover[(100, 75), (150, 25)] "X2" (150, 50) Straight (200, 50) ::END
+"""
+
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile("w", suffix=".track", delete=False)
+        self.file.write(self.ladder)
+        self.file.close()
+
+    def tearDown(self):
+        os.remove(self.file.name)
+
+    def test_merges_groups(self):
+        track_manager = Managers.TrackManager(None, self.file.name, cache=False)
+        self.assertEqual([group.labels for group in track_manager.groups], [["P1", "X1", "P2", "X2"]])
+        for piece in track_manager.groups[0].all:
+            self.assertEqual(piece.groups, [track_manager.groups[0]])
+
+    def test_loft_groups(self):
+        """Every point in the Loft layout is in exactly one group"""
+        track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        grouped = [piece for group in track_manager.groups for piece in group.all]
+        self.assertEqual(len(grouped), len(set(grouped)))
+        self.assertEqual(set(grouped), {piece for piece in track_manager.track_pieces
+                                        if isinstance(piece, (Models.Point, Models.Crossover))})
+
+
 if __name__ == "__main__":
     unittest.main()
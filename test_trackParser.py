@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+import Managers
+import TrackParser
+import LayoutGenerator
+
+
+class TestTrackParser(unittest.TestCase):
+    def test_errors(self):
+        """All errors are found in one pass, and the pieces around them are still parsed"""
+        text = """NEW::A(Clockwise)
+(0, 0) Straight (50, 0) Strait (100, 0) Straight "X" (150, 0) Curve (1a, 2)
+Straight "X" (200, 0) ::END
+(5, 5) Straight (6, 6)
+NEW::B(Sideways)
+Straight (0, 50) Straight (50, 50) Point[(75, 75), 0] ::CLOSE
+"""
+        parser = TrackParser.TrackParser()
+        records = list(parser.parse(text.splitlines()))
+        self.assertEqual([(record.kind, record.start, record.end) for record in records],
+                         [("Straight", (0, 0), (50, 0)), ("Straight", (100, 0), (150, 0)),
+                          ("Straight", (150, 0), (200, 0)), ("Straight", (0, 50), (50, 50)),
+                          ("Point", (50, 50), (0, 50))])
+        self.assertEqual(records[-1].arguments, ((75, 75), 0))
+        self.assertEqual([(error.line_number, error.args[0]) for error in parser.errors],
+                         [(2, "Unknown piece"), (2, "Invalid coordinate given"), (3, "Repeated Label"),
+                          (4, "No track segment started"), (5, "Invalid direction: Sideways"),
+                          (6, "No starting coordinate given")])
+        with self.assertRaises(Managers.TrackSyntaxError) as context:
+            Managers.parse_track(text.splitlines())
+        self.assertEqual(len(context.exception.errors), 6)
+
+    def test_generated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "generated.track")
+            LayoutGenerator.write_layout(filename, 1000, columns=100)
+            rate, count = LayoutGenerator.parse_throughput(filename)
+            self.assertEqual(count, 1000)
+            track_manager = Managers.TrackManager(None, filename, cache=False)
+        self.assertEqual(len(track_manager.track_pieces), 1000)
+        linked = [group for group in track_manager.groups if len(group.all) == 2]
+        self.assertEqual(len(linked), 5 * 13)
+
+
+if __name__ == "__main__":
+    unittest.main()
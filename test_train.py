@@ -0,0 +1,312 @@
+import contextlib
+import io
+import os
+import re
+import tempfile
+import types
+import unittest
+import Managers
+import train
+import Simulation
+import simulate
+import Conflicts
+import Deadlock
+import Dispatcher
+import Routing
+
+
+class TestTrainScheduler(unittest.TestCase):
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, "Loft.accessory", cache=False)
+        # Moving the trains with the arrays, however few there are
+        self.scheduler = train.TrainScheduler(min_vectorised=0)
+        self.trains = [train.Train(None, self.track_manager, (325, 575), 1, "Blue", "Fast Up", 1.6, self.scheduler),
+                       train.Train(None, self.track_manager, (700, 525), -1, "Purple", "Fast Down", 1.4,
+                                   self.scheduler),
+                       train.Train(None, self.track_manager, (659, 380), -1, "Orange", "Slow Down",
+                                   scheduler=self.scheduler)]
+
+    def test_placement(self):
+        self.assertIs(self.trains[2].track_segment, self.track_manager.track_labels["Platform 2"])
+
+    def test_stopped_trains_skipped(self):
+        self.trains[2].stop = True
+        moved = self.scheduler.step()
+        self.assertEqual(moved, [])
+        self.trains[2].stop = False
+        moved = self.scheduler.step()
+        self.assertEqual(moved, [self.trains[2]])
+
+    def test_speed_synced(self):
+        kinematics = self.scheduler.kinematics
+        self.trains[2].speed = 0.5
+        self.assertEqual(kinematics.speed[kinematics.index[self.trains[2]]], 0.5)
+
+    def test_run(self):
+        """Trains start at red signals, and run to the next one once cleared"""
+        self.scheduler.run(500)
+        slow_down = self.trains[2]
+        self.assertEqual(tuple(slow_down.pos), self.track_manager.track_labels["Platform 2"].end)
+        fast_up = self.trains[0]
+        self.assertEqual(tuple(fast_up.pos), (325, 575))
+        self.signal_manager.all["L1a"].on_click(None)
+        self.scheduler.run(2000)
+        self.assertIs(fast_up.track_segment, self.track_manager.track_labels["R2a"])
+        self.assertEqual(tuple(fast_up.pos), fast_up.track_segment.start)
+
+    def test_matches_train_move(self):
+        """Moving clear trains with the arrays gives the same positions as moving every train with Train.move"""
+        track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        signal_manager = Managers.SignalManager(track_manager, None, "Loft.accessory", cache=False)
+        trains = [train.Train(None, track_manager, (325, 575), 1, "Blue", "Fast Up", 1.6),
+                  train.Train(None, track_manager, (700, 525), -1, "Purple", "Fast Down", 1.4),
+                  train.Train(None, track_manager, (659, 380), -1, "Orange", "Slow Down")]
+        for manager in (signal_manager, self.signal_manager):
+            manager.all["L1a"].on_click(None)
+            manager.all["R1b"].on_click(None)
+        # Starting with too few trains for the arrays, which are then brought up to date to use
+        self.scheduler.min_vectorised = len(trains) + 1
+        for tick in range(1500):
+            if tick == 300:
+                self.scheduler.min_vectorised = 0
+            self.scheduler.step()
+            for other in trains:
+                if not other.stop:
+                    other.move()
+            for scheduled, other in zip(self.trains, trains):
+                self.assertAlmostEqual(scheduled.pos[0], other.pos[0], 6, tick)
+                self.assertAlmostEqual(scheduled.pos[1], other.pos[1], 6, tick)
+
+
+class TestEventSimulation(unittest.TestCase):
+    def setUp(self):
+        self.track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        self.signal_manager = Managers.SignalManager(self.track_manager, None, "Loft.accessory", cache=False)
+        self.simulation = Simulation.EventSimulation(self.track_manager)
+        self.trains = [train.Train(None, self.track_manager, (325, 575), 1, "Blue", "Fast Up", 1.6, self.simulation),
+                       train.Train(None, self.track_manager, (700, 525), -1, "Purple", "Fast Down", 1.4,
+                                   self.simulation),
+                       train.Train(None, self.track_manager, (659, 380), -1, "Orange", "Slow Down",
+                                   scheduler=self.simulation)]
+
+    def test_waits_for_signal(self):
+        """Trains held at red signals have no events until the signal clears"""
+        fast_up = self.trains[0]
+        self.simulation.run(2000)
+        self.assertEqual(tuple(fast_up.pos), (325, 575))
+        self.assertFalse(self.simulation.queue)
+        self.signal_manager.all["L1a"].on_click(None)
+        self.simulation.run(4000)
+        self.assertIs(fast_up.track_segment, self.track_manager.track_labels["R2a"])
+        self.assertEqual(tuple(fast_up.pos), fast_up.track_segment.start)
+
+    def test_zero_speed(self):
+        """A train at speed 0 stands where it is, without events, until its speed changes"""
+        fast_up = self.trains[0]
+        self.signal_manager.all["L1a"].on_click(None)
+        self.simulation.run(100)
+        fast_up.speed = 0
+        pos = tuple(fast_up.pos)
+        self.simulation.run(1000)
+        self.assertEqual(tuple(fast_up.pos), pos)
+        version = self.simulation._versions[fast_up]
+        self.assertNotIn((fast_up, version), [event[3:] for event in self.simulation.queue])
+        fast_up.speed = 1.6
+        self.simulation.run(1100)
+        self.assertNotEqual(tuple(fast_up.pos), pos)
+        standing = train.Train(None, self.track_manager, (325, 575), 1, "Green", "Standing", 0, self.simulation)
+        self.assertIn(standing, self.simulation.moving)
+
+    def test_matches_scheduler(self):
+        """Trains pass through the same pieces and stop in the same places as with the TrainScheduler"""
+        track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        signal_manager = Managers.SignalManager(track_manager, None, "Loft.accessory", cache=False)
+        scheduler = train.TrainScheduler()
+        trains = [train.Train(None, track_manager, (325, 575), 1, "Blue", "Fast Up", 1.6, scheduler),
+                  train.Train(None, track_manager, (700, 525), -1, "Purple", "Fast Down", 1.4, scheduler),
+                  train.Train(None, track_manager, (659, 380), -1, "Orange", "Slow Down", scheduler=scheduler)]
+        for manager in (signal_manager, self.signal_manager):
+            manager.all["L1a"].on_click(None)
+            manager.all["R1b"].on_click(None)
+        scheduler.run(3000)
+        self.simulation.run(3000)
+        for simulated, scheduled in zip(self.trains, trains):
+            self.assertEqual(simulated.track_segment.label, scheduled.track_segment.label)
+            self.assertEqual(simulated.stop, scheduled.stop)
+            self.assertAlmostEqual(simulated.pos[0], scheduled.pos[0], 0)
+            self.assertAlmostEqual(simulated.pos[1], scheduled.pos[1], 0)
+
+
+class TestSimulate(unittest.TestCase):
+    def test_deterministic(self):
+        """The same seed gives the same run, in either mode"""
+        for mode in ("event", "tick"):
+            first = simulate.simulate("Loft.track", "Loft.accessory", 120, seed=1, mode=mode)
+            second = simulate.simulate("Loft.track", "Loft.accessory", 120, seed=1, mode=mode)
+            del first["wall_seconds"], second["wall_seconds"]
+            self.assertEqual(first, second)
+            self.assertEqual(first["seconds"], 120)
+
+    def test_verbose(self):
+        """Output from loading and running is only shown with verbose"""
+        for verbose in (True, False):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                simulate.simulate("Loft.track", "Loft.accessory", 10, verbose=verbose)
+            self.assertEqual(bool(output.getvalue()), verbose)
+
+
+def run_head_on(predict, resolve=None):
+    """Runs two trains towards each other round the top left corner of the Loft layout. Returns the up and down
+    trains and the DeadlockDetector, or None if resolve is None."""
+    track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+    signal_manager = Managers.SignalManager(track_manager, None, "Loft.accessory", cache=False)
+    detector = Deadlock.DeadlockDetector(track_manager, resolve) if resolve is not None else None
+    predictor = Conflicts.ConflictPredictor(track_manager) if predict else None
+    scheduler = train.TrainScheduler(predictor=predictor)
+    up = train.Train(None, track_manager, (325, 575), 1, "Blue", "Up", 1.6, scheduler)
+    down = train.Train(None, track_manager, (500, 25), -1, "Red", "Down", 1.4, scheduler)
+    signal_manager.all["L1a"].on_click(None)
+    scheduler.run(1000)
+    return up, down, detector
+
+
+class TestConflictPredictor(unittest.TestCase):
+    def test_hard_stop_without(self):
+        up, down, _ = run_head_on(False)
+        self.assertEqual(up.conflicts, [down])
+
+    def test_brakes(self):
+        up, down, _ = run_head_on(True)
+        self.assertEqual(up.conflicts, [])
+        self.assertEqual(down.conflicts, [])
+        self.assertFalse(up.stop or down.stop)
+        self.assertEqual((up.speed, down.speed), (0, 0))
+        self.assertIsNot(up.track_segment, down.track_segment)
+        self.assertGreater(abs(up.pos[1] - down.pos[1]), Conflicts.ConflictPredictor.stop_short)
+
+    def test_zero_max_speed(self):
+        """A train with a max_speed of 0 claims the pieces ahead after a train that will reach them"""
+        track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        predictor = Conflicts.ConflictPredictor(track_manager)
+        standing = train.Train(None, track_manager, (659, 380), -1, "Orange", "Standing", 0)
+        following = train.Train(None, track_manager, (659, 380), -1, "Blue", "Following", 1.6)
+        predictor.update([standing, following])
+        self.assertEqual(standing.speed, 0)
+        self.assertNotIn(following, predictor.limits)
+        self.assertEqual(predictor.limits[standing][1], following)
+
+    def test_holds_follow_layout(self):
+        """Signals added after the predictor has run hold trains once the layout is marked as changed"""
+        track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        predictor = Conflicts.ConflictPredictor(track_manager)
+        slow_down = train.Train(None, track_manager, (659, 380), -1, "Orange", "Slow Down")
+        self.assertTrue(list(predictor.ahead(slow_down)))
+        Managers.SignalManager(track_manager, None, "Loft.accessory", cache=False)
+        track_manager.layout_changed()
+        # Held at the red Platform 2 signal at the end of its piece
+        self.assertEqual(list(predictor.ahead(slow_down)), [])
+
+
+class TestDeadlockDetector(unittest.TestCase):
+    def test_cycle(self):
+        track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        detector = Deadlock.DeadlockDetector(track_manager)
+        detector.waiting("a", "b")
+        detector.waiting("b", "c")
+        detector.waiting("d", "a")
+        self.assertEqual(detector.deadlocks, [])
+        detector.waiting("c", "a")
+        self.assertEqual(detector.deadlocks, [["c", "a", "b"]])
+        detector.waiting("c", "a")
+        self.assertEqual(len(detector.deadlocks), 1)
+        detector.waiting("c", None)
+        self.assertNotIn("c", detector.waits_for)
+
+    def test_head_on(self):
+        """Trains braking for each other are reported"""
+        up, down, detector = run_head_on(True, resolve=False)
+        self.assertEqual(detector.deadlocks, [[up, down]])
+
+    def test_resolve(self):
+        """Reversing one of the trains lets both carry on"""
+        up, down, detector = run_head_on(True, resolve=True)
+        self.assertEqual(len(detector.deadlocks), 1)
+        self.assertEqual(up.direction, down.direction)
+        self.assertGreater(up.speed, 0)
+        self.assertGreater(down.speed, 0)
+
+
+class TestDispatcher(unittest.TestCase):
+    @staticmethod
+    def dispatcher(services, accessory_file="Loft.accessory"):
+        """Returns a Dispatcher for services with the Loft trains on a freshly loaded Loft layout"""
+        track_manager = Managers.TrackManager(None, "Loft.track", cache=False)
+        Managers.SignalManager(track_manager, None, accessory_file, cache=False)
+        trains = train.loft_trains(None, track_manager, train.TrainScheduler())
+        return Dispatcher.Dispatcher(track_manager, Routing.RouteManager(track_manager), trains, services)
+
+    def test_priority(self):
+        """Of two services whose routes cross, the higher priority one is granted"""
+        for up_priority, granted, origin in ((0, "Fast Down", "R1b"), (2, "Fast Up", "L1a")):
+            with self.subTest(up_priority=up_priority):
+                dispatcher = self.dispatcher([Dispatcher.Service("Fast Up", "L1a", "St1a", 0, up_priority),
+                                              Dispatcher.Service("Fast Down", "R1b", "L4a", 0, 1)])
+                self.assertEqual([service.train for service in dispatcher.update(0)], [granted])
+                self.assertTrue(dispatcher.track_manager.signal_manager.all[origin].set)
+
+    def test_interlocked_origin(self):
+        """A service whose origin signal is held red by a point off its route is not granted, and changes nothing"""
+        with open("Loft.accessory") as f:
+            text = re.sub(r'^("L1a":: .*Red\[)(.*)\]$', r'\1\2 | "L4a" 1]', f.read(), flags=re.MULTILINE)
+        with tempfile.NamedTemporaryFile("w", suffix=".accessory", delete=False) as f:
+            f.write(text)
+        self.addCleanup(os.remove, f.name)
+        dispatcher = self.dispatcher([Dispatcher.Service("Fast Up", "L1a", "St1a", 0)], f.name)
+        track_manager = dispatcher.track_manager
+        point = track_manager.track_labels["L4a"]
+        lever = Managers.lever_of(point)
+        lever.set(1 ^ (point in lever.invert))
+        route = dispatcher.route_manager.route("L1a", "St1a")
+        self.assertNotIn(lever, route.settings)
+        states = {lever: Managers.lever_state(lever) for lever in route.settings}
+        self.assertNotEqual(states, route.settings)
+        fast_up = dispatcher.trains["Fast Up"]
+        segment_end = fast_up.segment_end
+        self.assertEqual(dispatcher.update(0), [])
+        self.assertEqual({lever: Managers.lever_state(lever) for lever in route.settings}, states)
+        self.assertEqual(fast_up.segment_end, segment_end)
+        self.assertFalse(track_manager.signal_manager.all["L1a"].set)
+        # Once the point is set back the service goes
+        lever.set(0 ^ (point in lever.invert))
+        self.assertEqual([service.train for service in dispatcher.update(1)], ["Fast Up"])
+
+    def test_serial(self):
+        """The points switched for a granted service, and only those, are written to serial"""
+        dispatcher = self.dispatcher([Dispatcher.Service("Fast Up", "L1a", "St1a", 0)])
+        written = []
+        for group in dispatcher.track_manager.groups:
+            group.serial_manager = types.SimpleNamespace(write_point=written.append)
+        route = dispatcher.route_manager.route("L1a", "St1a")
+        changed = [piece for lever, state in route.settings.items() if Managers.lever_state(lever) != state
+                   for piece in lever.points]
+        self.assertTrue(changed)
+        self.assertEqual([service.train for service in dispatcher.update(0)], ["Fast Up"])
+        self.assertEqual(sorted(written, key=id), sorted(changed, key=id))
+
+    def test_aging(self):
+        """A lower priority service that has waited long enough goes before a higher priority one"""
+        dispatcher = self.dispatcher([Dispatcher.Service("Fast Up", "L1a", "St1a", 0, 0),
+                                      Dispatcher.Service("Fast Down", "R1b", "L4a", 120, 1)])
+        self.assertEqual([service.train for service in dispatcher.update(120)], ["Fast Up"])
+
+    def test_timetable(self):
+        results = simulate.simulate("Loft.track", "Loft.accessory", 600, timetable_file="Loft.timetable")
+        self.assertGreater(results["services"], 10)
+        self.assertAlmostEqual(results["throughput"], results["services"] * 6)
+        self.assertEqual(results["conflicts"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
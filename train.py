@@ -3,6 +3,7 @@
 from Managers import TrackManager, SignalManager
 import tkinter
 from ResizingCanvas import ResizingCanvas
+from Kinematics import TrainKinematics
 import time
 import logging
 
@@ -14,59 +15,62 @@ class Train:
     Right click to change direction
     """
 
-    def __init__(self, canvas, track_manager, pos, direction, colour="Blue", label="", speed=1.0):
+    def __init__(self, canvas, track_manager, pos, direction, colour="Blue", label="", speed=1.0, scheduler=None):
         self.size = 4
         self.canvas = canvas
         self.track_manager = track_manager
         self.colour = colour
         self.label = label
-        self.speed = speed
+        self._speed = speed
+        # Speed to run at when not braking
+        self.max_speed = speed
         self.pos = list(pos)
-        self.t = time.time()
         coord = tuple(pos)
         if coord not in self.track_manager.coordinate_dict:
-            near_id = self.canvas.find_closest(*self.pos)
-            print(near_id)
-            self.track_segment = self.track_manager.piece_by_id(near_id[0])
-        else:
-            piece_list = self.track_manager.coordinate_dict[coord]
-            if None in piece_list:
-                self.track_segment = next((x for x in piece_list if x is not None))
+            if self.canvas is not None:
+                near_id = self.canvas.find_closest(*self.pos)
+                print(near_id)
+                self.track_segment = self.track_manager.piece_by_id(near_id[0])
             else:
-                if piece_list[0].direction == piece_list[1].direction:  # The common case
-                    if direction == piece_list[0].direction:
-                        self.track_segment = next((x for x in piece_list if x.start == coord))
-                    else:
-                        # TODO: Cope with alternates
-                        self.track_segment = next((x for x in piece_list if x.end == coord))
-                else:
-                    # Assume we are going the right way on the track.
-                    self.track_segment = next((x for x in piece_list if x.direction == direction))
+                self.track_segment = self.track_manager.closest_piece(self.pos)
+        else:
+            self.track_segment = self.track_manager.start_piece(coord, direction)
         self.segment_start = pos
         self.segment_end = self.track_segment.next(pos)
         # Get the previous segment
         if self.segment_end is not None:
             self.segment_start = self.track_segment.next(self.segment_end)
-            self.previous_segment = next(
-                (x for x in self.track_manager.coordinate_dict[self.segment_start] if
-                 x is not self.track_segment))
+            self.previous_segment = self.track_manager.other_piece(self.segment_start, self.track_segment)
         else:
             self.previous_segment = None
 
-        self.track_segment.train_in = self
+        self.occupancy = track_manager.occupancy
+        self.occupancy.occupy(self.track_segment, self)
         if self.previous_segment is not None:
-            self.previous_segment.train_in = self
+            self.occupancy.occupy(self.previous_segment, self)
         # self.track_segment = track_manager.coordinate_dict[pos][0]
         self.direction = direction
-        self.image_id = self.create()
-        self.canvas.tag_bind(self.image_id, "<Button-1>", self.on_click)
-        self.canvas.tag_bind(self.image_id, "<Button-3>", self.on_click)
-        self.stop = False
+        self.image_id = None
+        if self.canvas is not None:
+            self.image_id = self.create()
+            self.canvas.tag_bind(self.image_id, "<Button-1>", self.on_click)
+            self.canvas.tag_bind(self.image_id, "<Button-3>", self.on_click)
+        self.scheduler = None
+        self._stop = False
         self.next_section_occupied_flag = False
+        # Trains this one has stopped for
+        self.conflicts = []
         self._seg_end_cache = self.segment_end
         self._track_seg_cache = self.track_segment
-        self._next_segment = next((x for x in self.track_manager.coordinate_dict[self.segment_end] if x is not self.track_segment))
-        self.canvas.after(10, self.move)
+        self._next_segment = self.track_manager.other_piece(self.segment_end, self.track_segment)
+        self._path_key = None
+        self._path = None
+        # A one item sequence, so that like pos it can be a view of an array
+        self._distance = [0.0]
+        if self.segment_end is not None:
+            self.distance = self.path.locate(self.pos)
+        if scheduler is not None:
+            scheduler.add(self)
 
     def create(self) -> int:
         """Draw on the canvas, returning the id"""
@@ -76,21 +80,63 @@ class Train:
 
     def draw(self):
         """Edits the current image"""
+        if self.canvas is None:
+            return
         if self.stop:
             self.canvas.itemconfig(self.image_id, outline="Red")
         else:
             self.canvas.itemconfig(self.image_id, outline="Black")
 
+    @property
+    def stop(self):
+        return self._stop
+
+    @stop.setter
+    def stop(self, value):
+        self._stop = value
+        self.changed()
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @speed.setter
+    def speed(self, value):
+        self._speed = value
+        self.changed()
+
+    def changed(self):
+        """Tells the scheduler the train has stopped, started, reversed or changed speed"""
+        if self.scheduler is not None:
+            self.scheduler.changed(self)
+
     @property
     def next_section(self):
         """Returns the next piece of track"""
         if self.segment_end != self._seg_end_cache or self.track_segment != self._track_seg_cache:
             self._seg_end_cache = self.segment_end
             self._track_seg_cache = self.track_segment
-            self._next_segment = next((x for x in self.track_manager.coordinate_dict[self.segment_end]
-                                       if x is not self.track_segment))
+            self._next_segment = self.track_manager.other_piece(self.segment_end, self.track_segment)
         return self._next_segment
 
+    @property
+    def distance(self):
+        """Distance along the path from segment_start to segment_end"""
+        return self._distance[0]
+
+    @distance.setter
+    def distance(self, value):
+        self._distance[0] = value
+
+    @property
+    def path(self):
+        """Returns the Path along the track segment from segment_start to segment_end"""
+        key = (self.track_segment, self.segment_start, self.segment_end)
+        if key != self._path_key:
+            self._path_key = key
+            self._path = self.track_segment.path(self.segment_start, self.segment_end)
+        return self._path
+
     @staticmethod
     def close_to(x, y, diff=0.5):
         """Works out if two 2-vectors are sufficiently close (for small errors introduced by corners)
@@ -105,84 +151,215 @@ class Train:
         if event.num == 1:
             self.stop = not self.stop
         else:
-            self.direction *= -1
-            self.segment_start, self.segment_end = self.segment_end, self.segment_start
+            self.reverse()
         self.draw()
 
+    def reverse(self):
+        """Changes direction where the train is"""
+        self.direction *= -1
+        if self.segment_end is not None:
+            self.distance = self.path.length - self.distance
+        else:
+            self.distance = 0.0
+        self.segment_start, self.segment_end = self.segment_end, self.segment_start
+        self.changed()
+
+    def wait_for(self, other):
+        """Tells the deadlock detector, if there is one, the train this one is waiting for, or None once it can move"""
+        detector = self.track_manager.deadlock_detector
+        if detector is not None:
+            detector.waiting(self, other)
+
+    def coords(self):
+        """Returns the canvas coordinates of the image at the current position"""
+        return ((self.pos[0] - self.size) * self.canvas.wscale, (self.pos[1] - self.size) * self.canvas.hscale,
+                (self.pos[0] + self.size) * self.canvas.wscale, (self.pos[1] + self.size) * self.canvas.hscale)
+
     def __str__(self):
         return "Train {} ({})".format(self.label, self.colour)
 
     def conflict(self, other):
+        self.conflicts.append(other)
         self.stop = True
         self.draw()
         print(self, "Stopped due to conflicting traffic", other)
 
 
-    def move(self):
-        """Called by tkinter. Checks whether the train can move (e.g. if stopped by click, at a red signal, points set
-        against or other train ahead) sets the current and previous tack pieces as occupied and moves an increment
-        towards the end of the track piece.
-        Finally sets itself to be called again after 10ms.
-        """
-        t = time.time()
-        if t-self.t > 0.02:
-            logging.debug("{} delay between move calls {}".format(self, t-self.t))
-        self.t = t
-        if self.stop:
-            self.canvas.after(10, self.move)
-            return
-
-        # Stop at red signals
+    def held_by(self):
+        """Returns the red signal next to the track segment the train is held at, or None"""
         label = self.track_segment.label
         signal_manager = self.track_manager.signal_manager
         if label and signal_manager and label in signal_manager.all:
             signal = signal_manager.all[label]
-            # Held by signal that is next to the track segment.
             if signal.direction == self.direction and not signal.set and \
                tuple(self.pos) == getattr(self.track_segment, signal.track_relative_position):
-                # Check if points have changed
-                self.segment_end = self.track_segment.next(self.segment_start)
-                self.canvas.after(10, self.move)
-                return
+                return signal
+        return None
+
+    def oncoming(self, piece):
+        """Returns the train on piece if it is travelling the opposite way, or None"""
+        other = self.occupancy.occupant(piece)
+        if other is not None and other.direction == -1 * self.direction:
+            return other
+        return None
+
+    def move(self) -> bool:
+        """Called by the TrainScheduler each tick. Checks whether the train can move (e.g. if stopped by click, at a
+        red signal, points set against or other train ahead) sets the current and previous tack pieces as occupied and
+        moves speed along the path of the track piece towards its end.
+        Returns True if the train has moved and needs redrawing.
+        """
+        if self.stop:
+            return False
+
+        # Stop at red signals
+        signal = self.held_by()
+        if signal is not None:
+            # Check if points have changed
+            self.segment_end = self.track_segment.next(self.segment_start)
+            if signal.automatic:
+                self.wait_for(self.track_manager.signal_manager.block_occupant(signal))
+            return False
 
         if self.segment_end is None:
             self.segment_end = self.track_segment.next(self.pos)
-        elif self.close_to(self.pos, self.segment_end, 0.5*self.speed):
+            self.segment_start = tuple(self.pos)
+            self.distance = 0.0
+        elif self.distance >= self.path.length:
             next_section = self.next_section
             if next_section is None:
                 print("End of line for", self)
                 self.stop = True
                 self.draw()
-            elif next_section.train_in and next_section.train_in != self:
+            elif self.occupancy.occupant(next_section) not in (None, self):
                 if not self.next_section_occupied_flag:
                     print("Next section occupied for", self)
                     self.next_section_occupied_flag = True
+                self.wait_for(self.occupancy.occupant(next_section))
             else:
                 self.next_section_occupied_flag = False
+                self.wait_for(None)
                 self.previous_segment = self.track_segment
                 self.track_segment = next_section
                 self.segment_start = self.segment_end
-                self.pos = list(self.segment_end)
+                self.pos[:] = self.segment_end
                 self.segment_end = self.track_segment.next(self.segment_end)
+                self.distance = 0.0
+                return True
         elif self.close_to(self.pos, self.segment_end, 20) and self.next_section is not None and \
-                self.next_section.train_in and self.next_section.train_in.direction == -1 * self.direction:
-            self.conflict(self.next_section.train_in)
-            self.next_section.train_in.conflict(self)
+                self.oncoming(self.next_section) is not None:
+            other = self.oncoming(self.next_section)
+            self.conflict(other)
+            other.conflict(self)
         else:
-            self.track_segment.train_in = self
-            if self.previous_segment is not None and self.previous_segment.train_in == self:
-                self.previous_segment.train_in = False
-            dx = self.segment_end[0] - self.pos[0]
-            dy = self.segment_end[1] - self.pos[1]
-            normalise = (dx ** 2 + dy ** 2) ** 0.5
-            # self.canvas.move(self.image_id, dx/normalise, dy/normalise)
-            self.pos[0] += dx / normalise * self.speed
-            self.pos[1] += dy / normalise * self.speed
-            self.canvas.coords(self.image_id, (self.pos[0] - self.size) * self.canvas.wscale,
-                               (self.pos[1] - self.size) * self.canvas.hscale,
-                               (self.pos[0] + self.size) * self.canvas.wscale,
-                               (self.pos[1] + self.size) * self.canvas.hscale)
-        self.canvas.after(10, self.move)
+            self.occupancy.occupy(self.track_segment, self)
+            if self.previous_segment is not None:
+                self.occupancy.release(self.previous_segment, self)
+            if self.speed:
+                self.wait_for(None)
+            # Along the path, stopping exactly at its end rather than overshooting
+            path = self.path
+            self.distance = min(self.distance + self.speed, path.length)
+            self.pos[:] = path.at(self.distance)
+            return True
+        return False
+
+
+class TrainScheduler:
+    """Advances every train in one fixed timestep tick, so there is a single timer however many trains there are.
+    Trains clear of the ends of their segments are moved together by TrainKinematics, the rest by Train.move. Stopped
+    trains are skipped, and the canvas is updated once per tick for the trains that moved. If ticks are late the
+    scheduler catches up by running several steps at once (up to max_catch_up), so simulated time keeps a steady rate.
+    With no canvas, run advances the trains as fast as possible. A ConflictPredictor, if given, sets the trains'
+    speeds before each step.
+    A step of TrainKinematics costs about 20 us however many trains it moves, and Train.move 3 to 4 us a train, so
+    with fewer than min_vectorised trains every train is moved by Train.move, and the arrays are brought up to date
+    when there are enough trains to use them."""
+
+    def __init__(self, canvas=None, tick=10, max_catch_up=5, predictor=None, min_vectorised=8):
+        self.canvas = canvas
+        self.tick = tick
+        self.max_catch_up = max_catch_up
+        self.predictor = predictor
+        self.min_vectorised = min_vectorised
+        self.kinematics = TrainKinematics()
+        self.ticks = 0
+        self._last = None
+        # False once trains have been moved by Train.move alone, and the arrays are out of date
+        self._synced = True
+
+    @property
+    def trains(self):
+        return self.kinematics.trains
+
+    def add(self, train):
+        train.scheduler = self
+        self.kinematics.add(train)
+
+    def remove(self, train):
+        self.kinematics.remove(train)
+        train.scheduler = None
+
+    def changed(self, train):
+        self.kinematics.sync(train)
+
+    def step(self):
+        """Advances all running trains one tick. Returns the trains that moved."""
+        self.ticks += 1
+        if self.predictor is not None:
+            self.predictor.update(self.kinematics.trains)
+        trains = self.kinematics.trains
+        if len(trains) < self.min_vectorised:
+            self._synced = False
+            return [train for train in trains if train.move()]
+        if not self._synced:
+            for train in trains:
+                self.kinematics.sync(train)
+            self._synced = True
+        moved, others = self.kinematics.step()
+        out = [trains[i] for i in moved]
+        for i in others:
+            train = trains[i]
+            if train.move():
+                out.append(train)
+            self.kinematics.sync(train)
+        return out
+
+    def start(self):
+        """Starts the timer on the canvas"""
+        self._last = time.perf_counter()
+        self.canvas.after(self.tick, self.on_timer)
+
+    def on_timer(self):
+        """Called by tkinter. Runs the steps that are due, redraws the trains that moved and sets the next timer."""
+        now = time.perf_counter()
+        due = int((now - self._last) * 1000 // self.tick)
+        if due > self.max_catch_up:
+            logging.debug("{} ticks late, skipping {}".format(due, due - self.max_catch_up))
+            due = self.max_catch_up
+            self._last = now
+        else:
+            self._last += due * self.tick / 1000
+        moved = {}
+        for _ in range(due):
+            for train in self.step():
+                moved[train] = True
+        for train in moved:
+            self.canvas.coords(train.image_id, *train.coords())
+        delay = self.tick - (time.perf_counter() - self._last) * 1000
+        self.canvas.after(max(1, int(delay)), self.on_timer)
+
+    def run(self, ticks):
+        """Runs a number of ticks without a canvas, as fast as possible"""
+        for _ in range(ticks):
+            self.step()
+
+
+def loft_trains(canvas, track_manager, scheduler=None):
+    """Places the trains on the Loft layout"""
+    return [Train(canvas, track_manager, (325, 575), 1, "Blue", "Fast Up", 1.6, scheduler),
+            Train(canvas, track_manager, (700, 525), -1, "Purple", "Fast Down", 1.4, scheduler),
+            Train(canvas, track_manager, (659, 380), -1, "Orange", "Slow Down", scheduler=scheduler)]
 
 
 if __name__ == "__main__":
@@ -192,11 +369,11 @@ if __name__ == "__main__":
     frame.pack(fill="both", expand="yes")
     root.wm_title("Railway Manager")
     canvas = ResizingCanvas(frame, bg="cyan", height=600, width=1000)
-    track_manager = TrackManager(canvas, "Loft.track")
-    signal_manager = SignalManager(track_manager, canvas, "Loft.accessory")
+    track_manager = TrackManager(canvas, "Loft.track", cache=True)
+    signal_manager = SignalManager(track_manager, canvas, "Loft.accessory", cache=True)
     canvas.pack(fill="both", expand="yes")
-    fast_up_train = Train(canvas, track_manager, (325, 575), 1, "Blue", "Fast Up", 1.6)
-    fast_down_train = Train(canvas, track_manager, (700, 525), -1, "Purple", "Fast Down", 1.4)
-    slow_down_train = Train(canvas, track_manager, (659, 380), -1, "Orange", "Slow Down")
+    scheduler = TrainScheduler(canvas)
+    trains = loft_trains(canvas, track_manager, scheduler)
+    scheduler.start()
     root.mainloop()
     print("\nDone")